@@ -0,0 +1,113 @@
+"""
+Benchmarks of the preprocessing of a SpectrumBatch (a synthetic Raman map).
+Run from the root of the repository:
+
+    python benchmarks/bench_batch.py
+
+"""
+import timeit
+
+import numpy as np
+
+from ramanpy import SpectrumBatch
+from ramanpy.preprocessing import (_als_batched, _als_single, common_grid, despike_diff, resample_spectra,
+                                  smooth_spectra, snip_baseline)
+
+
+def make_map(n_spectra=10000, n_points=1024, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(100, 3500, n_points)
+    centers = 1350 + 5 * rng.standard_normal((n_spectra, 1))
+    y = 100 / (1 + ((x - centers) / 30) ** 2) + 80 / (1 + ((x - 1590) / 25) ** 2)
+    y += 0.002 * x + rng.random((n_spectra, n_points))
+    return x, y
+
+
+def report(name, seconds, reference=None):
+    line = f'{name:<40s} {seconds * 1e3:9.2f} ms'
+    if reference is not None:
+        line += f'   x{reference / seconds:5.1f}'
+    print(line)
+
+
+def bench_precision(number=3):
+    x, y = make_map()
+    other_data = {'window_size': '15', 'poly_order': '3'}  # as read by ConfigObj
+    print(f'Smoothing + normalization of a {y.shape[0]} x {y.shape[1]} map')
+
+    reference = None
+    for dtype in (np.float64, np.float32):
+        batch = SpectrumBatch(x, y, other_data=other_data, dtype=dtype)
+
+        def preprocess():
+            batch.y = y.astype(dtype)
+            batch.apply_smoothing()
+            batch.apply_normalize()
+
+        seconds = min(timeit.repeat(preprocess, number=1, repeat=number))
+        print(f'{np.dtype(dtype).name}: intensities use {batch.y.nbytes / 2 ** 20:.1f} MiB')
+        report(f'preprocessing {np.dtype(dtype).name}', seconds, reference)
+        reference = seconds if reference is None else reference
+
+
+def bench_smoothing(number=3):
+    x, y = make_map()
+    print(f'Savitzky-Golay smoothing of a {y.shape[0]} x {y.shape[1]} map')
+    for window_size in (15, 101):
+        def loop():
+            return [smooth_spectra(spectrum, window_size, 3, method='savgol') for spectrum in y]
+
+        reference = min(timeit.repeat(loop, number=1, repeat=number))
+        report(f'window {window_size}: one call per spectrum', reference)
+        for method in ('savgol', 'fft'):
+            seconds = min(timeit.repeat(lambda: smooth_spectra(y, window_size, 3, method=method),
+                                        number=1, repeat=number))
+            report(f'window {window_size}: batched {method}', seconds, reference)
+
+
+def bench_baseline(n_spectra=2000, number=1):
+    x, y = make_map(n_spectra=n_spectra)
+    print(f'Baseline removal of a {y.shape[0]} x {y.shape[1]} map')
+    reference = min(timeit.repeat(lambda: [_als_single(spectrum, 1e6, 0.01, 10) for spectrum in y],
+                                  number=1, repeat=number))
+    report('asymmetric least squares, one by one', reference)
+    seconds = min(timeit.repeat(lambda: _als_batched(y, 1e6, 0.01, 10), number=1, repeat=number))
+    report('asymmetric least squares, batched', seconds, reference)
+    seconds = min(timeit.repeat(lambda: snip_baseline(y, half_window=40), number=1, repeat=number))
+    report('SNIP, batched', seconds, reference)
+
+
+def bench_despike(number=3):
+    x, y = make_map()
+    y[::100, 500] += 500  # one spike every 100 spectra
+    print(f'Cosmic-ray removal of a {y.shape[0]} x {y.shape[1]} map')
+    seconds = min(timeit.repeat(lambda: despike_diff(y), number=1, repeat=number))
+    report('despike_diff, batched', seconds)
+
+
+def bench_resampling(number=3):
+    x, y = make_map()
+    rng = np.random.default_rng(1)
+    # each spectrum with its own slightly shifted and stretched axis, as from different sessions
+    x_axes = [x * (1 + 1e-4 * rng.standard_normal()) + rng.standard_normal() for _ in range(len(y))]
+    grid = common_grid(x_axes)
+    print(f'Resampling of {y.shape[0]} spectra of {y.shape[1]} points, each with its own axis')
+
+    def one_by_one():
+        return [np.interp(grid, x_axis, spectrum) for x_axis, spectrum in zip(x_axes, y)]
+
+    reference = min(timeit.repeat(one_by_one, number=1, repeat=number))
+    report('np.interp, one call per spectrum', reference)
+    for kind in ('linear', 'cubic'):
+        seconds = min(timeit.repeat(lambda: resample_spectra(x_axes, y, grid, kind=kind), number=1, repeat=number))
+        report(f'resample_spectra {kind}', seconds, reference)
+    seconds = min(timeit.repeat(lambda: resample_spectra(x, y, grid), number=1, repeat=number))
+    report('resample_spectra linear, shared axis', seconds, reference)
+
+
+if __name__ == '__main__':
+    bench_precision()
+    bench_smoothing()
+    bench_baseline()
+    bench_despike()
+    bench_resampling()
@@ -0,0 +1,221 @@
+"""
+Benchmarks of the fits of ramanpy.
+Run from the root of the repository:
+
+    python benchmarks/bench_fit.py
+
+"""
+import contextlib
+import io
+import timeit
+
+import numpy as np
+from lmfit.models import LorentzianModel, QuadraticModel
+
+from ramanpy import RamanFit, SpectrumBatch
+
+
+def make_spectrum(n_points=1024, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(100, 3500, n_points)
+    y = 100 / (1 + ((x - 1350) / 30) ** 2) + 80 / (1 + ((x - 1590) / 25) ** 2)
+    y += 0.002 * x + rng.random(n_points)
+    return x, y
+
+
+def report(name, seconds, reference=None, n_evaluations=None):
+    line = f'{name:<40s} {seconds * 1e3:9.2f} ms'
+    if n_evaluations is not None:
+        line += f' {n_evaluations:6d} evaluations'
+    if reference is not None:
+        line += f'   x{reference / seconds:5.1f}'
+    print(line)
+
+
+def fit_spectrum(x, y, peaks, other_data):
+    with contextlib.redirect_stdout(io.StringIO()):  # messages of the defaults and of lmfit
+        fit = RamanFit.from_arrays(x, y, peaks=peaks, other_data=dict(other_data))
+        fit.apply_normalize()
+        fit.set_tolerances_fit()
+        fit.apply_roi()
+        fit.apply_decimation()
+        fit.build_fitting_model_peaks()
+        fit.run_fit_model()
+    return fit
+
+
+def bench_roi(number=5):
+    other_data = {'poly_type': 'linear', 'peak_center_tolerance': '20', 'sigma': '30',
+                  'min_max_amplitude': ['0', '500']}
+    for n_points in (1024, 16384):
+        x, y = make_spectrum(n_points)
+        print(f'Fit of 2 peaks in a {x.size} points spectrum')
+
+        reference = None
+        for roi in ('none', 'sigma'):
+            fit = fit_spectrum(x, y, [1350, 1590], dict(other_data, roi=roi))
+            seconds = min(timeit.repeat(lambda: fit_spectrum(x, y, [1350, 1590], dict(other_data, roi=roi)),
+                                        number=1, repeat=number))
+            report(f'roi = {roi}, {fit.x.size} points', seconds, reference, fit.result.nfev)
+            reference = seconds if reference is None else reference
+
+
+def bench_decimation(number=5):
+    x, y = make_spectrum(16384)
+    other_data = {'poly_type': 'linear', 'peak_center_tolerance': '20', 'sigma': '30',
+                  'min_max_amplitude': ['0', '500'], 'decimation_factor': '8'}
+    print(f'Fit of 2 peaks in a {x.size} points spectrum, decimated')
+
+    reference = None
+    for mode in ('none', 'curvature', 'peaks'):
+        fit = fit_spectrum(x, y, [1350, 1590], dict(other_data, decimate=mode))
+        seconds = min(timeit.repeat(lambda: fit_spectrum(x, y, [1350, 1590], dict(other_data, decimate=mode)),
+                                    number=1, repeat=number))
+        report(f'decimate = {mode}, {fit.x.size} points', seconds, reference, fit.result.nfev)
+        reference = seconds if reference is None else reference
+
+
+def make_carbon_spectrum(n_points=2000, seed=0):
+    # the 7 peaks of raman_linear_carbon.ini
+    peaks = [1150, 1346, 1587, 2480, 2687, 2932, 3230]
+    rng = np.random.default_rng(seed)
+    x = np.linspace(1000, 3400, n_points)
+    y = sum(amplitude * 30 / np.pi / ((x - center - 5) ** 2 + 30 ** 2)
+            for amplitude, center in zip([500, 3000, 2500, 400, 1200, 600, 300], peaks))
+    y += 0.01 * x + 1e-6 * x ** 2 + rng.normal(0, 0.5, x.size)
+    return x, y, peaks
+
+
+def bench_jacobian(number=5):
+    x, y, peaks = make_carbon_spectrum()
+    other_data = {'poly_type': 'quadratic', 'peak_center_tolerance': '50', 'sigma': '30',
+                  'min_max_amplitude': ['0', '500'], 'min_max_sigma': ['1', '200']}
+    print(f'Fit of {len(peaks)} peaks and a quadratic background in a {x.size} points spectrum')
+
+    reference = None
+    for mode in ('numeric', 'analytic'):
+        fit = fit_spectrum(x, y, peaks, dict(other_data, jacobian=mode))
+        seconds = min(timeit.repeat(lambda: fit_spectrum(x, y, peaks, dict(other_data, jacobian=mode)),
+                                    number=1, repeat=number))
+        report(f'jacobian = {mode}', seconds, reference, fit.result.nfev)
+        reference = seconds if reference is None else reference
+
+
+def bench_model(number=200):
+    x, y, peaks = make_carbon_spectrum()
+    other_data = {'poly_type': 'quadratic', 'peak_center_tolerance': '50', 'sigma': '30',
+                  'min_max_amplitude': ['0', '500'], 'min_max_sigma': ['1', '200']}
+    fit = fit_spectrum(x, y, peaks, other_data)
+    params = fit.result.params
+    composite = QuadraticModel(prefix='bkg')
+    for i in range(len(peaks)):
+        composite = composite + LorentzianModel(prefix='lz%d' % (i + 1))
+    print(f'Evaluation of {len(peaks)} peaks and a quadratic background on {x.size} points')
+
+    reference = timeit.timeit(lambda: composite.eval(params, x=x), number=number) / number
+    report('CompositeModel of LorentzianModel', reference)
+    seconds = timeit.timeit(lambda: fit.model.eval(params, x=x), number=number) / number
+    report('MultiLorentzianModel', seconds, reference)
+
+
+def bench_batch_fit(n_spectra=64, number=3):
+    maps = [make_carbon_spectrum(1000, seed) for seed in range(n_spectra)]
+    x, peaks = maps[0][0], maps[0][2]
+    other_data = {'poly_type': 'quadratic', 'peak_center_tolerance': '50', 'sigma': '30',
+                  'min_max_amplitude': ['0', '500'], 'min_max_sigma': ['1', '200'], '_normalize_data': True}
+    with contextlib.redirect_stdout(io.StringIO()):
+        batch = SpectrumBatch(x, np.array([y for _, y, _ in maps]), peaks=peaks, other_data=other_data)
+        batch.apply_normalize()
+    print(f'Fit of {n_spectra} spectra of {x.size} points with {len(peaks)} peaks')
+
+    def run(method):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return method()
+
+    reference = min(timeit.repeat(lambda: run(batch.run_fits), number=1, repeat=number))
+    report('run_fits (one lmfit fit per spectrum)', reference)
+    table = run(batch.run_batch_fits)
+    seconds = min(timeit.repeat(lambda: run(batch.run_batch_fits), number=1, repeat=number))
+    report('run_batch_fits', seconds, reference, int(table['nfev'].mean()))
+
+
+def make_map(n_side=12, n_points=600, seed=0):
+    # the peaks drift slowly across the map, as in a real sample
+    rng = np.random.default_rng(seed)
+    x = np.linspace(1000, 2000, n_points)
+    grid_x, grid_y = (grid.ravel() for grid in np.meshgrid(np.arange(n_side) * 2.0, np.arange(n_side) * 2.0))
+    centers = 1330 + grid_x + rng.normal(0, 0.3, grid_x.size)
+    y = np.array([(300 + 5 * position) / (1 + ((x - center) / 30) ** 2) + 200 / (1 + ((x - 1600) / 25) ** 2)
+                  for center, position in zip(centers, grid_y)]) + rng.normal(0, 1, (grid_x.size, x.size))
+    return x, y, {'X': grid_x, 'Y': grid_y}
+
+
+def bench_map_fits(number=1):
+    x, y, positions = make_map()
+    other_data = {'poly_type': 'linear', 'peak_center_tolerance': '30', 'sigma': '10', '_normalize_data': True,
+                  'min_max_amplitude': ['0', '500'], 'min_max_sigma': ['1', '200']}
+
+    for jacobian in ('analytic', 'numeric'):
+        with contextlib.redirect_stdout(io.StringIO()):
+            batch = SpectrumBatch(x, y, peaks=[1350, 1590], other_data=dict(other_data, jacobian=jacobian),
+                                  metadata=positions)
+            batch.apply_normalize()
+        print(f'Fit of a map of {len(batch)} spectra, jacobian = {jacobian}')
+
+        def cold():
+            return [batch.fit_spectrum(i).result.nfev for i in range(len(batch))]
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            n_evaluations = int(np.mean(cold()))
+            reference = min(timeit.repeat(cold, number=1, repeat=number))
+        report('cold start', reference, None, n_evaluations)
+        for order, coarse_step in (('raster', None), ('snake', None), ('hilbert', None), ('hilbert', 3)):
+            def warm():
+                return batch.run_map_fits(order=order, coarse_step=coarse_step)
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                table = warm()
+                seconds = min(timeit.repeat(warm, number=1, repeat=number))
+            name = f'warm start, {order}' + ('' if coarse_step is None else f', coarse step {coarse_step}')
+            report(name, seconds, reference, int(round(table['nfev'].mean())))
+
+
+def bench_initial_guess(number=3):
+    x, y, peaks = make_carbon_spectrum()
+    # sigma and amplitude left to the defaults of RamanFit, the same for all the peaks
+    other_data = {'poly_type': 'quadratic', 'peak_center_tolerance': '50', 'min_max_amplitude': ['0', '500'],
+                  'min_max_sigma': ['1', '200']}
+    print(f'Fit of {len(peaks)} peaks and a quadratic background in a {x.size} points spectrum')
+    for jacobian in ('numeric', 'analytic'):
+        reference = None
+        for guess in ('none', 'peaks'):
+            settings = dict(other_data, jacobian=jacobian, initial_guess=guess)
+            fit = fit_spectrum(x, y, peaks, settings)
+            seconds = min(timeit.repeat(lambda: fit_spectrum(x, y, peaks, settings), number=1, repeat=number))
+            report(f'jacobian = {jacobian}, initial_guess = {guess}', seconds, reference, fit.result.nfev)
+            reference = seconds if reference is None else reference
+
+    maps = [make_carbon_spectrum(1000, seed) for seed in range(64)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        batch = SpectrumBatch(maps[0][0], np.array([y for _, y, _ in maps]), peaks=peaks,
+                              other_data=dict(other_data, _normalize_data=True))
+        batch.apply_normalize()
+    print(f'Fit of {len(batch)} spectra of {batch.x.size} points with run_batch_fits')
+    reference = None
+    for guess in ('none', 'peaks'):
+        batch.other_data['initial_guess'] = guess
+        with contextlib.redirect_stdout(io.StringIO()):
+            table = batch.run_batch_fits()
+            seconds = min(timeit.repeat(batch.run_batch_fits, number=1, repeat=number))
+        report(f'initial_guess = {guess}', seconds, reference, int(round(table['nfev'].mean())))
+        reference = seconds if reference is None else reference
+
+
+if __name__ == '__main__':
+    bench_roi()
+    bench_decimation()
+    bench_jacobian()
+    bench_model()
+    bench_batch_fit()
+    bench_map_fits()
+    bench_initial_guess()
@@ -0,0 +1,85 @@
+"""
+Benchmarks of the readers of ramanpy.
+Run from the root of the repository:
+
+    python benchmarks/bench_readers.py
+
+"""
+import tempfile
+import timeit
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ramanpy import RamanFit, XRDFit
+
+
+def write_raman_file(filename, n_points=1024):
+    x = np.linspace(100, 3500, n_points)
+    y = 100 / (1 + ((x - 1350) / 30) ** 2) + 80 / (1 + ((x - 1590) / 25) ** 2) + np.random.rand(n_points)
+    with open(filename, 'w', encoding='utf-8') as fh:
+        fh.write('#Acq. time (s)=\t10\n#Accumulations=\t2\n')
+        fh.write('#X (µm)=\t12.5\n#Y (µm)=\t-3\n#Z (µm)=\t0\n')
+        for x_value, y_value in zip(x, y):
+            fh.write(f'{x_value:.4f}\t{y_value:.4f}\n')
+
+
+def write_xrd_file(filename, n_points=20000):
+    angle = np.linspace(5, 90, n_points)
+    intensity = 1000 / (1 + ((angle - 26) / 0.5) ** 2) + 50 * np.random.rand(n_points)
+    with open(filename, 'w') as fh:
+        fh.write('Scan of a carbon sample\n')
+        for angle_value, intensity_value in zip(angle, intensity):
+            fh.write(f'{angle_value:.4f} {intensity_value:.2f} {np.sqrt(intensity_value):.3f}\n')
+
+
+def report(name, seconds, number, reference=None):
+    per_call = seconds / number * 1e3
+    line = f'{name:<40s} {per_call:8.3f} ms/file'
+    if reference is not None:
+        line += f'   x{reference / seconds:5.1f}'
+    print(line)
+
+
+def bench_raman_readers(number=200):
+    with tempfile.TemporaryDirectory() as folder:
+        filename = str(Path(folder) / 'spectrum.txt')
+        write_raman_file(filename)
+        cache_dir = Path(folder) / 'cache'
+
+        print(f'Raman reader, {number} reads of a 1024 points file')
+        reference = timeit.timeit(lambda: RamanFit.read_data_raman(filename, engine='pandas'), number=number)
+        report('read_csv + read_header (pandas)', reference, number)
+
+        seconds = timeit.timeit(lambda: RamanFit.read_data_raman(filename), number=number)
+        report('single pass parser (numpy)', seconds, number, reference)
+
+        RamanFit.read_data_raman(filename, cache_dir=cache_dir)  # fill the cache
+        seconds = timeit.timeit(lambda: RamanFit.read_data_raman(filename, cache_dir=cache_dir), number=number)
+        report('memory-mapped cache', seconds, number, reference)
+
+
+def bench_xrd_readers(number=50):
+    with tempfile.TemporaryDirectory() as folder:
+        filename = str(Path(folder) / 'scan.xye')
+        write_xrd_file(filename)
+
+        print(f'XRD reader, {number} reads of a 20000 steps .xye file')
+        def read_pandas():
+            return pd.read_csv(filename, skiprows=1, comment='#', sep=r'\s+', index_col=False,
+                               names=['angle', 'intensity', 'error']).values
+
+        reference = timeit.timeit(read_pandas, number=number)
+        report('read_csv whitespace (pandas)', reference, number)
+
+        seconds = timeit.timeit(lambda: XRDFit.read_arrays_xrd(filename), number=number)
+        report('read_arrays_xrd float64 (numpy)', seconds, number, reference)
+
+        seconds = timeit.timeit(lambda: XRDFit.read_arrays_xrd(filename, dtype=np.float32), number=number)
+        report('read_arrays_xrd float32 (numpy)', seconds, number, reference)
+
+
+if __name__ == '__main__':
+    bench_raman_readers()
+    bench_xrd_readers()
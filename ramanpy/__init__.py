@@ -4,5 +4,11 @@ __version__ = get_versions()['version']
 del get_versions
 
 from .specific_fit_classes import *
+from .batch import SpectrumBatch
+from .loaders import load_directory
+from .manifest import Manifest
+from .pipeline import Pipeline
+from .spatial import SpatialIndex
+from .store import CampaignStore
 from ramanpy import runners
 from .process_results_raman import *
\ No newline at end of file
@@ -0,0 +1,196 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import tarfile
+import threading
+import zipfile
+
+# separator between an archive and one of its members: 'campaign.tar.gz::run1/spectrum_1.txt'
+ARCHIVE_SEPARATOR = '::'
+
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+# open tar files, one per thread, so that reading many members does not scan the archive again each time
+_open_tars = threading.local()
+
+
+def split_archive_path(filename):
+    """
+    Splits the name of a member of an archive.
+
+    :param filename: str name of a file, or archive::member
+    :return: tuple (path of the file on disk, name of the member or None)
+    Example:
+    >>> split_archive_path('campaign.zip::run1/spectrum.txt')
+    ('campaign.zip', 'run1/spectrum.txt')
+
+    """
+    filename = str(filename)
+    if ARCHIVE_SEPARATOR in filename:
+        archive, member = filename.split(ARCHIVE_SEPARATOR, 1)
+        return archive, member
+    return filename, None
+
+
+def is_archive(filename):
+    """
+    :param filename: str name of a file
+    :return: bool True if the file is a zip or tar archive (compressed or not)
+    """
+    return str(filename).lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def is_plain_file(filename):
+    """
+    :param filename: str name of a file
+    :return: bool True if the file is neither compressed nor a member of an archive
+    """
+    archive, member = split_archive_path(filename)
+    return member is None and os.path.splitext(archive)[1].lower() not in COMPRESSED_OPENERS
+
+
+def list_archive_members(archive):
+    """
+    Lists the regular files of an archive, with names that can be given to the readers.
+
+    :param archive: str name of the zip or tar archive
+    :return: sorted list of 'archive::member'
+    """
+    if str(archive).lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as zf:
+            members = [info.filename for info in zf.infolist() if not info.is_dir()]
+    else:
+        with tarfile.open(archive) as tf:
+            members = [info.name for info in tf.getmembers() if info.isfile()]
+    return sorted(f'{archive}{ARCHIVE_SEPARATOR}{member}' for member in members)
+
+
+def open_binary(filename):
+    """
+    Opens a file for reading in binary mode, whether it is a plain file, a gzip/bz2/xz compressed file,
+    or a member of a zip/tar archive (archive::member). Nothing is extracted to disk.
+
+    :param filename: str name of the file
+    :return: binary file handle
+    """
+    archive, member = split_archive_path(filename)
+    if member is None:
+        opener = COMPRESSED_OPENERS.get(os.path.splitext(archive)[1].lower(), open)
+        return opener(archive, 'rb')
+
+    if archive.lower().endswith('.zip'):
+        zf = zipfile.ZipFile(archive)
+        fh = zf.open(member)
+        zf.close()  # the archive stays open until the member is closed
+    else:
+        fh = _open_tar(archive).extractfile(member)
+        if fh is None:
+            raise FileNotFoundError(f'{member} is not a regular file of {archive}')
+
+    # members can also be compressed one by one
+    suffix = os.path.splitext(member)[1].lower()
+    if suffix in COMPRESSED_OPENERS:
+        fh = COMPRESSED_OPENERS[suffix](fh, 'rb')
+    return fh
+
+
+def open_text(filename):
+    """
+    Same as open_binary but in text mode. Undecodable characters (e.g. in the headers) are ignored.
+
+    :param filename: str name of the file
+    :return: text file handle
+    """
+    if is_plain_file(filename):
+        return open(filename, 'r', errors='ignore')
+    return io.TextIOWrapper(open_binary(filename), errors='ignore')
+
+
+def source_path(filename):
+    """
+    :param filename: str name of a file, or archive::member
+    :return: str path of the file on disk (the archive for a member)
+    """
+    return split_archive_path(filename)[0]
+
+
+def output_name(filename):
+    """
+    Name used for the outputs of a spectrum (plots, _params.txt): the file without its extension and compression.
+    The members of an archive go in a folder named as the archive.
+
+    :param filename: str name of a file, or archive::member
+    :return: str
+    Example:
+    >>> output_name('data/campaign.tar.gz::run1/spectrum.txt.gz')
+    'data/campaign/run1/spectrum'
+
+    """
+    archive, member = split_archive_path(filename)
+    if member is None:
+        return _strip_extension(archive)
+
+    for suffix in ARCHIVE_SUFFIXES:
+        if archive.lower().endswith(suffix):
+            archive = archive[:-len(suffix)]
+            break
+    return os.path.join(archive, _strip_extension(member))
+
+
+def close_archives():
+    """
+    Closes the tar archives kept open by the current thread.
+    """
+    for _, tf in getattr(_open_tars, 'archives', {}).values():
+        tf.close()
+    _open_tars.archives = {}
+
+
+def file_extension(filename):
+    """
+    Extension of a file (or of a member of an archive), without the compression suffix.
+
+    :param filename: str name of a file, or archive::member
+    :return: str in lower case, e.g. '.xye'
+    Example:
+    >>> file_extension('data/scans.zip::run1/scan.XYE.gz')
+    '.xye'
+
+    """
+    name = split_archive_path(filename)[1] or filename
+    return os.path.splitext(_strip_compression(name))[1].lower()
+
+
+def _strip_compression(filename):
+    """
+    removes the compression suffix of a file name, if any.
+    """
+    stem, suffix = os.path.splitext(filename)
+    return stem if suffix.lower() in COMPRESSED_OPENERS else filename
+
+
+def _strip_extension(filename):
+    """
+    removes the compression suffix (if any) and the extension of a file name.
+    """
+    return os.path.splitext(_strip_compression(filename))[0]
+
+
+def _open_tar(archive):
+    """
+    tar file of the current thread for an archive, opened on first use. If the archive has changed since it
+    was opened, the old handle is closed and the archive is opened again.
+    """
+    if not hasattr(_open_tars, 'archives'):
+        _open_tars.archives = {}
+    path = os.path.abspath(archive)
+    mtime = os.stat(archive).st_mtime_ns
+    opened = _open_tars.archives.get(path)
+    if opened is None or opened[0] != mtime:
+        if opened is not None:
+            opened[1].close()
+        _open_tars.archives[path] = (mtime, tarfile.open(archive))
+    return _open_tars.archives[path][1]
@@ -0,0 +1,555 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .archives import output_name
+from .batch_fit import BatchFitter
+from .generic_fit_class import GenericFit
+from .preprocessing import (baseline_settings, common_grid, decimation_weights, despike_diff, despike_neighbours,
+                            despike_settings, initial_guess_settings, normalization_mode, remove_baseline,
+                            resample_settings, resample_spectra, roi_mask)
+from .readers import iter_column_blocks, iter_stacked_spectra
+from .spatial import SpatialIndex
+from .specific_fit_classes import RamanFit
+from .tools import positions_from_header
+
+
+class SpectrumBatch:
+    """
+    A container for many spectra sharing the same x axis, typically a Raman map.
+    Instead of one RamanFit per spectrum, the intensities are stored in a single contiguous 2D array,
+    and the preprocessing steps of GenericFit are applied to all of them at once.
+
+    Attributes
+    ----------
+    x : 1D array
+        shared x axis (wavenumber or angle), shape (n_points,)
+    y : 2D array
+        intensities, shape (n_spectra, n_points)
+    filenames : list
+        names of the spectra, used as base name for the outputs
+    metadata : dict
+        per spectrum metadata, each value is an array of length n_spectra. The positions X, Y, Z (µm)
+        are read from the headers when available.
+    headers : list
+        headers of the files (dicts from the readers), None if not available
+    peaks : list
+        list of peaks to be fit
+    other_data : configObj
+        other data, as in GenericFit (window_size, poly_order, poly_type...)
+    folder_out: Path
+        folder to save the reports from the fit
+    fit_class: class
+        GenericFit subclass used to fit each spectrum (RamanFit or XRDFit), gives the default tolerances.
+    failures: dict
+        files that could not be loaded and the reason (see loaders.load_directory)
+
+    """
+
+    def __init__(self, x, y, filenames=None, metadata=None, peaks=None, other_data=None, folder_out=None,
+                 fit_class=RamanFit, headers=None, dtype=None, copy=True):
+        """
+
+        :param x: 1D array with the shared x axis
+        :param y: 2D array (n_spectra, n_points) with the intensities
+        :param filenames: list of names of the spectra. If not given, spectrum_0, spectrum_1...
+        :param metadata: dict of arrays of length n_spectra
+        :param peaks: list of peaks to be retrieved
+        :param other_data: if needed
+        :param folder_out: str folder where report will be saved.
+        :param fit_class: GenericFit subclass used for the fits
+        :param headers: list of headers of the spectra
+        :param dtype: precision of the intensities (np.float32 halves the memory of large maps), as given if None.
+                      The preprocessing keeps this precision, only the fits are computed in float64.
+        :param copy: bool, copy y so that the preprocessing done in place never modifies the array of the caller.
+                     The alternate constructors pass False for the arrays they have just read.
+        """
+        self.x = np.asarray(x)
+        self.y = np.atleast_2d(np.array(y, dtype=dtype) if copy else GenericFit._as_dtype(y, dtype))
+        if self.y.shape[1] != self.x.size:
+            raise ValueError(f'x has {self.x.size} points but the spectra have {self.y.shape[1]}')
+
+        if filenames is None:
+            self.filenames = [f'spectrum_{i}' for i in range(len(self))]
+        else:
+            self.filenames = list(filenames)
+
+        if metadata is None:
+            self.metadata = {}
+        else:
+            self.metadata = {key: np.asarray(value) for key, value in metadata.items()}
+        self.headers = None if headers is None else list(headers)
+
+        self.peaks = [] if peaks is None else peaks
+        self.fit_class = fit_class
+
+        if other_data is not None:
+            self.other_data = other_data
+        else:  # same defaults as GenericFit
+            self.other_data = dict()
+            self.other_data['_normalize_data'] = True
+            self.other_data['bkg'] = 'quadratic'
+
+        self.folder_out = Path('out_report') if folder_out is None else Path(folder_out)
+        self.baseline = None  # removed from y by apply_baseline, if used
+        self.spikes = None  # (spectra, points) indices of the points replaced by apply_despike
+        self.decimation = None  # points of x kept in the fits, set by apply_decimation
+        self.failures = {}
+        self._spatial_index = None
+
+    def __len__(self):
+        return self.y.shape[0]
+
+    @classmethod
+    def from_files(cls, filenames, fit_class=RamanFit, cache_dir=None, dtype=None, **kwargs):
+        """
+        Alternate constructor reading the spectra from files. All the files must have the same x axis,
+        unless grid is given in kwargs (see from_spectra).
+
+        :param filenames: list of str with the files
+        :param fit_class: RamanFit or XRDFit, its read_xy is used to read the files
+        :param cache_dir: folder of the binary cache (see SpectrumCache)
+        :param dtype: precision of the intensities, e.g. np.float32
+        :param kwargs: passed to from_spectra (grid, kind) and to the constructor (peaks, other_data, folder_out)
+        :return: SpectrumBatch
+        """
+        spectra = [fit_class.read_xy(filename, cache_dir=cache_dir, dtype=dtype) for filename in filenames]
+        return cls.from_spectra(spectra, [output_name(filename) for filename in filenames],
+                                fit_class=fit_class, dtype=dtype, **kwargs)
+
+    @classmethod
+    def from_spectra(cls, spectra, filenames=None, dtype=None, grid=None, kind='linear', **kwargs):
+        """
+        Alternate constructor from a list of (x, y, header) tuples, as returned by read_xy.
+        Without grid, all the spectra must have the same x axis. Otherwise they are resampled
+        onto a common grid (see preprocessing.resample_spectra).
+
+        :param spectra: list of tuples (x, y, header)
+        :param filenames: list of names of the spectra
+        :param dtype: precision of the intensities, the common one of the spectra if None
+        :param grid: None, 'auto' to resample onto the range shared by all the spectra (only if their x axes
+                     differ, see preprocessing.common_grid), or 1D array with the x axis of the batch
+        :param kind: interpolation used to resample, 'linear' or 'cubic'
+        :param kwargs: passed to the constructor
+        :return: SpectrumBatch
+        """
+        if not spectra:
+            raise ValueError('No spectra to build the batch')
+
+        x = np.asarray(spectra[0][0])
+        if dtype is None:
+            dtype = np.result_type(*[spectrum[1] for spectrum in spectra])
+        same_axis = all(np.array_equal(spectrum[0], x) for spectrum in spectra)
+        if isinstance(grid, str) and grid == 'auto':
+            grid = None if same_axis else common_grid([spectrum[0] for spectrum in spectra])
+        elif grid is None and not same_axis:
+            i = next(i for i, spectrum in enumerate(spectra) if not np.array_equal(spectrum[0], x))
+            name = filenames[i] if filenames is not None else i
+            raise ValueError(f'Spectrum {name} does not share the x axis of the first spectrum, '
+                             f'use grid to resample the spectra')
+
+        if grid is None:
+            y = np.empty((len(spectra), x.size), dtype=dtype)
+            for i, spectrum in enumerate(spectra):
+                y[i] = spectrum[1]
+        else:
+            x = np.asarray(grid)
+            y = resample_spectra([spectrum[0] for spectrum in spectra], [spectrum[1] for spectrum in spectra],
+                                 x, kind=kind).astype(dtype, copy=False)
+
+        positions = np.array([positions_from_header(spectrum[2]) for spectrum in spectra]).reshape(-1, 3)
+        metadata = {'X': positions[:, 0], 'Y': positions[:, 1], 'Z': positions[:, 2]}
+        headers = [spectrum[2] for spectrum in spectra]
+        return cls(x, y, filenames=filenames, metadata=metadata, headers=headers, copy=False, **kwargs)
+
+    @classmethod
+    def iter_from_export(cls, filename, layout='columns', block_size=64, **kwargs):
+        """
+        Generator of batches from a multi-spectrum export file, so that a large export can be processed
+        (smoothing, normalization, fits) block by block without being fully loaded.
+
+        :param filename: str name of the export file
+        :param layout: 'columns' for one x column followed by N intensity columns (see readers.iter_column_blocks),
+                       'stacked' for consecutive two column blocks (see readers.iter_stacked_spectra).
+        :param block_size: int maximum number of spectra per batch
+        :param kwargs: passed to the constructor (peaks, other_data, folder_out, fit_class)
+        :return: generator of SpectrumBatch
+        """
+        stem = output_name(filename)
+        if layout == 'columns':
+            for start, x, y in iter_column_blocks(filename, block_size=block_size):
+                names = [f'{stem}_{start + i}' for i in range(y.shape[0])]
+                yield cls(x, y, filenames=names, copy=False, **kwargs)
+        elif layout == 'stacked':
+            spectra = []
+            names = []
+            for index, (header, x, y) in enumerate(iter_stacked_spectra(filename)):
+                # a new batch starts when it is full or when the x axis changes
+                if spectra and (len(spectra) == block_size or not np.array_equal(x, spectra[0][0])):
+                    yield cls.from_spectra(spectra, filenames=names, **kwargs)
+                    spectra = []
+                    names = []
+                spectra.append((x, y, header))
+                names.append(f'{stem}_{index}')
+            if spectra:
+                yield cls.from_spectra(spectra, filenames=names, **kwargs)
+        else:
+            raise ValueError(f'Unknown layout {layout}, use columns or stacked')
+
+    @property
+    def positions(self):
+        """
+        positions of the measurements, array of shape (n_spectra, 3) with X, Y, Z in µm (nan if unknown)
+        """
+        return np.column_stack([self.metadata.get(axis, np.full(len(self), np.nan)) for axis in ('X', 'Y', 'Z')])
+
+    def spatial_index(self, n_dims=2):
+        """
+        KD-tree over the positions of the spectra, built on first use.
+
+        :param n_dims: int 2 for X, Y, 3 to include Z
+        :return: SpatialIndex, its queries give indices for subset
+        """
+        if self._spatial_index is None or self._spatial_index.positions.shape[1] != n_dims:
+            self._spatial_index = SpatialIndex(self.positions, labels=self.filenames, n_dims=n_dims)
+        return self._spatial_index
+
+    def subset(self, indices):
+        """
+        New batch with only some of the spectra. The x axis is shared, not copied.
+
+        :param indices: array like of indices or boolean mask
+        :return: SpectrumBatch
+        """
+        indices = np.arange(len(self))[indices]
+        return SpectrumBatch(self.x, self.y[indices], filenames=[self.filenames[i] for i in indices],
+                             metadata={key: value[indices] for key, value in self.metadata.items()},
+                             peaks=self.peaks, other_data=self.other_data, folder_out=self.folder_out,
+                             fit_class=self.fit_class,
+                             headers=None if self.headers is None else [self.headers[i] for i in indices],
+                             copy=False)
+
+    def apply_smoothing(self, dtype=None):
+        """
+        performs smoothing of all the spectra using the _sav_gol filter of GenericFit, in a single vectorized call.
+        The method (savgol, fft or auto) can be chosen with smoothing_method in other_data.
+        :param dtype: precision of the result (e.g. np.float32), the one of y if None.
+        """
+        win_size = GenericFit._try_get_other_data(self.other_data, 'window_size', default_value=(15,))[0]
+        poly_order = GenericFit._try_get_other_data(self.other_data, 'poly_order', default_value=(3,))[0]
+        method = self.other_data.get('smoothing_method', 'auto')
+
+        self.y = GenericFit._sav_gol(GenericFit._as_dtype(self.y, dtype), win_size=win_size, poly_order=poly_order,
+                                     method=method)
+
+    def resample(self, grid=None, step=None, kind='linear'):
+        """
+        Interpolates all the spectra onto a new x axis, e.g. a coarser one or the axis of another batch.
+
+        :param grid: 1D array with the new x axis. If None, a regular grid over the current range with the given
+                     step.
+        :param step: float step of the grid when grid is None
+        :param kind: 'linear' or 'cubic'
+        """
+        if grid is None:
+            grid = common_grid([self.x], step=step)
+        self.y = resample_spectra(np.asarray(self.x), self.y, grid, kind=kind).astype(self.y.dtype, copy=False)
+        self.x = np.asarray(grid)
+        self.baseline = None
+        self.spikes = None
+
+    def apply_resample(self, dtype=None):
+        """
+        resamples all the spectra onto a regular grid with resample_step and resample_kind given in other_data,
+        see resample. Nothing is done without resample_step.
+        :param dtype: precision of the result (e.g. np.float32), the one of y if None.
+        """
+        self.y = GenericFit._as_dtype(self.y, dtype)
+        settings = resample_settings(self.other_data)
+        if settings is not None:
+            self.resample(step=settings['step'], kind=settings['kind'])
+
+    def apply_roi(self):
+        """
+        keeps only the points of x close to the peaks, for all the spectra, with the windows of the fit class
+        (see GenericFit.roi_windows). The fits then evaluate the model on less points.
+        """
+        windows = self.get_fit(0).roi_windows()
+        if windows is None:
+            return
+
+        inside = roi_mask(self.x, windows)
+        self.x = self.x[inside]
+        self.y = self.y[:, inside]
+        if self.baseline is not None:
+            self.baseline = self.baseline[:, inside]
+        if self.decimation is not None:
+            self.decimation = self.decimation[inside]
+        self.spikes = None
+
+    def apply_decimation(self):
+        """
+        selects the points used in the fits of all the spectra, with the settings of GenericFit.decimation_mask:
+        the points with a large curvature in any spectrum and the points near the peaks. The arrays of the batch
+        are not modified, each fit is decimated (and evaluated on the full x for the plots).
+        """
+        fit = self.get_fit(0)
+        fit.y = self.y  # curvature of all the spectra
+        self.decimation = fit.decimation_mask()
+
+    def apply_despike(self, dtype=None):
+        """
+        removes the cosmic-ray spikes of all the spectra at once, with the method selected with despike in
+        other_data: diff (each spectrum alone, see preprocessing.despike_diff) or neighbours (comparison with the
+        spatial neighbours in the map, see preprocessing.despike_neighbours). To be done before the smoothing.
+        The replaced points are kept in self.spikes, see spike_table.
+        :param dtype: precision of the result (e.g. np.float32), the one of y if None.
+        """
+        method, kwargs = despike_settings(self.other_data)
+        y = GenericFit._as_dtype(self.y, dtype)
+        if method == 'diff':
+            y, spikes = despike_diff(y, **kwargs)
+        elif method == 'neighbours':
+            neighbours = self.spatial_index().neighbours(kwargs.pop('n_neighbours'))
+            y, spikes = despike_neighbours(y, neighbours, **kwargs)
+        else:
+            self.y = y
+            return
+
+        self.y = y
+        self.spikes = np.nonzero(spikes)
+
+    def spike_table(self):
+        """
+        Report of the points replaced by apply_despike.
+
+        :return: DataFrame with one row per point: filename, spectrum (index in the batch), point (index in x), x
+        """
+        spectra, points = self.spikes if self.spikes is not None else (np.array([], int), np.array([], int))
+        return pd.DataFrame({'filename': [self.filenames[i] for i in spectra], 'spectrum': spectra,
+                             'point': points, 'x': self.x[points]})
+
+    def apply_baseline(self, dtype=None):
+        """
+        removes the baseline of all the spectra at once, with the method selected with baseline in other_data
+        (none, als or snip) as for GenericFit.
+        :param dtype: precision of the result (e.g. np.float32), the one of y if None.
+        """
+        method, kwargs = baseline_settings(self.other_data)
+        if method is None:
+            self.y = GenericFit._as_dtype(self.y, dtype)
+            return
+
+        y = GenericFit._as_dtype(self.y, dtype)
+        self.y, self.baseline = remove_baseline(y, method=method, out=GenericFit._owned_or_none(y), **kwargs)
+
+    def apply_normalize(self, dtype=None):
+        """
+        performs the normalization of all the spectra, selected with _normalize_data in other_data as for
+        GenericFit.
+        :param dtype: precision of the result (e.g. np.float32), the one of y if None.
+        """
+        mode = normalization_mode(self.other_data)
+        if mode is None:
+            self.y = GenericFit._as_dtype(self.y, dtype)
+            return
+
+        self.y = GenericFit._normalize_data(GenericFit._as_dtype(self.y, dtype), mode=mode, x=self.x,
+                                            in_place=True)
+
+    def get_fit(self, index):
+        """
+        Fit object (of fit_class) for one spectrum of the batch, ready to set tolerances and build the model.
+        The arrays are views on the batch, nothing is read again.
+
+        :param index: int index of the spectrum
+        :return: fit object
+        """
+        return self.fit_class.from_arrays(self.x, self.y[index], peaks=self.peaks, other_data=self.other_data,
+                                          folder_out=self.folder_out, filename=self.filenames[index], copy=False)
+
+    def fit_spectrum(self, index, initial=None):
+        """
+        Fits one spectrum of the batch with the same steps as the runners (without smoothing and normalization,
+        which are applied to the whole batch). The decimation of the batch, if any, is applied to the fit.
+
+        :param index: int index of the spectrum
+        :param initial: dict {name of a parameter: starting value}, or None for the values of set_tolerances_fit
+        :return: fit object with the result
+        """
+        fit = self.get_fit(index)
+        fit.set_tolerances_fit()
+        if self.decimation is not None:
+            fit.apply_decimation(self.decimation)
+        fit.apply_roi()
+        fit.build_fitting_model_peaks()
+        if initial:
+            fit.set_initial_values(initial)
+        fit.run_fit_model()
+        return fit
+
+    def run_fits(self, indices=None, save_results=False, plot_results=False):
+        """
+        Fits the spectra of the batch one after the other.
+
+        :param indices: indices of the spectra to fit, all of them if None
+        :param save_results: bool, save the report and params file of each fit
+        :param plot_results: bool, save the plot of each fit
+        :return: pandas dataframe with one row per spectrum, with the value and the stderr of each parameter
+        """
+        if indices is None:
+            indices = range(len(self))
+
+        rows = {}
+        for index in indices:
+            fit = self.fit_spectrum(index)
+            if plot_results:
+                fit.plot_results()
+            if save_results:
+                fit.save_results()
+
+            rows[self.filenames[index]] = self._result_row(fit)
+
+        return pd.DataFrame.from_dict(rows, orient='index')
+
+    def run_map_fits(self, order='hilbert', neighbours=8, coarse_step=None, save_results=False,
+                     plot_results=False):
+        """
+        Fits the spectra of a map one after the other, each one starting from the results of its neighbours
+        instead of the global defaults of set_tolerances_fit: neighbouring spectra have almost the same peaks,
+        so the fits need less iterations.
+
+        The spectra are visited in the order given (see SpatialIndex.visit_order), and the starting values of each
+        one are the mean of the fitted parameters of its already fitted nearest neighbours. The bounds do not
+        change. With coarse_step, the spectra of every coarse_step-th row and column are fitted first, and the
+        starting values of the others are interpolated (inverse distance) from the closest coarse fits when none
+        of their neighbours is fitted yet.
+
+        :param order: str raster, snake or hilbert
+        :param neighbours: int number of nearest neighbours considered for the starting values
+        :param coarse_step: int step of the coarse grid fitted first, None to fit all the spectra in one pass
+        :param save_results: bool, save the report and params file of each fit
+        :param plot_results: bool, save the plot of each fit
+        :return: pandas dataframe as run_fits, in the order of the batch, with the number of evaluations (nfev)
+        """
+        index = self.spatial_index()
+        path = index.visit_order(order)
+        near = index.neighbours(neighbours)
+        passes = [path]
+        if coarse_step is not None and coarse_step > 1:
+            row, column = index.grid()
+            coarse = (row >= 0) & (row % coarse_step == 0) & (column % coarse_step == 0)
+            passes = [path[coarse[path]], path[~coarse[path]]]
+
+        fitted = {}  # index of the spectrum: fitted values of the parameters
+        rows = {}
+        guesses = {}  # starting values interpolated from the coarse grid
+        for i_pass, visit in enumerate(passes):
+            if i_pass == 1:
+                guesses = self._interpolate_values(fitted, visit, neighbours=min(4, neighbours))
+            for spectrum in visit:
+                done = [j for j in near[spectrum] if j in fitted]
+                if done:
+                    initial = {name: np.mean([fitted[j][name] for j in done]) for name in fitted[done[0]]}
+                else:
+                    initial = guesses.get(spectrum)
+                fit = self.fit_spectrum(spectrum, initial=initial)
+                fitted[spectrum] = {name: param.value for name, param in fit.result.params.items()
+                                    if param.vary}
+                if plot_results:
+                    fit.plot_results()
+                if save_results:
+                    fit.save_results()
+                rows[spectrum] = dict(self._result_row(fit), nfev=fit.result.nfev)
+
+        return pd.DataFrame.from_dict({self.filenames[i]: rows[i] for i in range(len(self))}, orient='index')
+
+    def _interpolate_values(self, fitted, indices, neighbours=4):
+        """
+        starting values of some spectra, interpolated by inverse distance from the fitted ones.
+
+        :param fitted: dict {index: dict of fitted values}
+        :param indices: indices of the spectra to interpolate
+        :param neighbours: int number of fitted spectra used for each one
+        :return: dict {index: dict of values}
+        """
+        done = np.array([i for i in fitted if np.all(np.isfinite(self.positions[i, :2]))], dtype=int)
+        if done.size == 0:
+            return {}
+        names = list(fitted[done[0]])
+        values = np.array([[fitted[i][name] for name in names] for i in done])
+        tree = SpatialIndex(self.positions[done])
+
+        guesses = {}
+        for i in indices:
+            if not np.all(np.isfinite(self.positions[i, :2])):
+                continue
+            found, distances = tree.nearest(self.positions[i, :2], k=min(neighbours, done.size),
+                                            exclude_self=False)
+            weights = 1 / np.maximum(distances, 1e-12)
+            guesses[i] = dict(zip(names, weights @ values[found] / weights.sum()))
+        return guesses
+
+    @staticmethod
+    def _result_row(fit):
+        """
+        value and stderr of each parameter of a fit, a row of the tables of run_fits.
+        """
+        row = {}
+        for key, param in fit.result.params.items():
+            row[key] = param.value
+            row[key + '_stderr'] = param.stderr
+        return row
+
+    def batch_fitter(self):
+        """
+        BatchFitter for the spectra of the batch, with the model, initial values and bounds of get_fit(0)
+        (set_tolerances_fit and build_fitting_model_peaks), on the points kept by apply_decimation and by the
+        roi of other_data, as in fit_spectrum.
+
+        :return: BatchFitter
+        """
+        fit = self.get_fit(0)
+        fit.set_tolerances_fit()
+        fit.build_fitting_model_peaks()
+        keep, weights = self._fitted_points(fit)
+        return BatchFitter(self.x[keep], fit.model, fit.params, weights=weights)
+
+    def _fitted_points(self, fit):
+        """
+        points of x used by the fits, selected as in fit_spectrum: the decimation, then the roi.
+
+        :param fit: fit object of the batch, after set_tolerances_fit
+        :return: boolean array over x, and the weights of the kept points (None without decimation)
+        """
+        keep = np.ones(self.x.size, dtype=bool) if self.decimation is None else self.decimation.copy()
+        weights = None if self.decimation is None else decimation_weights(self.decimation)
+        windows = fit.roi_windows()
+        if windows is not None:
+            inside = roi_mask(self.x[keep], windows)
+            keep[np.flatnonzero(keep)[~inside]] = False
+            weights = None if weights is None else weights[inside]
+        return keep, weights
+
+    def run_batch_fits(self, indices=None, initial=None, max_iterations=200, chunk_size=128):
+        """
+        Fits the spectra of the batch all at once with a BatchFitter (Levenberg-Marquardt on stacked parameters),
+        instead of one lmfit fit after the other as run_fits. Only for Lorentzians and polynomial backgrounds.
+
+        :param indices: indices of the spectra to fit, all of them if None
+        :param initial: dict {name of a parameter: array with one starting value per fitted spectrum}, or None for
+                        the values of set_tolerances_fit (or the ones estimated from the data with initial_guess)
+        :param max_iterations: int, maximum number of iterations of each spectrum
+        :param chunk_size: int, number of spectra fitted together
+        :return: pandas dataframe with one row per spectrum, the columns of run_fits and nfev, success
+        """
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        fitter = self.batch_fitter()
+        fit = self.get_fit(0)
+        fit.set_tolerances_fit()
+        if initial_guess_settings(self.other_data)[0] is not None:  # estimated for all the spectra at once
+            initial = dict(fit.guess_initial_values(self.y[indices]), **(initial or {}))
+        y = self.y[indices][:, self._fitted_points(fit)[0]]
+        results = fitter.fit(y, initial=initial, max_iterations=max_iterations, chunk_size=chunk_size)
+        return fitter.table(results, index=[self.filenames[i] for i in indices])
@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+
+from .models import LORENTZIAN_PARAMS, TINY, ModelJacobian, lorentzian_derivatives
+
+
+class BatchFitter:
+    """
+    Levenberg-Marquardt fit of the same model (Lorentzians plus a polynomial background, as built by
+    GenericFit.build_fitting_model_peaks) to many spectra at once.
+
+    The parameters of K spectra are stacked in a (K, P) array. The Jacobian of the whole batch is block diagonal,
+    one (n_points, P) block per spectrum, so only the blocks are computed, with the analytic derivatives of
+    ModelJacobian, and the K normal equations (J^T J + lambda D) delta = J^T r are solved together with the batched
+    linear algebra of numpy. Each spectrum has its own damping lambda, and stops as soon as it converges: the
+    following iterations only compute the spectra still running.
+
+    The bounds of the parameters are applied by projecting each step into them (lmfit transforms the bounded
+    parameters instead), so a parameter at a bound can end slightly differently than with lmfit.
+    The standard errors are computed as lmfit does, from the covariance scaled by the reduced chi-square.
+
+    Attributes
+    ----------
+    x: 1D array
+        x values of the spectra
+    names: list
+        names of the fitted parameters (the background, then amplitude, center, sigma of each peak)
+    params: lmfit Parameters
+        initial values, bounds and vary of the parameters, and the order of the columns of the results
+    """
+
+    def __init__(self, x, model, params, weights=None):
+        """
+
+        :param x: 1D array with the shared x axis
+        :param model: lmfit model built by GenericFit.build_fitting_model_peaks
+        :param params: lmfit Parameters of the model
+        :param weights: 1D array, weights of the residual of all the spectra (e.g. decimation_weights), or None
+        """
+        jacobian = ModelJacobian.from_model(model, params)
+        if jacobian is None:
+            raise ValueError('Only sums of Lorentzians and polynomial backgrounds can be fitted in batch')
+
+        self.x = np.asarray(x, dtype=np.float64)
+        self.params = params
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+        self.peak_prefixes = jacobian.peak_prefixes
+        self.bkg_powers = jacobian.bkg_powers
+        self.names = list(self.bkg_powers) + [prefix + name for prefix in self.peak_prefixes
+                                               for name in LORENTZIAN_PARAMS]
+
+        self.vary = np.array([params[name].vary for name in self.names])
+        self.lower = np.array([params[name].min for name in self.names], dtype=np.float64)
+        self.upper = np.array([params[name].max for name in self.names], dtype=np.float64)
+        self._powers = np.array(list(self.bkg_powers.values()), dtype=float)
+        self._bkg_basis = self.x[:, np.newaxis] ** self._powers  # (n_points, B)
+
+    def initial_values(self, n_spectra, initial=None):
+        """
+        starting values of the parameters of each spectrum.
+
+        :param n_spectra: int number of spectra
+        :param initial: dict {name of a parameter: array of n_spectra values} replacing the values of params
+                        (except where they are nan), or None
+        :return: 2D array (n_spectra, P), within the bounds
+        """
+        values = np.tile([self.params[name].value for name in self.names], (n_spectra, 1)).astype(np.float64)
+        for name, value in (initial or {}).items():
+            if name in self.names:
+                column = values[:, self.names.index(name)]
+                value = np.broadcast_to(np.asarray(value, dtype=np.float64), column.shape)
+                column[np.isfinite(value)] = value[np.isfinite(value)]  # nan: no guess for this spectrum
+        return np.clip(values, self.lower, self.upper)
+
+    def evaluate(self, values, jacobian=False):
+        """
+        Evaluates the model for a stack of parameters.
+
+        :param values: 2D array (K, P)
+        :param jacobian: bool, also return the derivatives
+        :return: 2D array (K, n_points) of model values, and if jacobian, 3D array (K, n_points, P)
+        """
+        n_bkg = self._powers.size
+        peaks = values[:, n_bkg:].reshape(len(values), -1, len(LORENTZIAN_PARAMS))
+        derivatives = lorentzian_derivatives(self.x, peaks[..., 0], peaks[..., 1], peaks[..., 2])
+
+        model = np.einsum('knj,kj->kn', derivatives[0], peaks[..., 0])  # the Lorentzians are A * d/dA
+        model += values[:, :n_bkg] @ self._bkg_basis.T
+        if not jacobian:
+            return model
+
+        k, n = model.shape
+        jac = np.empty((k, n, len(self.names)))
+        jac[:, :, :n_bkg] = self._bkg_basis
+        jac[:, :, n_bkg:] = np.stack(derivatives, axis=-1).reshape(k, n, -1)  # amplitude, center, sigma per peak
+        return model, jac
+
+    def fit(self, y, initial=None, max_iterations=200, ftol=1.5e-8, xtol=1.5e-8, chunk_size=128):
+        """
+        Fits all the spectra.
+
+        :param y: 2D array (n_spectra, n_points) of intensities
+        :param initial: dict of starting values per spectrum, see initial_values
+        :param max_iterations: int, maximum number of iterations of each spectrum
+        :param ftol: float, relative reduction of the sum of squares below which a spectrum has converged
+        :param xtol: float, relative step below which a spectrum has converged
+        :param chunk_size: int, spectra fitted together. The Jacobian takes chunk_size * n_points * P floats.
+        :return: dict with arrays 'values' and 'stderr' (n_spectra, P), 'chisqr', 'nfev' and 'success'
+                 (n_spectra,), and 'height_stderr' (n_spectra, N). success is False for the spectra which stopped
+                 without converging (no smaller sum of squares found, or max_iterations reached)
+        """
+        y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+        values = self.initial_values(len(y), initial)
+        results = {'values': values, 'stderr': np.full(values.shape, np.nan), 'chisqr': np.empty(len(y)),
+                   'nfev': np.zeros(len(y), dtype=int), 'success': np.zeros(len(y), dtype=bool),
+                   'height_stderr': np.full((len(y), len(self.peak_prefixes)), np.nan)}
+        for start in range(0, len(y), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            self._levenberg_marquardt(y[chunk], values[chunk], results, chunk, max_iterations, ftol, xtol)
+        return results
+
+    def _levenberg_marquardt(self, y, values, results, chunk, max_iterations, ftol, xtol):
+        """
+        iterations of a chunk of spectra, values are modified in place and results are written in results[chunk].
+        """
+        vary = np.flatnonzero(self.vary)
+        lam = np.full(len(y), 1e-3)
+        nfev = np.ones(len(y), dtype=int)
+        success = np.zeros(len(y), dtype=bool)
+
+        model, jac = self.evaluate(values, jacobian=True)
+        residual = self._weighted(y - model)
+        cost = np.einsum('kn,kn->k', residual, residual)
+        running = np.arange(len(y))
+        for _ in range(max_iterations):
+            if running.size == 0:
+                break
+            j = self._weighted(jac[:, :, vary])
+            jtj = j.transpose(0, 2, 1) @ j
+            gradient = np.einsum('knp,kn->kp', j, residual)
+            diagonal = np.diagonal(jtj, axis1=1, axis2=2)
+            scale = np.maximum(diagonal, 1e-12 * diagonal.max(axis=1, keepdims=True) + 1e-300)
+
+            damped = jtj.copy()
+            damped[:, np.arange(vary.size), np.arange(vary.size)] += lam[running, np.newaxis] * scale
+            step = np.linalg.solve(damped, gradient[..., np.newaxis])[..., 0]
+
+            trial = values[running].copy()
+            trial[:, vary] = np.clip(trial[:, vary] + step, self.lower[vary], self.upper[vary])
+            trial_model, trial_jac = self.evaluate(trial, jacobian=True)
+            trial_residual = self._weighted(y[running] - trial_model)
+            trial_cost = np.einsum('kn,kn->k', trial_residual, trial_residual)
+            nfev[running] += 1
+
+            current = cost[running]
+            better = trial_cost < current
+            actual_step = trial[:, vary] - values[running][:, vary]
+            converged = better & ((current - trial_cost <= ftol * current) |
+                                  (np.linalg.norm(actual_step, axis=1) <=
+                                   xtol * (np.linalg.norm(trial[:, vary], axis=1) + xtol)))
+            stalled = ~better & (lam[running] > 1e10)  # no smaller sum of squares can be found, not a success
+
+            accepted = running[better]
+            values[accepted] = trial[better]
+            cost[accepted] = trial_cost[better]
+            lam[accepted] = np.maximum(lam[accepted] / 10, 1e-12)
+            lam[running[~better]] *= 10
+            success[running[converged]] = True
+
+            jac[better] = trial_jac[better]
+            residual[better] = trial_residual[better]
+            keep = ~(converged | stalled)
+            running, jac, residual = running[keep], jac[keep], residual[keep]
+
+        self._write_results(y, values, cost, results, chunk)
+        results['nfev'][chunk] = nfev
+        results['success'][chunk] = success
+
+    def _write_results(self, y, values, cost, results, chunk):
+        """
+        sums of squares and standard errors at the solution, as lmfit (covariance scaled by the reduced
+        chi-square).
+        """
+        vary = np.flatnonzero(self.vary)
+        _, jac = self.evaluate(values, jacobian=True)
+        j = self._weighted(jac[:, :, vary])
+        jtj = j.transpose(0, 2, 1) @ j
+        # inverted with the columns scaled to unit norm, the powers of x of the background are badly scaled
+        norm = np.sqrt(np.maximum(np.diagonal(jtj, axis1=1, axis2=2), TINY))
+        covariance = np.linalg.pinv(jtj / (norm[:, :, np.newaxis] * norm[:, np.newaxis, :]), hermitian=True)
+        covariance /= norm[:, :, np.newaxis] * norm[:, np.newaxis, :]
+        degrees_of_freedom = max(y.shape[1] - vary.size, 1)
+        covariance *= (cost / degrees_of_freedom)[:, np.newaxis, np.newaxis]
+
+        full = np.zeros((len(values), len(self.names), len(self.names)))
+        full[:, vary[:, np.newaxis], vary] = covariance
+        variance = np.diagonal(full, axis1=1, axis2=2)
+        results['stderr'][chunk] = np.where(self.vary, np.sqrt(np.abs(variance)), np.nan)
+        results['chisqr'][chunk] = cost
+
+        # propagation of the covariance of amplitude and sigma to the height of each peak, amplitude / (pi sigma)
+        for i, prefix in enumerate(self.peak_prefixes):
+            a, s = self.names.index(prefix + 'amplitude'), self.names.index(prefix + 'sigma')
+            sigma = np.maximum(values[:, s], TINY)
+            grad_a, grad_s = 1 / (np.pi * sigma), -values[:, a] / (np.pi * sigma ** 2)
+            variance = (grad_a ** 2 * full[:, a, a] + grad_s ** 2 * full[:, s, s]
+                        + 2 * grad_a * grad_s * full[:, a, s])
+            results['height_stderr'][chunk, i] = np.sqrt(np.abs(variance))
+
+    def _weighted(self, array):
+        """
+        multiplies the residuals (K, n) or the Jacobian (K, n, P) by the weights of the points.
+        """
+        if self.weights is None:
+            return array
+        if array.ndim == 2:
+            return array * self.weights
+        return array * self.weights[:, np.newaxis]
+
+    def table(self, results, index=None):
+        """
+        Table of the results, with the same columns as SpectrumBatch.run_fits: value and stderr of each parameter
+        of params (also fwhm and height of each peak), plus the number of function evaluations and the success.
+
+        :param results: dict returned by fit
+        :param index: names of the rows (e.g. the filenames), range if None
+        :return: pandas dataframe
+        """
+        values, stderr = results['values'], results['stderr']
+        columns = {name: (values[:, i], stderr[:, i]) for i, name in enumerate(self.names)}
+
+        for i, prefix in enumerate(self.peak_prefixes):
+            amplitude, sigma = columns[prefix + 'amplitude'][0], np.maximum(columns[prefix + 'sigma'][0], TINY)
+            columns[prefix + 'fwhm'] = (2 * sigma, 2 * columns[prefix + 'sigma'][1])
+            columns[prefix + 'height'] = (amplitude / (np.pi * sigma), results['height_stderr'][:, i])
+
+        data = {}
+        for name in self.params:
+            if name in columns:
+                data[name], data[name + '_stderr'] = columns[name]
+        data['nfev'] = results['nfev']
+        data['success'] = results['success']
+        return pd.DataFrame(data, index=index)
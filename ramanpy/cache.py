@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .archives import source_path
+
+
+class SpectrumCache:
+    """
+    On-disk cache of parsed spectra.
+    Each spectrum is converted once into a binary .npy sidecar (plus a small .json with the header),
+    so that later reads memory-map the array instead of parsing the text file again.
+
+    The sidecar is keyed by the absolute path of the original file, and it is considered stale
+    as soon as the modification time or the size of the original file changes.
+
+    Attributes
+    ----------
+    cache_dir: Path
+        folder where the sidecars are stored
+    """
+
+    def __init__(self, cache_dir):
+        """
+
+        :param cache_dir: str or Path folder for the sidecars. It is created if it does not exist.
+        """
+        self.cache_dir = Path(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def load(self, filename):
+        """
+        Returns the cached data of a file, if it exists and it is up to date.
+
+        :param filename: str name of the original file
+        :return: data, header. data is a read-only memory-mapped array of shape (n_columns, n_points).
+                 None if the file is not in the cache (or it is stale).
+        """
+        array_file, meta_file = self._sidecar_names(filename)
+        try:
+            with open(meta_file, 'r') as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+        if meta.get('key') != self._file_key(filename):
+            return None
+
+        try:
+            data = np.load(array_file, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+        return data, meta['header']
+
+    def store(self, filename, data, header):
+        """
+        Stores the data of a file in the cache.
+
+        :param filename: str name of the original file
+        :param data: 2D array like of shape (n_columns, n_points)
+        :param header: dict or str metadata of the file, must be json serializable
+        """
+        array_file, meta_file = self._sidecar_names(filename)
+        meta = {'path': os.path.abspath(filename), 'key': self._file_key(filename), 'header': header}
+
+        # write to a temporary file and then rename, so that a reader never sees half a file
+        tmp_array = array_file.with_suffix('.tmp.npy')
+        with open(tmp_array, 'wb') as fh:
+            np.save(fh, np.ascontiguousarray(data))
+        os.replace(tmp_array, array_file)
+
+        tmp_meta = meta_file.with_suffix('.tmp.json')
+        with open(tmp_meta, 'w') as fh:
+            json.dump(meta, fh)
+        os.replace(tmp_meta, meta_file)
+
+    def _sidecar_names(self, filename):
+        """
+        names of the sidecar files for a given file, based on the hash of its absolute path.
+
+        :param filename: str name of the original file
+        :return: tuple of Path (array file, metadata file)
+        """
+        digest = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+        base = self.cache_dir / digest
+        return base.with_suffix('.npy'), base.with_suffix('.json')
+
+    @staticmethod
+    def _file_key(filename):
+        """
+        key used to check if the sidecar is still valid: modification time and size.
+
+        :param filename: str name of the original file
+        :return: list [mtime_ns, size]
+        """
+        stat = os.stat(source_path(filename))  # the archive for a member of an archive
+        return [stat.st_mtime_ns, stat.st_size]
+
+
+def read_cached(filename, reader, cache_dir=None):
+    """
+    Reads a file through the cache. If cache_dir is None, the reader is simply called.
+
+    :param filename: str name of the file
+    :param reader: function filename -> (data, header), where data has shape (n_columns, n_points)
+    :param cache_dir: str folder of the cache, or None to disable it
+    :return: data, header
+    """
+    if cache_dir is None:
+        return reader(filename)
+
+    cache = SpectrumCache(cache_dir)
+    cached = cache.load(filename)
+    if cached is not None:
+        return cached
+
+    data, header = reader(filename)
+    cache.store(filename, data, header)
+    return data, header
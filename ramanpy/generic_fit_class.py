@@ -3,9 +3,17 @@ from abc import ABC, abstractmethod
 from pathlib import Path
 
 from configobj import ConfigObj
-from lmfit.models import LorentzianModel, QuadraticModel, LinearModel, ConstantModel, PolynomialModel
+from lmfit import Parameters
+from lmfit.models import QuadraticModel, LinearModel, ConstantModel, PolynomialModel
 from matplotlib import pyplot as plt
-from scipy.signal import savgol_filter
+import numpy as np
+
+from .models import ModelJacobian, MultiLorentzianModel, jacobian_mode
+from .preprocessing import (baseline_settings, common_grid, decimation_mask, decimation_settings,
+                            decimation_weights, despike_diff, despike_settings, guess_peaks,
+                            initial_guess_settings, normalization_mode, normalize_spectra, peak_windows,
+                            remove_baseline, resample_settings, resample_spectra, roi_mask, roi_settings,
+                            smooth_spectra)
 
 try:
     from plot_python_vki import apply_style
@@ -35,7 +43,8 @@ class GenericFit(ABC):
         folder to save the reports from the fit
 
     """
-
+    var_x = None  # name of the variable x, for plots
+    var_y = None
 
     def __init__(self, experimental_data=None, peaks=None, other_data=None, folder_out=None):
         """
@@ -47,6 +56,10 @@ class GenericFit(ABC):
         other_data: if needed
         folder_out: str folder where report will be saved.
         """
+        # where the data come from, for the lazy loading (see load_data). None if the data are given here.
+        self._source = None
+        self.pipeline = None  # run each time the data are read, see Pipeline.attach
+        self._loaded = False
 
         if peaks is None:
             self.peaks = []
@@ -71,31 +84,315 @@ class GenericFit(ABC):
         self.experimental_data = experimental_data
 
         # extract the experimental data into two variables. Gets extended in inheritance
-        self.var_x = None  # name of the varible x
-        self.var_y = None
         self.x = None  # values of x
         self.y = None
+        self.y_error = None  # uncertainty of y, if known, used as weights of the fit
+        self.baseline = None  # removed from y by apply_baseline, if used
+        self.spikes = None  # indices of the points replaced by apply_despike
+        self.roi = None  # windows (n_windows, 2) of x kept by apply_roi
+        self.x_full = None  # x and y before apply_decimation, to evaluate and plot the fit on all the points
+        self.y_full = None
+        self.sample_weights = None  # weights of the points kept by apply_decimation in the fit
         self.model = None
         self.params = None
         self.filename = None
         self.dict_tolerances_fit = None
 
-    def apply_normalize(self):
-        """
-        performs the normalization.
-        """
-        self.y = self._normalize_data(self.y)
-
-    def apply_smoothing(self):
+    @classmethod
+    def from_arrays(cls, x, y, peaks=None, other_data=None, folder_out=None, filename='spectrum', copy=True):
+        """
+        Alternate constructor from data already in memory (for example one spectrum of a SpectrumBatch).
+        No file is read.
+
+        :param x: 1D array with x values
+        :param y: 1D array with intensities
+        :param peaks: list of peaks to be retrieved
+        :param other_data: if needed
+        :param folder_out: str folder where report will be saved.
+        :param filename: str base name for the outputs (plots, params file)
+        :param copy: bool, copy y so that the preprocessing done in place never modifies the array of the caller.
+                     False only for arrays that may be overwritten (or views, which are never written).
+        :return: fit object of the calling class
+        """
+        fit = cls.__new__(cls)
+        GenericFit.__init__(fit, peaks=peaks, other_data=other_data, folder_out=folder_out)
+        fit.x = x
+        fit.y = np.array(y) if copy else y
+        fit.filename = filename
+        return fit
+
+    @property
+    def experimental_data(self):
+        self._ensure_loaded()
+        return self._experimental_data
+
+    @experimental_data.setter
+    def experimental_data(self, value):
+        self._experimental_data = value
+
+    @property
+    def x(self):
+        self._ensure_loaded()
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x = value
+
+    @property
+    def y(self):
+        self._ensure_loaded()
+        return self._y
+
+    @y.setter
+    def y(self, value):
+        self._y = value
+
+    @property
+    def y_error(self):
+        self._ensure_loaded()
+        return self._y_error
+
+    @y_error.setter
+    def y_error(self, value):
+        self._y_error = value
+
+    def load_data(self):
+        """
+        Reads the experimental data. With lazy construction, it is called on the first access to
+        experimental_data, x or y, so it does not need to be called explicitly.
+        The attached Pipeline, if any, is run on the data read.
+        """
+        self._loaded = True
+        if self._source is None:  # data given directly, nothing to read
+            return
+        try:
+            self._read_source()
+        except Exception:
+            self._loaded = False
+            raise
+        if self.pipeline is not None:
+            self.pipeline.apply(self)
+
+    def release_data(self):
+        """
+        Frees the experimental data (e.g. after the fit, the plot and the save of a spectrum of a large campaign).
+        They will be read again from the file if accessed. Does nothing if the data were not read from a file.
+        Note that the preprocessing (smoothing, normalization) is lost, unless it is done by an attached Pipeline.
+        The state derived from the data by the preprocessing (baseline, spikes, roi, decimation) is reset with
+        them.
+        """
+        if self._source is None:
+            return
+        self._experimental_data = None
+        self._x = None
+        self._y = None
+        self._y_error = None
+        self.baseline = None
+        self.spikes = None
+        self.roi = None
+        self.x_full = None
+        self.y_full = None
+        self.sample_weights = None
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        """
+        loads the data on first access, for the lazy construction.
+        """
+        if not self._loaded and self._source is not None:
+            self.load_data()
+
+    def _read_source(self):
+        """
+        reads self._source and sets experimental_data, x, y (and y_error).
+        Implemented by the classes reading files.
+        """
+        raise NotImplementedError
+
+    def apply_despike(self, dtype=None):
+        """
+        removes the cosmic-ray spikes, if despike = diff is given in other_data (see preprocessing.despike_diff).
+        The indices of the replaced points are kept in self.spikes. To be done before the smoothing.
+        :param dtype: precision of the result (e.g. np.float32), the one of y if None.
+        """
+        method, kwargs = despike_settings(self.other_data)
+        y = self._as_dtype(self.y, dtype)
+        if method == 'neighbours':
+            raise ValueError('despike = neighbours needs the other spectra of a map, use a SpectrumBatch')
+        if method is not None:
+            y, spikes = despike_diff(y, **kwargs)
+            self.spikes = np.flatnonzero(spikes)
+        self.y = y
+
+    def apply_baseline(self, dtype=None):
+        """
+        removes the baseline from y, with the method selected with baseline in other_data (none, als or snip).
+        The fit can then be done without background model (poly_type = none).
+        y_error, if any, is kept: subtracting a baseline does not change the uncertainty of the points.
+        :param dtype: precision of the result (e.g. np.float32), the one of y if None.
+        """
+        method, kwargs = baseline_settings(self.other_data)
+        if method is None:
+            self.y = self._as_dtype(self.y, dtype)
+            return
+
+        y = self._as_dtype(self.y, dtype)
+        self.y, self.baseline = remove_baseline(y, method=method, out=self._owned_or_none(y), **kwargs)
+
+    def apply_resample(self, dtype=None):
+        """
+        interpolates the spectrum onto a regular grid over its range, with the step resample_step and the
+        interpolation resample_kind (linear or cubic) given in other_data. Nothing is done without resample_step.
+        :param dtype: precision of the result (e.g. np.float32), the one of y if None.
+        """
+        settings = resample_settings(self.other_data)
+        y = self._as_dtype(self.y, dtype)
+        if settings is None:
+            self.y = y
+            return
+
+        x = np.asarray(self.x)
+        grid = common_grid([x], step=settings['step'])
+        self.y = resample_spectra(x, y, grid, kind=settings['kind'])[0].astype(y.dtype, copy=False)
+        if self.y_error is not None:
+            self.y_error = resample_spectra(x, self.y_error, grid)[0]
+        self.x = grid
+        self.baseline = None
+        self.spikes = None
+
+    def apply_normalize(self, dtype=None):
+        """
+        performs the normalization, selected with _normalize_data in other_data:
+        True (min-max, the default), False/none, or one of minmax, max, area, l2 (vector), snv.
+        The uncertainty y_error, if any, is scaled by the same factor.
+        :param dtype: precision of the result (e.g. np.float32), the one of y if None.
+        """
+        mode = normalization_mode(self.other_data)
+        if mode is None:
+            self.y = self._as_dtype(self.y, dtype)
+            return
+
+        y = self._as_dtype(self.y, dtype)
+        span = None if self.y_error is None else np.ptp(y)  # before y is overwritten
+        self.y = self._normalize_data(y, mode=mode, x=self.x, in_place=True)
+        if span:  # all the modes are y * a + b
+            self.y_error = self.y_error * (np.ptp(self.y) / span)
+
+    def apply_smoothing(self, dtype=None):
         """
         performs smoothing using _sav_gol filter.
-        :param inplace: bool. if False, returns a new column for the df called smoothed.
+        The method (savgol, fft or auto) can be chosen with smoothing_method in other_data.
+        :param dtype: precision of the result (e.g. np.float32), the one of y if None.
         """
 
         win_size = self._try_get_other_data(self.other_data, 'window_size', default_value=(15,))[0]
         poly_order = self._try_get_other_data(self.other_data, 'poly_order', default_value=(3,))[0]
+        method = self.other_data.get('smoothing_method', 'auto')
 
-        self.y = self._sav_gol(self.y, win_size=win_size, poly_order=poly_order)
+        self.y = self._sav_gol(self._as_dtype(self.y, dtype), win_size=win_size, poly_order=poly_order,
+                               method=method)
+
+    def roi_windows(self):
+        """
+        Windows of x around the peaks to be fitted, as selected with roi, roi_width and roi_merge_gap in other_data
+        (see preprocessing.roi_settings). Uses the tolerances of the fit, set_tolerances_fit is called if needed.
+
+        :return: array (n_windows, 2), None if no region of interest is selected
+        """
+        mode, width, merge_gap = roi_settings(self.other_data)
+        if mode is None or len(self.peaks) == 0:
+            return None
+        if self.dict_tolerances_fit is None:
+            self.set_tolerances_fit()
+
+        tolerance_center = self.dict_tolerances_fit['tolerance_center']
+        if mode == 'tolerance':
+            half_width = width * tolerance_center
+        else:
+            half_width = tolerance_center + width * self.dict_tolerances_fit['sigma']
+        return peak_windows(self.peaks, half_width, merge_gap=merge_gap)
+
+    def apply_roi(self):
+        """
+        keeps only the points of x close to the peaks (see roi_windows), so that the fit evaluates the model on
+        less points. To be done after set_tolerances_fit and before build_fitting_model_peaks.
+        The windows are kept in self.roi, the result can still be evaluated on any x with self.result.eval(x=x).
+        """
+        windows = self.roi_windows()
+        if windows is None:
+            return
+
+        inside = roi_mask(self.x, windows)
+        self.roi = windows
+        if inside.all():
+            return
+        self.x = self.x[inside]
+        self.y = self.y[inside]
+        if self.y_error is not None:
+            self.y_error = self.y_error[inside]
+        if self.baseline is not None:
+            self.baseline = self.baseline[inside]
+        if self.sample_weights is not None:  # decimated before
+            self.sample_weights = self.sample_weights[inside]
+        self.spikes = None
+
+    def decimation_mask(self):
+        """
+        Points kept by apply_decimation, as selected with decimate, decimation_factor, curvature_fraction and
+        decimation_width in other_data (see preprocessing.decimation_settings). With decimate = peaks (or both),
+        all the points within peak_center_tolerance + decimation_width * sigma of the peaks are kept.
+
+        :return: boolean array, None if no decimation is selected
+        """
+        mode, kwargs = decimation_settings(self.other_data)
+        if mode is None:
+            return None
+
+        windows = None
+        if mode in ('peaks', 'both') and len(self.peaks) > 0:
+            if self.dict_tolerances_fit is None:
+                self.set_tolerances_fit()
+            tolerances = self.dict_tolerances_fit
+            half_width = tolerances['tolerance_center'] + kwargs['width'] * tolerances['sigma']
+            windows = peak_windows(self.peaks, half_width)
+        curvature_fraction = kwargs['curvature_fraction'] if mode in ('curvature', 'both') else None
+        return decimation_mask(self.x, self.y, factor=kwargs['factor'], curvature_fraction=curvature_fraction,
+                               windows=windows)
+
+    def apply_decimation(self, keep=None):
+        """
+        keeps all the points near the peaks but only some of the flat regions, so that the fit evaluates the
+        model on less points. The points kept are weighted by the number of points they stand for.
+        The full x and y are kept in x_full and y_full: plot_results and eval_full use them.
+        To be done after the preprocessing and set_tolerances_fit, before build_fitting_model_peaks.
+
+        :param keep: boolean array of the points to keep, decimation_mask() if None
+        """
+        if keep is None:
+            keep = self.decimation_mask()
+        if keep is None or keep.all():
+            return
+
+        self.x_full, self.y_full = self.x, self.y
+        self.sample_weights = decimation_weights(keep)
+        self.x = self.x[keep]
+        self.y = self.y[keep]
+        if self.y_error is not None:
+            self.y_error = self.y_error[keep]
+        if self.baseline is not None:
+            self.baseline = self.baseline[keep]
+        self.spikes = None
+
+    def eval_full(self):
+        """
+        best fit evaluated on all the points, also the ones removed by apply_decimation.
+
+        :return: tuple of arrays x, y, best fit
+        """
+        if self.x_full is None:
+            return self.x, self.y, self.result.best_fit
+        return self.x_full, self.y_full, self.result.eval(x=np.asarray(self.x_full, dtype=np.float64))
 
     @abstractmethod
     def set_tolerances_fit(self):
@@ -105,28 +402,78 @@ class GenericFit(ABC):
         """
         Builds the fitting model with parameters.
         It uses a quadraticModel to remove background noise, even though it is not the most important.
+        Without background model (poly_type = none) only the peaks are fitted.
+        With initial_guess = peaks in other_data, the starting values of the peaks are estimated from the data
+        (see guess_initial_values) instead of the same amplitude and sigma for all.
         :return:
 
         """
 
         model, params = self.create_bkg_model()
-        for i, cen in enumerate(self.peaks):
-            peak, pars = self._add_peak('lz%d' % (i + 1), cen, amplitude=self.dict_tolerances_fit['amplitude'],
-                                        sigma=self.dict_tolerances_fit['sigma'],
-                                        tolerance_center=self.dict_tolerances_fit['tolerance_center'],
-                                        min_max_amplitude=self.dict_tolerances_fit['min_max_amplitude'],
-                                        min_max_sigma=self.dict_tolerances_fit['min_max_sigma'])
-            model = model + peak
-            params.update(pars)
-
+        if len(self.peaks):
+            peaks = MultiLorentzianModel(['lz%d' % (i + 1) for i in range(len(self.peaks))])
+            params.update(peaks.make_params())
+            for prefix, cen in zip(peaks.prefixes, self.peaks):
+                self._add_peak(params, prefix, cen, amplitude=self.dict_tolerances_fit['amplitude'],
+                               sigma=self.dict_tolerances_fit['sigma'],
+                               tolerance_center=self.dict_tolerances_fit['tolerance_center'],
+                               min_max_amplitude=self.dict_tolerances_fit['min_max_amplitude'],
+                               min_max_sigma=self.dict_tolerances_fit['min_max_sigma'])
+            model = peaks if model is None else model + peaks
+
+        if model is None:
+            raise ValueError('Nothing to fit: no peaks and no background model')
         self.model = model
         self.params = params
+        if initial_guess_settings(self.other_data)[0] is not None:
+            self.set_initial_values(self.guess_initial_values())
+
+    def guess_initial_values(self, intensity_data=None):
+        """
+        Estimates the starting values of the peaks from the data, see preprocessing.guess_peaks: the maximum within
+        peak_center_tolerance of each configured peak, its FWHM and its area. Needs set_tolerances_fit.
+
+        :param intensity_data: 1D array, or 2D array (n_spectra, n_points) on the same x, self.y if None
+        :return: dict {lz1amplitude: value (or array with one value per spectrum), lz1center: ..., ...},
+                 nan for the peaks not found
+        """
+        tolerances = self.dict_tolerances_fit
+        window = initial_guess_settings(self.other_data)[1]
+        if window is None:
+            window = tolerances['tolerance_center'] + 5 * tolerances['sigma']
+        x, y = (self.x, self.y) if self.x_full is None else (self.x_full, self.y_full)  # all the points
+        y = y if intensity_data is None else intensity_data
+        amplitude, center, sigma = guess_peaks(x, y, self.peaks, tolerances['tolerance_center'], window)
+
+        values = {}
+        for i in range(len(self.peaks)):
+            prefix = 'lz%d' % (i + 1)
+            values.update({prefix + 'amplitude': amplitude[..., i], prefix + 'center': center[..., i],
+                           prefix + 'sigma': sigma[..., i]})
+        return values
+
+    def set_initial_values(self, values):
+        """
+        Changes the starting values of the fit (e.g. to the results of a neighbouring spectrum), after
+        build_fitting_model_peaks. The values are kept within the bounds of the parameters.
+
+        :param values: dict {name of a parameter: value}, the names which are not parameters are ignored
+        """
+        for name, value in values.items():
+            if name in self.params and self.params[name].expr is None and np.isfinite(value):
+                param = self.params[name]
+                param.set(value=min(max(value, param.min), param.max))
 
     def run_fit_model(self):
         """
         Perform the fit
         """
-        result, components = self._fit_lorentzians(self.x, self.y, self.model, self.params)
+        weights = None if self.y_error is None else self._weights_from_error(self.y_error)
+        if self.sample_weights is not None:
+            weights = self.sample_weights if weights is None else weights * self.sample_weights
+        jacobian = jacobian_mode(self.other_data) == 'analytic'
+        result, components = self._fit_lorentzians(self.x, self.y, self.model, self.params, weights=weights,
+                                                    jacobian=jacobian)
         self.result = result
         self.components = components
 
@@ -137,6 +484,11 @@ class GenericFit(ABC):
             params file : with the actual paramters and their std.
 
         """
+        # the name can contain folders, e.g. for the members of an archive
+        os.makedirs(os.path.dirname(self.folder_out / self.filename), exist_ok=True)
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+
         # save fit report to a file:
         with open(f'{self.folder_out / self.filename}_report', 'w') as fh:
             fh.write(self.result.fit_report())
@@ -150,16 +502,21 @@ class GenericFit(ABC):
         """
         Plots the results of the fit.
         """
-        plt.plot(self.x, self.y, label='data')
-        plt.plot(self.x, self.result.best_fit, label='best fit')
-        for name, component in self.components.items():
+        x, y, best_fit = self.eval_full()  # all the points, if the data were decimated
+        components = self.components if self.x_full is None else self.result.eval_components(
+            x=np.asarray(x, dtype=np.float64))
+        plt.plot(x, y, label='data')
+        plt.plot(x, best_fit, label='best fit')
+        for name, component in components.items():
             if isinstance(component, float):
                 plt.axhline(component, linestyle='--', label=name)
             else:
-                plt.plot(self.x, component, linestyle='--', label=name)
+                plt.plot(x, component, linestyle='--', label=name)
         plt.xlabel(self.var_x)
         plt.ylabel(self.var_y)
         plt.legend(loc='upper right')
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
         plt.savefig(self.filename + '.png')
         plt.close()
 
@@ -168,10 +525,12 @@ class GenericFit(ABC):
         Creates a bkg model for removing the background from the signals.
         Gets the data from the other_data part of the input file. Otherwise it will assign quadratic.
 
-        :return: model lmfit  for the bkg function.
+        :return: model lmfit  for the bkg function, None for poly_type = none (e.g. after apply_baseline).
         :return: params lmfit parameters to be adjusted.
         """
-        bkg_model = self._choose_bkg_model(self.other_data['poly_type'])
+        bkg_model = self._choose_bkg_model(self.other_data.get('poly_type', 'quadratic'))
+        if bkg_model is None:
+            return None, Parameters()
         model = bkg_model[0](**bkg_model[1])
         params = model.make_params(bkg_model[2])
 
@@ -182,12 +541,14 @@ class GenericFit(ABC):
     # The underscore is to treat them as private
     #########
     @staticmethod
-    def _add_peak(prefix, center, amplitude, sigma, tolerance_center,
+    def _add_peak(params, prefix, center, amplitude, sigma, tolerance_center,
                   min_max_amplitude, min_max_sigma):
         """
-        adds a peak using a LorentzianModel from lmfit. Peaks can be summed as a linear combination
+        sets the initial values and the bounds of a peak of the MultiLorentzianModel, which sums all the peaks.
 
 
+        :param params: lmfit parameters
+                with the ones of the peak, modified in place
         :param prefix: str
                 name of the peak
         :param center: float
@@ -202,19 +563,15 @@ class GenericFit(ABC):
                 plus minus this quantity for the peak center location
         :param min_max_sigma: tuple
                 for the sigma of the peak
-        :return: peak lmfit model with the peak and its properties.
-        :return: pars lmfit parameters to be adjusted.
+        :return: params lmfit parameters to be adjusted.
         """
-        peak = LorentzianModel(prefix=prefix)  # created a lorentzian function
-        pars = peak.make_params()
-
-        pars[prefix + 'center'].set(center, min=center - tolerance_center, max=center + tolerance_center)
-        pars[prefix + 'amplitude'].set(amplitude, min=min_max_amplitude[0], max=min_max_amplitude[1])
-        pars[prefix + 'sigma'].set(sigma, min=min_max_sigma[0], max=min_max_sigma[1])
-        return peak, pars
+        params[prefix + 'center'].set(center, min=center - tolerance_center, max=center + tolerance_center)
+        params[prefix + 'amplitude'].set(amplitude, min=min_max_amplitude[0], max=min_max_amplitude[1])
+        params[prefix + 'sigma'].set(sigma, min=min_max_sigma[0], max=min_max_sigma[1])
+        return params
 
     @staticmethod
-    def _fit_lorentzians(x, y, model, params):
+    def _fit_lorentzians(x, y, model, params, weights=None, jacobian=True):
         """
         Fits the lorentzians to the experimental data.
         It uses a quadraticModel to remove background noise, even though it is not the most important.
@@ -226,26 +583,67 @@ class GenericFit(ABC):
                 to be fit
         :param params: lmfit params
                 to be adjusted
+        :param weights: 1D array like
+                weights of the residual (1/error), None for no weights
+        :param jacobian: bool
+                True to give the analytic Jacobian (ModelJacobian) to the optimizer, if the model supports it.
+                False for finite differences
         :return:
         """
+        # the data may be stored in float32, the residual of the optimizer is always computed in float64
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
 
         init = model.eval(params, x=x)
-        result = model.fit(y, params, x=x)
+        dfun = ModelJacobian.from_model(model, params) if jacobian else None
+        fit_kws = None if dfun is None else {'Dfun': dfun}
+        result = model.fit(y, params, x=x, weights=weights, fit_kws=fit_kws)
         components = result.eval_components()
 
         return result, components
 
+    @staticmethod
+    def _as_dtype(data, dtype=None):
+        """
+        converts the data to the given precision, without copy if it is already in that precision.
+
+        :param data: array like
+        :param dtype: numpy dtype, or None to keep the data as it is
+        :return: array
+        """
+        if dtype is None:
+            return data
+        return np.asarray(data, dtype=dtype)
+
+    @staticmethod
+    def _weights_from_error(y_error):
+        """
+        weights of the fit from the uncertainty of the data, 1/error. Points with a zero or invalid error get
+        the median weight.
+
+        :param y_error: 1D array with the uncertainty of each point
+        :return: 1D array with the weights
+        """
+        y_error = np.asarray(y_error, dtype=np.float64)
+        valid = np.isfinite(y_error) & (y_error > 0)
+        weights = np.empty_like(y_error)
+        weights[valid] = 1 / y_error[valid]
+        weights[~valid] = np.median(weights[valid]) if valid.any() else 1
+        return weights
+
     @staticmethod
     def _choose_bkg_model(poly_type):
         """
         Selects a bkg model for the fit. If not available, it will use the default quadratic.
 
         :param poly_type: str
-                Type of bkg: linear, quadratic, constant, cubic.
+                Type of bkg: linear, quadratic, constant, cubic, or none (no background).
         :return: lmfit model
-                the bkg model to be added in the fitting.
+                the bkg model to be added in the fitting. None for none.
         """
         poly_type = poly_type.lower()  # to avoid typos
+        if poly_type == 'none':
+            return None
 
         poly_type_dict = {
             'quadratic': (QuadraticModel, {'prefix': 'bkg'}, {'a': 0, 'b': 0, 'c': 0}),
@@ -293,34 +691,52 @@ class GenericFit(ABC):
         return list_numbers
 
     @staticmethod
-    def _sav_gol(intensity_data, win_size=11, poly_order=4):
+    def _sav_gol(intensity_data, win_size=11, poly_order=4, method='savgol'):
         """
         applies the savgol_filter for a 1D data. set as static method for convenience.
-        
+        For a 2D array (n_spectra, n_points) each row is filtered, in a single call.
+
         :param intensity_data: 
             1D array with the original data
+        :param method: 'savgol', 'fft' or 'auto', see preprocessing.smooth_spectra
         :return: 1D array
             with data smoothed
         """
-        data_smoothed = savgol_filter(intensity_data, window_length=int(win_size), polyorder=int(poly_order), axis=0)
+        data_smoothed = smooth_spectra(intensity_data, window_size=win_size, poly_order=poly_order, method=method)
         return data_smoothed
 
     @staticmethod
-    def _normalize_data(intensity_data):
+    def _normalize_data(intensity_data, mode='minmax', x=None, in_place=False):
         """
-        Here we normalize as z = z - min(x)/(max(x)-min(x)).
+        Here we normalize as z = z - min(x)/(max(x)-min(x)), or with another mode of
+        preprocessing.normalize_spectra.
+        For a 2D array (n_spectra, n_points) each row is normalized.
         :param intensity_data
             1D array with the original data
+        :param mode: str minmax, max, area, l2 or snv
+        :param x: x axis, for the area mode
+        :param in_place: bool, overwrite intensity_data if it is a float array owning its (writeable) data,
+            as the results of the smoothing. Views (e.g. on the cache or on the arrays of a batch) are never
+            modified.
         :return: intensity_data_scaled:
             scaled intensity data
         """
-
-        min_intensity = min(intensity_data)
-        max_intensity = max(intensity_data)
-
-        intensity_data_scaled = (intensity_data - min_intensity) / (max_intensity - min_intensity)
+        intensity_data = np.asarray(intensity_data)
+        out = GenericFit._owned_or_none(intensity_data) if in_place else None
+        intensity_data_scaled = normalize_spectra(intensity_data, mode=mode, x=x, out=out)
         return intensity_data_scaled
 
+    @staticmethod
+    def _owned_or_none(data):
+        """
+        the array itself if it can be overwritten by the preprocessing (a float array owning its writeable data,
+        as the results of a previous stage or the copies made by from_arrays and SpectrumBatch), None otherwise
+        (views on the cache, on the spectra of a batch...)
+        """
+        if isinstance(data, np.ndarray) and data.dtype.kind == 'f' and data.flags.owndata and data.flags.writeable:
+            return data
+        return None
+
     @staticmethod
     def read_otherdata_configfile(config_file, default_config_file, default_folder=None):
         """
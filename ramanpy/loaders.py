@@ -0,0 +1,102 @@
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .archives import close_archives, is_archive, list_archive_members, output_name
+from .batch import SpectrumBatch
+from .specific_fit_classes import RamanFit
+
+
+def find_spectra_files(pattern):
+    """
+    Lists the spectra files matching a pattern, sorted so that the order is always the same.
+    The _params.txt files written by GenericFit.save_results are skipped.
+    The zip and tar archives matched are replaced by their members (archive::member), which the readers
+    open without extracting them.
+
+    :param pattern: str glob pattern (e.g. 'campaign/**/*.txt', 'old_campaign.tar.gz') or a folder,
+                    then all its .txt files are used
+    :return: list of str
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.txt')
+
+    filenames = []
+    for filename in glob.glob(pattern, recursive=True):
+        if not os.path.isfile(filename):
+            continue
+        if is_archive(filename):
+            filenames.extend(list_archive_members(filename))
+        else:
+            filenames.append(filename)
+    return sorted(filename for filename in filenames if not output_name(filename).endswith('_params'))
+
+
+def read_files_threaded(filenames, reader, workers=8):
+    """
+    Reads many files concurrently with a thread pool. Reading is I/O bound, so threads are enough.
+    Each thread reads its share of the files, reusing the tar archives it opens, and closes them at the end.
+
+    :param filenames: list of str
+    :param reader: function filename -> result
+    :param workers: int number of threads
+    :return: list of results in the same order as filenames (None for the failed ones),
+             dict with the failures filename -> error message
+    """
+    def safe_reader(filename):
+        try:
+            return reader(filename), None
+        except Exception as error:  # a corrupted file should not stop the whole campaign
+            return None, f'{type(error).__name__}: {error}'
+
+    def read_share(share):
+        try:
+            return [safe_reader(filename) for filename in share]
+        finally:
+            close_archives()  # the tar files opened by this thread
+
+    filenames = list(filenames)
+    workers = max(1, min(workers, len(filenames)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        shares = list(executor.map(read_share, [filenames[i::workers] for i in range(workers)]))
+
+    outputs = [None] * len(filenames)
+    for i, share in enumerate(shares):
+        outputs[i::workers] = share
+
+    results = [result for result, _ in outputs]
+    failures = {filename: error for filename, (_, error) in zip(filenames, outputs) if error is not None}
+    return results, failures
+
+
+def load_directory(pattern, workers=8, fit_class=RamanFit, cache_dir=None, dtype=None, **kwargs):
+    """
+    Loads all the spectra matching a pattern into a SpectrumBatch, reading the files with a thread pool.
+    The spectra are sorted by filename. Files that cannot be read are reported and skipped.
+
+    :param pattern: str glob pattern or folder (see find_spectra_files)
+    :param workers: int number of threads
+    :param fit_class: RamanFit or XRDFit, its read_xy is used to read the files
+    :param cache_dir: folder of the binary cache (see SpectrumCache)
+    :param dtype: precision of the intensities, e.g. np.float32 to halve the memory
+    :param kwargs: passed to SpectrumBatch.from_spectra (grid, kind to resample spectra with different x axes)
+                   and to SpectrumBatch (peaks, other_data, folder_out)
+    :return: SpectrumBatch, with the failed files in its failures attribute
+    """
+    filenames = find_spectra_files(pattern)
+    if not filenames:
+        raise FileNotFoundError(f'No spectra found for {pattern}')
+
+    def reader(filename):
+        return fit_class.read_xy(filename, cache_dir=cache_dir, dtype=dtype)
+
+    spectra, failures = read_files_threaded(filenames, reader, workers=workers)
+    for filename, error in failures.items():
+        print(f'{filename} could not be read, skipped. {error}')
+
+    loaded = [(filename, spectrum) for filename, spectrum in zip(filenames, spectra) if spectrum is not None]
+    batch = SpectrumBatch.from_spectra([spectrum for _, spectrum in loaded],
+                                       filenames=[output_name(filename) for filename, _ in loaded],
+                                       fit_class=fit_class, dtype=dtype, **kwargs)
+    batch.failures = failures
+    return batch
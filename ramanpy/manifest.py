@@ -0,0 +1,226 @@
+import json
+import os
+import zlib
+
+import numpy as np
+
+from .archives import open_binary, source_path
+from .loaders import find_spectra_files, read_files_threaded
+from .readers import read_header
+from .spatial import SpatialIndex
+from .tools import positions_from_header
+
+
+class Manifest:
+    """
+    Index of a campaign folder: for each spectrum file, its parsed header and positions, so that post-processing
+    and map tools do not need to open the raw files again.
+
+    Only the header lines are read when building the index. With full_scan, the whole file is also read as bytes
+    (without parsing) to get the number of points and a crc32 checksum.
+    An entry is rebuilt when the modification time or the size of its file changes, and removed when its file
+    is deleted: refresh checks all the files at once, and header and positions check the files they read.
+
+    Attributes
+    ----------
+    entries: dict
+        absolute path -> dict with mtime_ns, size, header, positions (X, Y, Z in µm), n_points and checksum
+        (the last two are None if the file was not fully scanned)
+    index_file: str
+        json file where the index is persisted, None to keep it only in memory
+    failures: dict
+        files that could not be indexed by the last refresh and the reason (see loaders.read_files_threaded)
+    """
+
+    def __init__(self, entries=None, index_file=None):
+        """
+
+        :param entries: dict of entries, see attributes
+        :param index_file: str json file of the index
+        """
+        self.entries = {} if entries is None else entries
+        self.index_file = index_file
+        self.failures = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, filename):
+        return os.path.abspath(filename) in self.entries
+
+    @classmethod
+    def build(cls, pattern, index_file=None, workers=8, full_scan=False):
+        """
+        Builds (or updates) the manifest of the files matching a pattern. If index_file exists, it is loaded
+        first and only the new or modified files are scanned. The index is saved back to index_file.
+
+        :param pattern: str glob pattern or folder (see loaders.find_spectra_files)
+        :param index_file: str json file of the index, None to not persist it
+        :param workers: int number of threads to scan the files
+        :param full_scan: bool, also count the points and compute the checksum of each file
+        :return: Manifest
+        """
+        if index_file is not None and os.path.exists(index_file):
+            manifest = cls.load(index_file)
+        else:
+            manifest = cls(index_file=index_file)
+
+        manifest.refresh(find_spectra_files(pattern), workers=workers, full_scan=full_scan)
+        if index_file is not None:
+            manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, index_file):
+        """
+        Loads a manifest saved with save.
+
+        :param index_file: str json file of the index
+        :return: Manifest
+        """
+        with open(index_file, 'r', encoding='utf-8') as fh:
+            entries = json.load(fh)
+        return cls(entries, index_file=index_file)
+
+    def save(self, index_file=None):
+        """
+        Saves the manifest as json.
+
+        :param index_file: str json file, by default the one of the manifest
+        """
+        index_file = self.index_file if index_file is None else index_file
+        tmp_file = index_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as fh:
+            json.dump(self.entries, fh, ensure_ascii=False)
+        os.replace(tmp_file, index_file)
+
+    def refresh(self, filenames, workers=8, full_scan=False):
+        """
+        Scans the files that are not in the manifest or whose modification time or size changed. The entries of
+        the files that no longer exist (given or already in the manifest) are removed, and so are the ones of
+        the files that cannot be scanned again, which are reported in self.failures.
+
+        :param filenames: list of str
+        :param workers: int number of threads
+        :param full_scan: bool, also count the points and compute the checksum
+        :return: list of the files that were (re)scanned
+        """
+        for path in list(self.entries):
+            if not os.path.exists(source_path(path)):
+                del self.entries[path]
+
+        outdated = []
+        for filename in filenames:
+            path = os.path.abspath(filename)
+            if not os.path.exists(source_path(path)):
+                self.entries.pop(path, None)
+            elif self._is_outdated(path, full_scan=full_scan):
+                outdated.append(path)
+
+        def scanner(path):
+            return scan_file(path, full_scan=full_scan)
+
+        entries, self.failures = read_files_threaded(outdated, scanner, workers=workers)
+        for path, entry in zip(outdated, entries):
+            if entry is None:  # the old entry would describe another version of the file
+                self.entries.pop(path, None)
+            else:
+                self.entries[path] = entry
+
+        return outdated
+
+    def _is_outdated(self, path, full_scan=False):
+        """
+        True if the file is not in the manifest, or was modified since it was scanned.
+        """
+        entry = self.entries.get(path)
+        stat = os.stat(source_path(path))
+        return (entry is None or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size
+                or (full_scan and entry['checksum'] is None))
+
+    def _entry(self, filename):
+        """
+        entry of a file of the manifest, scanned again if the file was modified.
+
+        :param filename: str name of the file
+        :return: dict entry
+        """
+        path = os.path.abspath(filename)
+        if path not in self.entries:
+            raise KeyError(f'{filename} is not in the manifest')
+        if not os.path.exists(source_path(path)):
+            del self.entries[path]
+            raise FileNotFoundError(f'{filename} was deleted, it is removed from the manifest')
+        if self._is_outdated(path):
+            try:
+                self.entries[path] = scan_file(path, full_scan=self.entries[path]['checksum'] is not None)
+            except Exception:
+                del self.entries[path]
+                raise
+        return self.entries[path]
+
+    def header(self, filename):
+        """
+        :param filename: str name of the file
+        :return: dict with the header of the file, scanned again if the file was modified
+        """
+        return self._entry(filename)['header']
+
+    def positions(self, filenames=None):
+        """
+        :param filenames: list of str, all the files of the manifest if None (after a refresh, which drops the
+                          deleted files)
+        :return: array (n, 3) with X, Y, Z in µm, of the files as they are now
+        """
+        if filenames is None:
+            self.refresh(list(self.entries))
+            filenames = list(self.entries)
+        return np.array([self._entry(filename)['positions'] for filename in filenames]).reshape(-1, 3)
+
+    def spatial_index(self, n_dims=2):
+        """
+        KD-tree over the positions of the files of the manifest. The files selected by a query can then be
+        loaded alone (e.g. SpectrumBatch.from_files(index.labels_of(indices))).
+
+        :param n_dims: int 2 for X, Y, 3 to include Z
+        :return: SpatialIndex labelled with the paths of the files
+        """
+        positions = self.positions()  # refreshed first
+        return SpatialIndex(positions, labels=list(self.entries), n_dims=n_dims)
+
+
+def scan_file(filename, full_scan=False, block_size=1 << 20):
+    """
+    Builds the manifest entry of one file.
+
+    :param filename: str name of the file
+    :param full_scan: bool, also count the points and compute the crc32 of the whole file
+    :param block_size: int bytes read at a time in the full scan
+    :return: dict entry, see Manifest
+    """
+    stat = os.stat(source_path(filename))
+    header = read_header(filename)
+    entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'header': header,
+             'positions': positions_from_header(header), 'n_points': None, 'checksum': None}
+
+    if full_scan:
+        checksum = 0
+        n_lines = 0
+        n_header_lines = 0
+        last_byte = b'\n'
+        with open_binary(filename) as fh:
+            for i, block in enumerate(iter(lambda: fh.read(block_size), b'')):
+                checksum = zlib.crc32(block, checksum)
+                n_lines += block.count(b'\n')
+                last_byte = block[-1:]
+                if i == 0:  # the header is always in the first block
+                    for line in block.split(b'\n'):
+                        if not line.startswith(b'#'):
+                            break
+                        n_header_lines += 1
+        if last_byte != b'\n':  # last line without end of line
+            n_lines += 1
+        entry['n_points'] = n_lines - n_header_lines
+        entry['checksum'] = f'{checksum:08x}'
+
+    return entry
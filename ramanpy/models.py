@@ -0,0 +1,301 @@
+import operator
+
+import numpy as np
+from lmfit import Model
+from lmfit.models import LorentzianModel, QuadraticModel, LinearModel, ConstantModel, PolynomialModel
+
+# values of other_data['jacobian']: analytic derivatives, or finite differences computed by the optimizer
+JACOBIAN_MODES = ('analytic', 'numeric')
+
+# powers of x multiplying each parameter of the background models of _choose_bkg_model
+BKG_POWERS = {
+    QuadraticModel: {'a': 2, 'b': 1, 'c': 0},
+    LinearModel: {'slope': 1, 'intercept': 0},
+    ConstantModel: {'c': 0},
+}
+
+LORENTZIAN_PARAMS = ('amplitude', 'center', 'sigma')
+
+# parameters given by expressions, as in LorentzianModel
+LORENTZIAN_DERIVED = ('fwhm', 'height')
+
+# smallest sigma used by lmfit for the Lorentzians
+TINY = 1.0e-15
+
+
+class MultiLorentzianModel(Model):
+    """
+    Sum of N Lorentzians evaluated at once: one broadcast of shape (n_points, N) into a work array kept between
+    evaluations, instead of a CompositeModel of N LorentzianModel, which evaluates each peak separately and
+    goes through the tree of models and the prefixes of the parameters at each evaluation.
+
+    It has the same parameters as the LorentzianModel it replaces, in the same order:
+    {prefix}amplitude, {prefix}center, {prefix}sigma and the expressions {prefix}fwhm and {prefix}height, so the
+    reports, the _params.txt files and ReadResultParamsFit do not change. eval_components gives one
+    component per peak, named by its prefix.
+
+    Attributes
+    ----------
+    prefixes: list
+        prefixes of the peaks, e.g. ['lz1', 'lz2']
+    """
+
+    fwhm_factor = 2.0
+    height_factor = 1. / np.pi
+
+    def __init__(self, prefixes, nan_policy='raise', **kws):
+        """
+
+        :param prefixes: list of str prefixes of the peaks
+        :param nan_policy: str, see lmfit Model
+        """
+        self.prefixes = list(prefixes)
+        self._work = None  # (n_points, N) array reused by the evaluations
+        super().__init__(self._lorentzians, independent_vars=['x'], nan_policy=nan_policy, name='lorentzians',
+                         **kws)
+        for prefix in self.prefixes:
+            self.set_param_hint(f'{prefix}sigma', min=0)
+            self.set_param_hint(f'{prefix}fwhm', expr=f'{self.fwhm_factor:.7f}*{prefix}sigma')
+            self.set_param_hint(f'{prefix}height',
+                                expr=f'{self.height_factor:.7f}*{prefix}amplitude/max({TINY}, {prefix}sigma)')
+
+    def _parse_params(self):
+        """
+        the parameters are given by the prefixes, not by the signature of a function.
+        """
+        self.independent_vars = ['x']
+        self.independent_vars_defvals = {}
+        self.def_vals = {}
+        self._param_root_names = [prefix + name for prefix in self.prefixes
+                                  for name in LORENTZIAN_PARAMS + LORENTZIAN_DERIVED]
+        self._param_names = self._param_root_names[:]
+        self._func_allargs = ['x'] + self._param_names
+        self._func_haskeywords = True
+
+    def _lorentzians(self, x, **values):
+        """
+        model function, with the parameters as keywords (as lmfit calls the functions of the models).
+        """
+        return self._peaks(x, *self._peak_values(None, values)).sum(axis=1)
+
+    def eval(self, params=None, **kwargs):
+        """
+        Evaluates the sum of the peaks.
+
+        :param params: lmfit Parameters
+        :param kwargs: x, and values of parameters replacing the ones of params
+        :return: 1D array
+        """
+        return self._peaks(kwargs['x'], *self._peak_values(params, kwargs)).sum(axis=1)
+
+    def eval_components(self, params=None, **kwargs):
+        """
+        Evaluates each peak.
+
+        :param params: lmfit Parameters
+        :param kwargs: x, and values of parameters replacing the ones of params
+        :return: dict {prefix: 1D array}
+        """
+        peaks = self._peaks(kwargs['x'], *self._peak_values(params, kwargs))
+        return {prefix: peaks[:, i].copy() for i, prefix in enumerate(self.prefixes)}
+
+    def _peak_values(self, params, values):
+        """
+        amplitudes, centers and sigmas of the peaks.
+
+        :param params: lmfit Parameters, or None
+        :param values: dict of values replacing the ones of params
+        :return: tuple of 3 arrays of shape (N,)
+        """
+        return tuple(np.array([values[name] if name in values else params[name].value
+                               for name in (prefix + root for prefix in self.prefixes)], dtype=np.float64)
+                     for root in LORENTZIAN_PARAMS)
+
+    def _peaks(self, x, amplitude, center, sigma):
+        """
+        values of each peak, written into the work array.
+
+        :return: 2D array of shape (n_points, N), valid until the next evaluation
+        """
+        x = np.asarray(x, dtype=np.float64)
+        shape = (x.size, len(self.prefixes))
+        if self._work is None or self._work.shape != shape:
+            self._work = np.empty(shape)
+        work = self._work
+
+        sigma = np.maximum(sigma, TINY)  # as LorentzianModel
+        np.subtract(x.reshape(-1, 1), center, out=work)
+        np.multiply(work, work, out=work)
+        work += sigma * sigma
+        np.divide(amplitude * sigma / np.pi, work, out=work)
+        return work
+
+
+class ModelJacobian:
+    """
+    Analytic Jacobian of the residual of a sum of Lorentzians (MultiLorentzianModel or LorentzianModel) and a
+    polynomial background (QuadraticModel, LinearModel, ConstantModel or PolynomialModel), i.e. the models built
+    by GenericFit.build_fitting_model_peaks.
+
+    It is given to lmfit as Dfun of leastsq, which then computes one model evaluation per iteration instead of
+    one per varying parameter for the finite differences. It has the signature lmfit uses for Dfun with
+    Model.fit: jacobian(params, data, weights, x=x), and returns the derivatives of the residual
+    with respect to the varying parameters, in the order of lmfit (one column per parameter). The residual of
+    lmfit is (data - model) * weights, so the Jacobian is -df/dp * weights.
+    lmfit applies itself the scaling of the bounded parameters.
+
+    For a Lorentzian f = A / pi * s / ((x - c)^2 + s^2), with u = x - c and D = u^2 + s^2:
+
+        df/dA = s / (pi D)
+        df/dc = 2 A s u / (pi D^2)
+        df/ds = A (u^2 - s^2) / (pi D^2)
+
+    Attributes
+    ----------
+    peak_prefixes: list
+        prefixes of the Lorentzians, e.g. ['lz1', 'lz2']
+    bkg_powers: dict
+        name of each parameter of the background: power of x it multiplies
+    """
+
+    def __init__(self, peak_prefixes, bkg_powers=None):
+        """
+
+        :param peak_prefixes: list of str prefixes of the LorentzianModel
+        :param bkg_powers: dict {name of the parameter: power of x} of the background, None for no background
+        """
+        self.peak_prefixes = list(peak_prefixes)
+        self.bkg_powers = dict(bkg_powers or {})
+        self._columns = {}  # varying parameters: index of the columns, computed once per set of parameters
+
+    @classmethod
+    def from_model(cls, model, params=None):
+        """
+        Alternate constructor from an lmfit model.
+
+        :param model: lmfit Model or CompositeModel (a sum of components)
+        :param params: lmfit Parameters, to check that the parameters of the components have no expression
+        :return: ModelJacobian, or None if the model has other components or operators (then the optimizer
+                 uses finite differences)
+        """
+        if not _is_sum(model):
+            return None
+
+        peak_prefixes = []
+        bkg_powers = {}
+        for component in model.components:
+            if isinstance(component, MultiLorentzianModel):
+                peak_prefixes.extend(component.prefixes)
+                names = [prefix + name for prefix in component.prefixes for name in LORENTZIAN_PARAMS]
+            elif isinstance(component, LorentzianModel):
+                peak_prefixes.append(component.prefix)
+                names = [component.prefix + name for name in LORENTZIAN_PARAMS]
+            elif isinstance(component, PolynomialModel):
+                names = [f'{component.prefix}c{power}' for power in range(component.poly_degree + 1)]
+                bkg_powers.update({name: power for power, name in enumerate(names)})
+            elif type(component) in BKG_POWERS:
+                powers = BKG_POWERS[type(component)]
+                names = [component.prefix + name for name in powers]
+                bkg_powers.update({component.prefix + name: power for name, power in powers.items()})
+            else:
+                return None
+
+            # a parameter given by an expression would need the derivatives of the expression
+            if params is not None and any(params[name].expr for name in names if name in params):
+                return None
+
+        return cls(peak_prefixes, bkg_powers)
+
+    def __call__(self, params, data=None, weights=None, x=None, **kws):
+        """
+        Jacobian of the residual.
+
+        :param params: lmfit Parameters, with the current values
+        :param data: 1D array, not used (the residual is linear in the data)
+        :param weights: 1D array weights of the residual, or None
+        :param x: 1D array x values
+        :return: 2D array of shape (x.size, number of varying parameters)
+        """
+        x = np.asarray(x, dtype=np.float64)
+        var_names = tuple(name for name, par in params.items() if par.vary)
+        columns = self._columns.get(var_names)
+        if columns is None:
+            columns = self._columns[var_names] = self._column_indices(var_names)
+        peak_columns, bkg_columns = columns
+
+        jacobian = np.zeros((x.size, len(var_names)))
+        if self.peak_prefixes:
+            amplitude, center, sigma = (np.array([params[prefix + name].value for prefix in self.peak_prefixes])
+                                        for name in LORENTZIAN_PARAMS)
+            derivatives = dict(zip(LORENTZIAN_PARAMS, lorentzian_derivatives(x, amplitude, center, sigma)))
+            for name, (peaks, cols) in peak_columns.items():
+                jacobian[:, cols] = derivatives[name][:, peaks]
+
+        for col, power in bkg_columns:
+            jacobian[:, col] = x ** power if power else 1
+
+        if weights is None:
+            return np.negative(jacobian, out=jacobian)
+        jacobian *= -np.asarray(weights, dtype=np.float64)[:, np.newaxis]
+        return jacobian
+
+    def _column_indices(self, var_names):
+        """
+        columns of the Jacobian for each varying parameter.
+
+        :param var_names: tuple of names of the varying parameters, in the order of lmfit
+        :return: dict {name: (index of the peaks, index of the columns)}, list of (column, power) of the background
+        """
+        index = {name: i for i, name in enumerate(var_names)}
+        peak_columns = {}
+        for name in LORENTZIAN_PARAMS:
+            pairs = [(i, index[prefix + name]) for i, prefix in enumerate(self.peak_prefixes)
+                     if prefix + name in index]
+            peaks, cols = zip(*pairs) if pairs else ((), ())
+            peak_columns[name] = (np.array(peaks, dtype=int), np.array(cols, dtype=int))
+        bkg_columns = [(index[name], power) for name, power in self.bkg_powers.items() if name in index]
+        return peak_columns, bkg_columns
+
+
+def lorentzian_derivatives(x, amplitude, center, sigma):
+    """
+    Derivatives of Lorentzians with respect to their amplitude, center and sigma (see ModelJacobian).
+    The parameters can be stacked for many spectra, with shape (..., N) for N peaks.
+
+    :param x: 1D array of n points
+    :param amplitude: array (..., N)
+    :param center: array (..., N)
+    :param sigma: array (..., N)
+    :return: tuple of 3 arrays of shape (..., n, N), d/damplitude (which is also the peak of amplitude 1),
+             d/dcenter and d/dsigma
+    """
+    amplitude = np.asarray(amplitude)[..., np.newaxis, :]
+    sigma = np.maximum(sigma, TINY)[..., np.newaxis, :]  # as LorentzianModel
+    u = x[:, np.newaxis] - np.asarray(center)[..., np.newaxis, :]
+    u2 = u * u
+    denominator = u2 + sigma * sigma
+    d_amplitude = sigma / (np.pi * denominator)
+    a_over_d2 = amplitude / (np.pi * denominator * denominator)
+    return d_amplitude, 2 * sigma * u * a_over_d2, (u2 - sigma * sigma) * a_over_d2
+
+
+def jacobian_mode(other_data):
+    """
+    reads the jacobian key of the other data.
+
+    :param other_data: dict, as read by read_otherdata_configfile
+    :return: str 'analytic' (default) or 'numeric'
+    """
+    mode = str((other_data or {}).get('jacobian', 'analytic')).strip().lower()
+    if mode not in JACOBIAN_MODES:
+        raise ValueError(f'Unknown jacobian {mode}, use one of {JACOBIAN_MODES}')
+    return mode
+
+
+def _is_sum(model):
+    """
+    True if the model is a single component or a sum of components (the operators can be anything in lmfit).
+    """
+    if not hasattr(model, 'op'):
+        return True
+    return model.op is operator.add and _is_sum(model.left) and _is_sum(model.right)
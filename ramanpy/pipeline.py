@@ -0,0 +1,132 @@
+from .generic_fit_class import GenericFit
+
+# name of each stage and the method doing it, the same for GenericFit and SpectrumBatch
+STAGE_METHODS = {
+    'despike': 'apply_despike',
+    'smooth': 'apply_smoothing',
+    'baseline': 'apply_baseline',
+    'normalize': 'apply_normalize',
+    'resample': 'apply_resample',
+    'crop': 'apply_roi',
+    'decimate': 'apply_decimation',
+}
+
+# order used when the config file does not give one
+DEFAULT_STAGES = ('despike', 'smooth', 'baseline', 'normalize', 'crop', 'decimate')
+
+# stages selecting points of x, they do not take a dtype
+SELECTION_STAGES = ('crop', 'decimate')
+
+
+class Pipeline:
+    """
+    Preprocessing declared once (usually from the [other data] of the peaks file) and applied to one spectrum
+    (RamanFit, XRDFit) or to a whole SpectrumBatch, which have the same apply_ methods.
+
+    Each stage takes its settings from the other_data of the spectrum, and does nothing if it is not enabled
+    there (e.g. baseline = none), so the default pipeline only smooths and normalizes as the runners did.
+    The stages work in place when they can: the normalization and the baseline removal write into the array
+    produced by the previous stage instead of allocating a new one.
+
+    The pipeline is lazy in two ways:
+
+    - attach sets it on a spectrum built with lazy=True: it runs when the file is read (on the first access to x or
+      y), and again if the data are released and read again.
+    - map applies it to each element of an iterable (e.g. SpectrumBatch.iter_from_export) only when it is consumed.
+
+    Example in the peaks file:
+
+        [other data]
+        pipeline = despike, smooth, baseline, normalize
+        despike = diff
+        baseline = als
+
+    Attributes
+    ----------
+    stages: tuple
+        names of the stages, in order. See STAGE_METHODS.
+    dtype: numpy dtype
+        precision of the intensities (e.g. np.float32), None to keep the one of the data
+    """
+
+    def __init__(self, stages=DEFAULT_STAGES, dtype=None):
+        """
+
+        :param stages: list of names of stages, see STAGE_METHODS
+        :param dtype: precision of the intensities, as they are if None
+        """
+        unknown = [stage for stage in stages if stage not in STAGE_METHODS]
+        if unknown:
+            raise ValueError(f'Unknown stages {unknown}, use {list(STAGE_METHODS)}')
+        self.stages = tuple(stages)
+        self.dtype = dtype
+
+    def __repr__(self):
+        return f'Pipeline({list(self.stages)})'
+
+    @classmethod
+    def from_other_data(cls, other_data, dtype=None):
+        """
+        Alternate constructor from the other data of the peaks file, with the stages given by pipeline.
+
+        :param other_data: dict, as read by read_otherdata_configfile
+        :param dtype: precision of the intensities, see Pipeline
+        :return: Pipeline
+        """
+        stages = other_data.get('pipeline', DEFAULT_STAGES) if other_data else DEFAULT_STAGES
+        if isinstance(stages, str):  # ConfigObj gives a str for a single value
+            stages = [stages]
+        return cls([stage.strip().lower() for stage in stages], dtype=dtype)
+
+    @classmethod
+    def from_config_file(cls, config_file, default_config_file='raman_linear_carbon.ini', dtype=None):
+        """
+        Alternate constructor from a peaks file.
+
+        :param config_file: str name of the peaks file
+        :param default_config_file: str peaks file of ramanpy used if config_file has no [other data]
+        :param dtype: precision of the intensities, see Pipeline
+        :return: Pipeline
+        """
+        return cls.from_other_data(GenericFit.read_otherdata_configfile(config_file, default_config_file),
+                                   dtype=dtype)
+
+    def apply(self, target):
+        """
+        Runs all the stages on a spectrum or on a batch.
+
+        :param target: GenericFit (RamanFit, XRDFit) or SpectrumBatch
+        :return: target, modified in place
+        """
+        for stage in self.stages:
+            method = getattr(target, STAGE_METHODS[stage])
+            if stage in SELECTION_STAGES:
+                method()
+            else:  # converted by the first stage, then the array is already in that precision
+                method(dtype=self.dtype)
+        return target
+
+    __call__ = apply
+
+    def attach(self, target):
+        """
+        Sets the pipeline on a spectrum, to be run when its data are read (see GenericFit.load_data).
+        If the data are already loaded, it is run now.
+
+        :param target: GenericFit
+        :return: target
+        """
+        target.pipeline = self
+        if target._loaded:
+            self.apply(target)
+        return target
+
+    def map(self, targets):
+        """
+        Generator applying the pipeline to each spectrum or batch when it is consumed.
+
+        :param targets: iterable of GenericFit or SpectrumBatch
+        :return: generator of the processed targets
+        """
+        for target in targets:
+            yield self.apply(target)
@@ -0,0 +1,811 @@
+"""
+Vectorized preprocessing of spectra.
+All the functions work on a 1D spectrum or on a 2D batch of spectra of shape (n_spectra, n_points),
+the operations are applied along the last axis.
+"""
+from functools import lru_cache
+
+import numpy as np
+from scipy import fft
+from scipy.integrate import trapezoid
+from scipy.interpolate import CubicSpline
+from scipy.linalg import solveh_banded
+from scipy.signal import savgol_coeffs, savgol_filter
+
+NORMALIZATION_MODES = ('minmax', 'max', 'area', 'l2', 'snv')
+BASELINE_METHODS = ('als', 'snip')
+DESPIKE_METHODS = ('diff', 'neighbours')
+ROI_MODES = ('tolerance', 'sigma')
+RESAMPLE_KINDS = ('linear', 'cubic')
+DECIMATION_MODES = ('curvature', 'peaks', 'both')
+INITIAL_GUESS_MODES = ('peaks',)
+
+# from this number of spectra, the asymmetric least squares solve all the spectra together
+ALS_BATCH_THRESHOLD = 256
+
+# above this window, the convolution of the smoothing is done with FFTs instead of directly
+FFT_WINDOW_THRESHOLD = 41
+
+# fraction of the area of a lorentzian within one FWHM of its center, (2 / pi) arctan(2)
+LORENTZIAN_AREA_FRACTION = 2 / np.pi * np.arctan(2)
+
+
+@lru_cache(maxsize=32)
+def savgol_coefficients(window_size, poly_order):
+    """
+    Savitzky-Golay convolution coefficients, cached since the same window is used for all the spectra.
+
+    :param window_size: int odd length of the window
+    :param poly_order: int order of the polynomial
+    :return: 1D read-only array of length window_size
+    """
+    coefficients = savgol_coeffs(window_size, poly_order)
+    coefficients.flags.writeable = False
+    return coefficients
+
+
+@lru_cache(maxsize=32)
+def _savgol_spectrum(window_size, poly_order, n_fft, dtype):
+    """
+    real FFT of the Savitzky-Golay coefficients padded to n_fft points, cached as the coefficients.
+    """
+    spectrum = fft.rfft(savgol_coefficients(window_size, poly_order).astype(dtype), n_fft)
+    spectrum.flags.writeable = False
+    return spectrum
+
+
+def smooth_spectra(intensity_data, window_size=15, poly_order=3, method='auto'):
+    """
+    Savitzky-Golay smoothing of one spectrum or of a whole batch in a single vectorized call.
+    The edges are treated as scipy's savgol_filter (mode interp), so all the methods give the same result.
+
+    :param intensity_data: 1D or 2D array (n_spectra, n_points)
+    :param window_size: int odd length of the window
+    :param poly_order: int order of the polynomial
+    :param method: 'savgol' direct convolution (scipy savgol_filter), 'fft' FFT convolution of all the spectra
+                   with the cached coefficients (faster for long windows), 'auto' picks one from the window size
+    :return: array of the same shape and precision (float32 or float64) as the input
+    """
+    window_size = int(window_size)
+    poly_order = int(poly_order)
+    intensity_data = np.asarray(intensity_data)
+    if method == 'auto':
+        method = 'fft' if window_size > FFT_WINDOW_THRESHOLD else 'savgol'
+
+    if method == 'savgol' or intensity_data.shape[-1] <= window_size:
+        return savgol_filter(intensity_data, window_length=window_size, polyorder=poly_order, axis=-1)
+    if method != 'fft':
+        raise ValueError(f'Unknown smoothing method {method}, use savgol, fft or auto')
+
+    dtype = intensity_data.dtype if intensity_data.dtype in (np.float32, np.float64) else np.dtype(np.float64)
+    n_points = intensity_data.shape[-1]
+    n_fft = fft.next_fast_len(n_points + window_size - 1, real=True)
+    half_window = window_size // 2
+
+    smoothed = np.empty(intensity_data.shape, dtype=dtype)
+    convolved = fft.irfft(fft.rfft(intensity_data.astype(dtype, copy=False), n_fft, axis=-1)
+                          * _savgol_spectrum(window_size, poly_order, n_fft, dtype), n_fft, axis=-1)
+    smoothed[..., half_window:-half_window] = convolved[..., window_size - 1:n_points]
+    # the edges, polynomial fit of the first and last windows as in savgol_filter(mode='interp')
+    smoothed[..., :half_window] = savgol_filter(intensity_data[..., :window_size], window_size, poly_order,
+                                                axis=-1)[..., :half_window]
+    smoothed[..., -half_window:] = savgol_filter(intensity_data[..., -window_size:], window_size, poly_order,
+                                                 axis=-1)[..., -half_window:]
+    return smoothed
+
+
+def normalization_mode(other_data):
+    """
+    Normalization selected with _normalize_data in other_data.
+    True (the default) is the min-max normalization, False or none disables it, otherwise one of
+    NORMALIZATION_MODES (vector is accepted for l2).
+
+    :param other_data: dict, as read from the config file (the values can be strings)
+    :return: str mode or None
+    """
+    mode = other_data.get('_normalize_data', True)
+    if isinstance(mode, (list, tuple)):
+        mode = mode[0]
+    mode = str(mode).strip().lower()
+    if mode in ('true', 'yes', '1'):
+        return 'minmax'
+    if mode in ('false', 'no', '0', 'none', ''):
+        return None
+    if mode == 'vector':
+        return 'l2'
+    if mode not in NORMALIZATION_MODES:
+        raise ValueError(f'Unknown normalization {mode}, use one of {NORMALIZATION_MODES}')
+    return mode
+
+
+def normalize_spectra(intensity_data, mode='minmax', x=None, out=None):
+    """
+    Normalization of one spectrum or of each spectrum of a batch.
+
+    - minmax: (y - min(y)) / (max(y) - min(y))
+    - max: y / max(y)
+    - area: y / trapezoidal integral of y over x (unit spacing if x is None)
+    - l2: y / sqrt(sum(y**2))
+    - snv: standard normal variate, (y - mean(y)) / std(y)
+
+    :param intensity_data: 1D or 2D array (n_spectra, n_points)
+    :param mode: str one of NORMALIZATION_MODES
+    :param x: 1D array of the x axis, used by the area mode
+    :param out: array where the result is written, it can be intensity_data itself to normalize in place.
+                A new array is allocated if None.
+    :return: out
+    """
+    intensity_data = np.asarray(intensity_data)
+    if out is None:
+        dtype = intensity_data.dtype if intensity_data.dtype in (np.float32, np.float64) else np.float64
+        out = np.empty(intensity_data.shape, dtype=dtype)
+
+    if mode == 'minmax':
+        min_intensity = np.min(intensity_data, axis=-1, keepdims=True)
+        max_intensity = np.max(intensity_data, axis=-1, keepdims=True)
+        np.subtract(intensity_data, min_intensity, out=out)
+        np.divide(out, max_intensity - min_intensity, out=out)
+    elif mode == 'max':
+        np.divide(intensity_data, np.max(intensity_data, axis=-1, keepdims=True), out=out)
+    elif mode == 'area':
+        area = trapezoid(intensity_data, x=x, axis=-1)[..., np.newaxis]
+        np.divide(intensity_data, area, out=out)
+    elif mode == 'l2':
+        np.divide(intensity_data, np.linalg.norm(intensity_data, axis=-1, keepdims=True), out=out)
+    elif mode == 'snv':
+        mean = np.mean(intensity_data, axis=-1, keepdims=True)
+        std = np.std(intensity_data, axis=-1, ddof=1, keepdims=True)
+        np.subtract(intensity_data, mean, out=out)
+        np.divide(out, std, out=out)
+    else:
+        raise ValueError(f'Unknown normalization {mode}, use one of {NORMALIZATION_MODES}')
+    return out
+
+
+def baseline_settings(other_data):
+    """
+    Baseline removal selected in other_data:
+    baseline (none, als or snip), baseline_lambda, baseline_p, baseline_iterations for als,
+    snip_half_window and snip_lls for snip.
+
+    :param other_data: dict, as read from the config file (the values can be strings)
+    :return: tuple (method or None, dict of keyword arguments of the method)
+    """
+    method = str(other_data.get('baseline', 'none')).strip().lower()
+    if method in ('none', 'false', ''):
+        return None, {}
+    if method == 'als':
+        return method, {'lam': float(other_data.get('baseline_lambda', 1e5)),
+                        'p': float(other_data.get('baseline_p', 0.01)),
+                        'n_iterations': int(other_data.get('baseline_iterations', 10))}
+    if method == 'snip':
+        return method, {'half_window': int(other_data.get('snip_half_window', 40)),
+                        'lls': str(other_data.get('snip_lls', False)).lower() in ('true', 'yes', '1')}
+    raise ValueError(f'Unknown baseline {method}, use none or one of {BASELINE_METHODS}')
+
+
+def remove_baseline(intensity_data, method='als', out=None, **kwargs):
+    """
+    Removes the baseline of one spectrum or of each spectrum of a batch.
+
+    :param intensity_data: 1D or 2D array (n_spectra, n_points)
+    :param method: str als (als_baseline) or snip (snip_baseline)
+    :param out: array where the corrected data are written, it can be intensity_data itself.
+                A new array is allocated if None.
+    :param kwargs: parameters of the method
+    :return: tuple (corrected data, baseline), with the shape and precision of intensity_data
+    """
+    if method == 'als':
+        baseline = als_baseline(intensity_data, **kwargs)
+    elif method == 'snip':
+        baseline = snip_baseline(intensity_data, **kwargs)
+    else:
+        raise ValueError(f'Unknown baseline {method}, use one of {BASELINE_METHODS}')
+    return np.subtract(intensity_data, baseline, out=out), baseline
+
+
+def als_baseline(intensity_data, lam=1e5, p=0.01, n_iterations=10):
+    """
+    Asymmetric least squares baseline (Eilers and Boelens, 2005): a smooth curve z minimizing
+    sum(w * (y - z)**2) + lam * sum(diff(z, 2)**2), with small weights p where the spectrum is above the baseline.
+
+    The system is pentadiagonal: the banded penalty is built once per (n_points, lam) and only the weights
+    change. Few spectra are solved one by one with a banded Cholesky, large batches with a banded
+    factorization vectorized over all the spectra.
+
+    :param intensity_data: 1D or 2D array (n_spectra, n_points)
+    :param lam: float smoothness of the baseline
+    :param p: float asymmetry, weight of the points above the baseline
+    :param n_iterations: int maximum number of reweightings, it stops before if the weights do not change
+    :return: baseline, array with the shape and precision of intensity_data
+    """
+    intensity_data = np.asarray(intensity_data)
+    spectra = np.atleast_2d(intensity_data).astype(np.float64, copy=False)
+    if spectra.shape[0] >= ALS_BATCH_THRESHOLD:
+        baseline = _als_batched(spectra, float(lam), float(p), int(n_iterations))
+    else:
+        baseline = np.array([_als_single(spectrum, float(lam), float(p), int(n_iterations))
+                             for spectrum in spectra])
+
+    dtype = intensity_data.dtype if intensity_data.dtype in (np.float32, np.float64) else np.float64
+    return baseline.reshape(intensity_data.shape).astype(dtype, copy=False)
+
+
+def snip_baseline(intensity_data, half_window=40, lls=False):
+    """
+    SNIP baseline (statistics-sensitive non-linear iterative peak-clipping): each point is replaced by the mean
+    of its neighbours at distance k when it is larger, for k = 1 ... half_window. All the spectra are clipped
+    together.
+
+    :param intensity_data: 1D or 2D array (n_spectra, n_points)
+    :param half_window: int largest clipping distance, about the width of the widest peak in points
+    :param lls: bool apply the log-log-square root operator before clipping, for data >= 0 with a large
+                dynamic range
+    :return: baseline, array with the shape and precision of intensity_data
+    """
+    intensity_data = np.asarray(intensity_data)
+    dtype = intensity_data.dtype if intensity_data.dtype in (np.float32, np.float64) else np.float64
+    baseline = intensity_data.astype(dtype)  # copy
+    if lls:
+        baseline = np.log(np.log(np.sqrt(baseline + 1) + 1) + 1)
+
+    n_points = baseline.shape[-1]
+    half_window = min(int(half_window), (n_points - 1) // 2)
+    buffer = np.empty_like(baseline)
+    for k in range(1, half_window + 1):
+        mean = buffer[..., :n_points - 2 * k]
+        np.add(baseline[..., :-2 * k], baseline[..., 2 * k:], out=mean)
+        mean *= 0.5
+        np.minimum(baseline[..., k:-k], mean, out=baseline[..., k:-k])
+
+    if lls:
+        baseline = (np.exp(np.exp(baseline) - 1) - 1) ** 2 - 1
+    return baseline
+
+
+@lru_cache(maxsize=8)
+def _penalty_bands(n_points, lam):
+    """
+    bands of lam * D.T @ D, with D the second difference matrix: diagonal, first and second off-diagonals.
+    """
+    diagonal = np.full(n_points, 6.0)
+    diagonal[[0, -1]] = 1
+    diagonal[[1, -2]] = 5
+    first = np.full(n_points - 1, -4.0)
+    first[[0, -1]] = -2
+    second = np.ones(n_points - 2)
+
+    bands = tuple(lam * band for band in (diagonal, first, second))
+    for band in bands:
+        band.flags.writeable = False
+    return bands
+
+
+def _als_single(spectrum, lam, p, n_iterations):
+    """
+    asymmetric least squares baseline of one spectrum, banded Cholesky at each reweighting.
+    """
+    n_points = spectrum.size
+    diagonal, first, second = _penalty_bands(n_points, lam)
+    banded = np.zeros((3, n_points))  # upper form of solveh_banded
+    banded[0, 2:] = second
+    banded[1, 1:] = first
+
+    weights = np.ones(n_points)
+    for _ in range(n_iterations):
+        banded[2] = diagonal + weights
+        baseline = solveh_banded(banded, weights * spectrum, check_finite=False)
+        new_weights = np.where(spectrum > baseline, p, 1 - p)
+        if np.array_equal(new_weights, weights):
+            break
+        weights = new_weights
+    return baseline
+
+
+def _als_batched(spectra, lam, p, n_iterations):
+    """
+    asymmetric least squares baseline of many spectra: LDL.T factorization of the pentadiagonal systems of all
+    the spectra at once, looping on the points and vectorized on the spectra.
+    """
+    n_points = spectra.shape[1]
+    diagonal, first, second = _penalty_bands(n_points, lam)
+    data = np.ascontiguousarray(spectra.T)  # (n_points, n_spectra), rows are contiguous
+    weights = np.ones_like(data)
+    pivots = np.empty_like(data)
+    lower_1 = np.zeros_like(data)  # L[i + 1, i]
+    lower_2 = np.zeros_like(data)  # L[i + 2, i]
+
+    for _ in range(n_iterations):
+        baseline = weights * data
+        for i in range(n_points):  # factorization and forward substitution
+            pivot = diagonal[i] + weights[i]
+            off_diagonal = np.full(data.shape[1], first[i]) if i < n_points - 1 else None
+            if i >= 1:
+                pivot -= lower_1[i - 1] ** 2 * pivots[i - 1]
+                baseline[i] -= lower_1[i - 1] * baseline[i - 1]
+                if off_diagonal is not None:
+                    off_diagonal -= lower_2[i - 1] * lower_1[i - 1] * pivots[i - 1]
+            if i >= 2:
+                pivot -= lower_2[i - 2] ** 2 * pivots[i - 2]
+                baseline[i] -= lower_2[i - 2] * baseline[i - 2]
+            pivots[i] = pivot
+            if off_diagonal is not None:
+                lower_1[i] = off_diagonal / pivot
+            if i < n_points - 2:
+                lower_2[i] = second[i] / pivot
+
+        baseline /= pivots
+        for i in range(n_points - 2, -1, -1):  # backward substitution
+            baseline[i] -= lower_1[i] * baseline[i + 1]
+            if i < n_points - 2:
+                baseline[i] -= lower_2[i] * baseline[i + 2]
+
+        new_weights = np.where(data > baseline, p, 1 - p)
+        if np.array_equal(new_weights, weights):
+            break
+        weights = new_weights
+    return baseline.T
+
+
+def despike_settings(other_data):
+    """
+    Cosmic-ray removal selected in other_data: despike (none, diff or neighbours), spike_threshold,
+    spike_width and spike_neighbours.
+
+    :param other_data: dict, as read from the config file (the values can be strings)
+    :return: tuple (method or None, dict of keyword arguments of the method)
+    """
+    method = str(other_data.get('despike', 'none')).strip().lower()
+    if method in ('none', 'false', ''):
+        return None, {}
+    if method not in DESPIKE_METHODS:
+        raise ValueError(f'Unknown despike {method}, use none or one of {DESPIKE_METHODS}')
+
+    kwargs = {'threshold': float(other_data.get('spike_threshold', 7 if method == 'diff' else 10))}
+    if method == 'diff':
+        kwargs['width'] = int(other_data.get('spike_width', 1))
+    else:
+        kwargs['n_neighbours'] = int(other_data.get('spike_neighbours', 8))
+    return method, kwargs
+
+
+def despike_diff(intensity_data, threshold=7, width=1):
+    """
+    Cosmic-ray spikes found with the modified z-score of the differences (Whitaker and Hayes, 2018).
+    The second difference 2 y[i] - y[i - 1] - y[i + 1] is used: a spike of one or two points stands far above
+    the noise, while it stays small on the flanks of the (much wider) Raman peaks, unlike the first difference.
+    The spikes, widened by width points on each side, are replaced by a linear interpolation between the
+    good points around them. All the spectra are processed together.
+
+    :param intensity_data: 1D or 2D array (n_spectra, n_points)
+    :param threshold: float modified z-score above which a point is a spike
+    :param width: int number of points around a detected spike also replaced
+    :return: tuple (despiked data, boolean mask of the replaced points), with the shape of intensity_data
+    """
+    intensity_data = np.asarray(intensity_data)
+    spectra = np.atleast_2d(intensity_data)
+    padded = np.pad(spectra, ((0, 0), (1, 1)), mode='reflect')
+    differences = 2 * spectra - padded[:, :-2] - padded[:, 2:]
+    median = np.median(differences, axis=-1, keepdims=True)
+    mad = np.median(np.abs(differences - median), axis=-1, keepdims=True)
+    z_score = 0.6745 * (differences - median) / np.where(mad > 0, mad, np.finfo(float).tiny)
+
+    spikes = z_score > threshold  # only upwards, cosmic rays add counts
+    for _ in range(int(width)):
+        spikes[:, 1:] |= spikes[:, :-1].copy()
+        spikes[:, :-1] |= spikes[:, 1:].copy()
+
+    despiked = _interpolate_masked(spectra, spikes)
+    return despiked.reshape(intensity_data.shape), spikes.reshape(intensity_data.shape)
+
+
+def despike_neighbours(intensity_data, neighbours, threshold=10, chunk_size=512):
+    """
+    Cosmic-ray spikes found by comparison with the spatial neighbours in a map: a point is a spike when it is
+    far above the median of the neighbouring spectra, compared to the spread of the difference over the
+    spectrum. The spikes are replaced by that median.
+
+    :param intensity_data: 2D array (n_spectra, n_points)
+    :param neighbours: int array (n_spectra, k) of indices of the neighbours, -1 for none
+                       (e.g. SpatialIndex.neighbours). Spectra without neighbours are not modified.
+    :param threshold: float number of robust standard deviations above which a point is a spike
+    :param chunk_size: int number of spectra compared at once, to bound the memory (chunk_size * k spectra)
+    :return: tuple (despiked data, boolean mask of the replaced points)
+    """
+    intensity_data = np.asarray(intensity_data)
+    neighbours = np.asarray(neighbours)
+    despiked = intensity_data.copy()
+    spikes = np.zeros(intensity_data.shape, dtype=bool)
+
+    for start in range(0, intensity_data.shape[0], chunk_size):
+        rows = slice(start, start + chunk_size)
+        chunk_neighbours = neighbours[rows]
+        valid = chunk_neighbours >= 0
+        with_neighbours = valid.any(axis=1)
+        if not with_neighbours.any():
+            continue
+
+        # the missing neighbours are nan and ignored by the median
+        stacked = intensity_data[np.where(valid, chunk_neighbours, 0)].astype(np.float64)
+        stacked[~valid] = np.nan
+        reference = np.nanmedian(stacked[with_neighbours], axis=1)
+
+        chunk = intensity_data[rows][with_neighbours]
+        residual = chunk - reference
+        deviation = np.median(np.abs(residual - np.median(residual, axis=-1, keepdims=True)), axis=-1,
+                              keepdims=True) * 1.4826
+        chunk_spikes = residual > threshold * np.where(deviation > 0, deviation, np.finfo(float).tiny)
+
+        indices = np.arange(start, min(start + chunk_size, intensity_data.shape[0]))[with_neighbours]
+        spikes[indices] = chunk_spikes
+        despiked[indices] = np.where(chunk_spikes, reference, chunk)
+    return despiked, spikes
+
+
+def _interpolate_masked(spectra, mask):
+    """
+    replaces the masked points of each row by a linear interpolation (over the index) between the closest
+    good points on each side, the nearest good point at the edges. Only the rows with masked points are copied.
+    """
+    result = spectra.copy()
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return result
+
+    masked = mask[rows]
+    n_points = spectra.shape[1]
+    index = np.broadcast_to(np.arange(n_points), masked.shape)
+    previous = np.maximum.accumulate(np.where(masked, -1, index), axis=1)
+    following = np.minimum.accumulate(np.where(masked, n_points, index)[:, ::-1], axis=1)[:, ::-1]
+    previous = np.where(previous < 0, following, previous)  # masked start
+    following = np.where(following >= n_points, previous, following)  # masked end
+    previous = np.clip(previous, 0, n_points - 1)  # rows entirely masked are kept
+    following = np.clip(following, 0, n_points - 1)
+
+    values = spectra[rows]
+    left = np.take_along_axis(values, previous, axis=1)
+    right = np.take_along_axis(values, following, axis=1)
+    span = np.where(following > previous, following - previous, 1)
+    interpolated = left + (right - left) * (index - previous) / span
+    result[rows] = np.where(masked, interpolated, values)
+    return result
+
+
+def resample_settings(other_data):
+    """
+    Resampling selected in other_data: resample_step (none by default) and resample_kind (linear or cubic).
+
+    :param other_data: dict, as read from the config file (the values can be strings)
+    :return: dict with step and kind, None if no resampling is selected
+    """
+    step = str(other_data.get('resample_step', 'none')).strip().lower()
+    if step in ('none', 'false', ''):
+        return None
+    kind = str(other_data.get('resample_kind', 'linear')).strip().lower()
+    if kind not in RESAMPLE_KINDS:
+        raise ValueError(f'Unknown resample_kind {kind}, use one of {RESAMPLE_KINDS}')
+    return {'step': float(step), 'kind': kind}
+
+
+def common_grid(x_axes, step=None):
+    """
+    Grid covering the range shared by all the spectra, with their median step.
+
+    :param x_axes: list of 1D arrays (or 2D array) with the x axis of each spectrum
+    :param step: float step of the grid, the median step of the spectra if None
+    :return: 1D array, increasing
+    """
+    x_axes = [np.asarray(x_axis, dtype=np.float64) for x_axis in x_axes]
+    lower = max(x_axis.min() for x_axis in x_axes)
+    upper = min(x_axis.max() for x_axis in x_axes)
+    if lower >= upper:
+        raise ValueError('The spectra do not have a common range of x')
+    if step is None:
+        step = np.median([np.median(np.abs(np.diff(x_axis))) for x_axis in x_axes])
+
+    n_points = int(np.floor((upper - lower) / step * (1 + 1e-12))) + 1
+    return lower + step * np.arange(n_points)
+
+
+def resample_spectra(x_axes, intensities, grid, kind='linear'):
+    """
+    Interpolates many spectra, each one with its own x axis (and number of points), onto the same grid.
+
+    The linear interpolation calls np.interp for each spectrum, writing in the preallocated result: measured on
+    a 10000 x 1024 map, it is faster than a single vectorized search over all the axes, or a sparse
+    interpolation matrix for a shared axis, since each call is already a compiled pass over the data.
+    The cubic one builds one CubicSpline per distinct x axis, for all the spectra sharing it.
+
+    :param x_axes: list of 1D arrays (or 2D array) with the x axis of each spectrum, increasing or decreasing.
+                   A single 1D array if all the spectra share the same axis (e.g. to change the grid of a batch).
+    :param intensities: list of 1D arrays (or 2D array) with the intensities, same shapes as x_axes
+    :param grid: 1D array with the common x axis, increasing
+    :param kind: 'linear' or 'cubic'
+    :return: 2D array (n_spectra, grid.size), nan where the grid is outside the range of a spectrum.
+             Float32 if all the intensities are float32, float64 otherwise.
+    """
+    grid = np.asarray(grid, dtype=np.float64)
+    if isinstance(x_axes, np.ndarray) and x_axes.ndim == 1:
+        intensities = np.atleast_2d(intensities)
+        x_axes = [x_axes] * intensities.shape[0]
+    x_axes = [np.asarray(x_axis, dtype=np.float64) for x_axis in x_axes]
+    intensities = [np.asarray(y) for y in intensities]
+    dtype = np.result_type(np.float32, *intensities)
+    # decreasing axes (as in some exports) are flipped
+    flip = [x_axis[0] > x_axis[-1] for x_axis in x_axes]
+    x_axes = [x_axis[::-1] if flipped else x_axis for x_axis, flipped in zip(x_axes, flip)]
+    intensities = [y[::-1] if flipped else y for y, flipped in zip(intensities, flip)]
+
+    resampled = np.empty((len(x_axes), grid.size))
+    if kind == 'linear':
+        for i, (x_axis, y) in enumerate(zip(x_axes, intensities)):
+            resampled[i] = np.interp(grid, x_axis, y, left=np.nan, right=np.nan)
+    elif kind == 'cubic':
+        groups = {}
+        for i, x_axis in enumerate(x_axes):
+            groups.setdefault(x_axis.tobytes(), []).append(i)
+        for indices in groups.values():
+            spline = CubicSpline(x_axes[indices[0]], np.stack([intensities[i] for i in indices]), axis=1,
+                                 extrapolate=False)
+            resampled[indices] = spline(grid)
+    else:
+        raise ValueError(f'Unknown interpolation {kind}, use linear or cubic')
+    return resampled.astype(dtype, copy=False)
+
+
+
+def roi_settings(other_data):
+    """
+    Region of interest selected in other_data: roi (none, tolerance or sigma), roi_width and roi_merge_gap.
+
+    - tolerance: the points within roi_width * peak_center_tolerance of a peak are kept (default roi_width 1.5)
+    - sigma: the points within peak_center_tolerance + roi_width * sigma of a peak (default roi_width 10, the
+      lorentzian still has about 3% of its height there)
+
+    :param other_data: dict, as read from the config file (the values can be strings)
+    :return: tuple (mode or None, roi_width, roi_merge_gap)
+    """
+    mode = str(other_data.get('roi', 'none')).strip().lower()
+    if mode in ('none', 'false', ''):
+        return None, None, None
+    if mode not in ROI_MODES:
+        raise ValueError(f'Unknown roi {mode}, use none or one of {ROI_MODES}')
+    width = float(other_data.get('roi_width', 1.5 if mode == 'tolerance' else 10))
+    return mode, width, float(other_data.get('roi_merge_gap', 0))
+
+
+def peak_windows(peaks, half_width, merge_gap=0):
+    """
+    Windows around the peaks, sorted, with the ones overlapping (or closer than merge_gap) merged.
+
+    :param peaks: list of the centers of the peaks
+    :param half_width: float or array (one per peak) half width of the windows
+    :param merge_gap: float windows separated by less than this are merged, so that the short stretches of
+                      background between close peaks are kept
+    :return: array (n_windows, 2) with the lower and upper limits of each window
+    """
+    centers = np.asarray(peaks, dtype=np.float64)
+    half_width = np.broadcast_to(np.asarray(half_width, dtype=np.float64), centers.shape)
+    order = np.argsort(centers)
+    lower = centers[order] - half_width[order]
+    upper = centers[order] + half_width[order]
+    if lower.size == 0:
+        return np.empty((0, 2))
+
+    # a window starts a new group when it begins after the end of all the previous ones (plus the gap)
+    reach = np.maximum.accumulate(upper)
+    starts = np.concatenate(([True], lower[1:] > reach[:-1] + merge_gap))
+    group = np.cumsum(starts) - 1
+    windows = np.empty((group[-1] + 1, 2))
+    windows[:, 0] = lower[starts]
+    windows[:, 1] = np.maximum.reduceat(upper, np.flatnonzero(starts))
+    return windows
+
+
+def roi_mask(x, windows):
+    """
+    :param x: 1D array with the x axis (in any order)
+    :param windows: array (n_windows, 2) of sorted, non overlapping windows, see peak_windows
+    :return: boolean array, True for the points inside a window
+    """
+    x = np.asarray(x)
+    windows = np.asarray(windows).reshape(-1, 2)
+    # index of the last window starting before each point
+    index = np.searchsorted(windows[:, 0], x, side='right') - 1
+    inside = index >= 0
+    inside[inside] = x[inside] <= windows[index[inside], 1]
+    return inside
+
+
+def decimation_settings(other_data):
+    """
+    Decimation selected in other_data: decimate (none, curvature, peaks or both), decimation_factor,
+    curvature_fraction and decimation_width (see decimation_mask).
+
+    :param other_data: dict, as read from the config file (the values can be strings)
+    :return: tuple (mode or None, dict with factor, curvature_fraction and width)
+    """
+    mode = str(other_data.get('decimate', 'none')).strip().lower()
+    if mode in ('none', 'false', ''):
+        return None, {}
+    if mode not in DECIMATION_MODES:
+        raise ValueError(f'Unknown decimate {mode}, use none or one of {DECIMATION_MODES}')
+    return mode, {'factor': int(other_data.get('decimation_factor', 4)),
+                  'curvature_fraction': float(other_data.get('curvature_fraction', 0.02)),
+                  'width': float(other_data.get('decimation_width', 5))}
+
+
+def decimation_mask(x, intensity_data, factor=4, curvature_fraction=None, windows=None):
+    """
+    Points kept by a peak-preserving decimation: one point every factor points, plus all the points
+    - where the curvature (second difference over factor points) is larger than curvature_fraction times the
+      largest one of the spectrum and than 5 times its median (the noise), widened by factor points on each side
+      to keep the flanks of the peaks,
+    - inside the windows (e.g. around the configured peaks, see peak_windows).
+    For a batch the same points are kept for all the spectra (the union of the points of each one).
+
+    :param x: 1D array with the x axis
+    :param intensity_data: 1D or 2D array (n_spectra, n_points), preferably smoothed
+    :param factor: int decimation of the flat regions
+    :param curvature_fraction: float or None to ignore the curvature
+    :param windows: array (n_windows, 2) or None
+    :return: boolean array, True for the points kept
+    """
+    n_points = np.shape(x)[0]
+    step = max(int(factor), 1)
+    keep = np.zeros(n_points, dtype=bool)
+    keep[::step] = True
+    keep[-1] = True
+
+    if curvature_fraction is not None and n_points > 2 * step:
+        # second difference over the decimation step: the peaks stand out of the noise much more than with
+        # neighbouring points
+        spectra = np.atleast_2d(intensity_data)
+        curvature = np.abs(spectra[:, :-2 * step] - 2 * spectra[:, step:-step] + spectra[:, 2 * step:])
+        # above a fraction of the largest curvature, and well above the noise (the median curvature)
+        threshold = np.maximum(curvature_fraction * curvature.max(axis=-1, keepdims=True),
+                               5 * np.median(curvature, axis=-1, keepdims=True))
+        curved = np.zeros(n_points, dtype=bool)
+        curved[step:-step] = (curvature > np.where(threshold > 0, threshold, np.inf)).any(axis=0)
+        keep |= np.convolve(curved, np.ones(2 * step + 1), mode='same') > 0
+
+    if windows is not None:
+        keep |= roi_mask(x, windows)
+    return keep
+
+
+def decimation_weights(keep):
+    """
+    Weights of the points kept by a decimation, so that the residual of the decimated fit approximates the one on
+    all the points: each point stands for half of the points between its neighbours, and the weight multiplies
+    the residual before it is squared.
+
+    :param keep: boolean array, see decimation_mask
+    :return: 1D array with one weight per kept point
+    """
+    kept = np.flatnonzero(keep)
+    if kept.size < 2:
+        return np.ones(kept.size)
+    span = np.empty(kept.size)
+    span[1:-1] = (kept[2:] - kept[:-2]) / 2
+    span[0] = (kept[1] - kept[0]) / 2 + 0.5
+    span[-1] = (kept[-1] - kept[-2]) / 2 + 0.5
+    return np.sqrt(span)
+
+
+def initial_guess_settings(other_data):
+    """
+    Initial values of the peaks selected in other_data: initial_guess (none or peaks) and guess_window.
+
+    - peaks: the amplitude, center and sigma of each peak are estimated from the data (see guess_peaks), within
+      guess_window of the configured center (default peak_center_tolerance + 5 * sigma).
+
+    :param other_data: dict, as read from the config file (the values can be strings)
+    :return: tuple (mode or None, guess_window or None for the default)
+    """
+    mode = str(other_data.get('initial_guess', 'none')).strip().lower()
+    if mode in ('none', 'false', ''):
+        return None, None
+    if mode not in INITIAL_GUESS_MODES:
+        raise ValueError(f'Unknown initial_guess {mode}, use none or one of {INITIAL_GUESS_MODES}')
+    window = other_data.get('guess_window')
+    return mode, None if window is None else float(window)
+
+
+def guess_peaks(x, intensity_data, centers, tolerance, half_width, chunk_size=256):
+    """
+    Estimates the amplitude, center and sigma of lorentzian peaks from the data, for all the peaks (and all the
+    spectra) at once. For each peak:
+
+    - the local baseline is the line through the minima on each side of the configured center, within half_width,
+    - the maximum is searched within tolerance of the configured center, and gives the height,
+    - the FWHM is the distance between the crossings of half the height on each side (interpolated),
+      and sigma = FWHM / 2,
+    - the center is the centroid of the part above half the height,
+    - the amplitude is the area within one FWHM of the center, divided by the fraction of the area of a
+      lorentzian there.
+
+    :param x: 1D array (n_points,)
+    :param intensity_data: 1D or 2D array (n_spectra, n_points), preprocessed (smoothed, without spikes)
+    :param centers: list of the configured centers of the N peaks
+    :param tolerance: float, the maximum of each peak is searched within tolerance of its center
+    :param half_width: float, half width of the window of each peak
+    :param chunk_size: int, number of spectra processed together
+    :return: tuple of 3 arrays amplitude, center, sigma of shape (N,) or (n_spectra, N), nan where no peak is found
+    """
+    x = np.asarray(x, dtype=np.float64)
+    data = np.atleast_2d(np.asarray(intensity_data, dtype=np.float64))
+    offset = x - np.asarray(centers, dtype=np.float64).reshape(-1, 1)  # (N, n_points)
+    distance = np.abs(offset)
+    search, window = distance <= tolerance, distance <= half_width
+    sides = (window & (offset < 0), window & (offset > 0))
+    dx = np.gradient(x) if x.size > 1 else np.ones(1)
+
+    out = tuple(np.full((len(data), distance.shape[0]), np.nan) for _ in range(3))
+    for start in range(0, len(data), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        for array, value in zip(out, _guess_chunk(x, dx, data[chunk], search, window, sides)):
+            array[chunk] = value
+
+    if np.ndim(intensity_data) == 1:
+        return tuple(array[0] for array in out)
+    return out
+
+
+def _guess_chunk(x, dx, data, search, window, sides):
+    """
+    guess_peaks for a chunk of spectra, the arrays are (n_spectra, N, n_points).
+    """
+    n_points = x.size
+    index = np.arange(n_points)
+    spectra = data[:, np.newaxis, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # line through the minimum of each side, flat if one side is empty (peak at the end of the data)
+        ends = []
+        for side in sides:
+            lowest = np.where(side, spectra, np.inf).argmin(axis=-1)
+            ends.append((x[lowest], np.where(side.any(axis=-1), np.take_along_axis(
+                spectra, lowest[..., np.newaxis], axis=-1)[..., 0], np.nan)))
+        (x_a, y_a), (x_b, y_b) = ends
+        y_a, y_b = np.where(np.isnan(y_a), y_b, y_a), np.where(np.isnan(y_b), y_a, y_b)
+        slope = np.where(x_b > x_a, (y_b - y_a) / (x_b - x_a), 0)
+        baseline = y_a[..., np.newaxis] + slope[..., np.newaxis] * (x - x_a[..., np.newaxis])
+        signal = spectra - baseline
+        top = np.where(search, signal, -np.inf).argmax(axis=-1)
+        height = np.take_along_axis(signal, top[..., np.newaxis], axis=-1)[..., 0]
+        half = height[..., np.newaxis] / 2
+
+        below = (signal < half) | ~window
+        left = np.where(below & (index < top[..., np.newaxis]), index, -1).max(axis=-1)
+        right = np.where(below & (index > top[..., np.newaxis]), index, n_points).min(axis=-1)
+        x_left = _crossing(x, signal, half[..., 0], left, left + 1)
+        x_right = _crossing(x, signal, half[..., 0], right, right - 1)
+        fwhm = x_right - x_left
+
+        above = (index > left[..., np.newaxis]) & (index < right[..., np.newaxis])
+        weights = np.where(above, signal * dx, 0)
+        center = (weights * x).sum(axis=-1) / weights.sum(axis=-1)
+
+        core = np.abs(x - center[..., np.newaxis]) <= fwhm[..., np.newaxis]
+        area = np.where(core & window, np.maximum(signal, 0) * dx, 0).sum(axis=-1)
+        amplitude = area / LORENTZIAN_AREA_FRACTION
+
+    found = np.isfinite(y_a) & (height > 0) & (fwhm > 0) & search.any(axis=-1)
+    return (np.where(found, amplitude, np.nan), np.where(found, center, np.nan),
+            np.where(found, fwhm / 2, np.nan))
+
+
+def _crossing(x, signal, level, outside, inside):
+    """
+    x where the signal crosses level between the points outside (below the level) and inside (above), linearly
+    interpolated. Where there is no point outside (the peak reaches the end of the data), x of the last point.
+    """
+    n_points = x.size
+    missing = (outside < 0) | (outside >= n_points)
+    outside = np.clip(outside, 0, n_points - 1)
+    inside = np.clip(inside, 0, n_points - 1)
+    s_out = np.take_along_axis(signal, outside[..., np.newaxis], axis=-1)[..., 0]
+    s_in = np.take_along_axis(signal, inside[..., np.newaxis], axis=-1)[..., 0]
+    fraction = np.clip((level - s_out) / (s_in - s_out), 0, 1)
+    crossing = x[outside] + fraction * (x[inside] - x[outside])
+    return np.where(missing, x[inside], crossing)
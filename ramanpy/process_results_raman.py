@@ -4,6 +4,9 @@ import numpy as np
 import pandas as pd
 from configobj import ConfigObj
 from ramanpy import RamanFit
+from ramanpy.spatial import SpatialIndex
+from ramanpy.store import CampaignStore
+from ramanpy.tools import positions_from_header
 
 
 class ReadResultParamsFit:
@@ -31,7 +34,7 @@ class ReadResultParamsFit:
     def __init__(self, params_file, peaks_names=None):
         """
 
-        :param params_file: filename with the results of the fit
+        :param params_file: filename with the results of the fit, or a dict with its content (see CampaignStore)
         :param peaks_names: names for the peaks (D, G, etc)
         """
         # print(params_file)
@@ -91,15 +94,21 @@ class ResultsDataFrames:
             same as data_dict, but in a pandas dataframe
         peak_names: list
             list of names for the peaks
+        positions: list
+            x, y, z positions of each sample, if known without reading the experimental files (see from_store)
 
         """
 
-    def __init__(self, file_names, peaks_names=None, sample_names=None):
+    def __init__(self, file_names, peaks_names=None, sample_names=None, params=None, positions=None):
         """
 
         :param file_names: file names without "_params.txt" this will be added inside
         :param peaks_names: for the lorentzians, if not given, it will be letters
         :param sample_names: for the dataframe, if not given, it will equal to file_names
+        :param params: list of dicts with the fitted parameters of each file. If given, the _params.txt files
+                       are not read.
+        :param positions: list of x, y, z positions of each file. If given, add_xypositions does not read the
+                       experimental files.
         """
 
         self.file_names_params = [file_to_process + '_params.txt' for file_to_process in file_names]
@@ -109,13 +118,18 @@ class ResultsDataFrames:
         else:
             self.sample_names = sample_names
 
+        if params is not None:
+            self.file_names_params = params
+        self.positions = positions
+
         self.peak_names = peaks_names
 
         self.data_dict = {}
 
         for file_name_param, sample_name in zip(self.file_names_params, self.sample_names):
             print(sample_name)
-            self.data_dict[sample_name] = ReadResultParamsFit(file_name_param, peaks_names=self.peak_names).lorentzians
+            self.data_dict[sample_name] = ReadResultParamsFit(file_name_param,
+                                                              peaks_names=self.peak_names).lorentzians
 
         self.data_pandas = pd.concat({k: pd.DataFrame(v).T for k, v in self.data_dict.items()}, axis=0)
 
@@ -127,6 +141,24 @@ class ResultsDataFrames:
 
         self.unstacked = False  # dirty trick to unstack only once
 
+    @classmethod
+    def from_store(cls, store_file, peaks_names=None, indices=None):
+        """
+        Alternate constructor reading the fitted parameters and the positions from a CampaignStore,
+        instead of one _params.txt file per spectrum.
+
+        :param store_file: str name of the HDF5 file
+        :param peaks_names: for the lorentzians, if not given, it will be letters
+        :param indices: indices of the spectra to read, all of them if None
+        :return: ResultsDataFrames
+        """
+        with CampaignStore(store_file, mode='r') as store:
+            table = store.read_fit_table(indices)
+            positions = store.read_positions(indices)
+
+        return cls(list(table.index), peaks_names=peaks_names, params=list(table.to_dict(orient='index').values()),
+                   positions=list(positions))
+
     def to_csv(self, filename):
         """
         passes the current data_pandas to a dataframe. the use of unstacked is due to the inclusion of x and y positions
@@ -253,22 +285,39 @@ class ResultsDataFrames:
             dump_file.write()
         return La
 
-    def add_xypositions(self):
+    def add_xypositions(self, manifest=None):
         """
         adds the x, y position of the raman measurement to the dataframe in order to be output in table_results
+
+        :param manifest: Manifest of the experimental files. If given, the positions are taken from it
+                         instead of reading the header of each file.
         """
         x_positions = []
         y_positions = []
         self.data_pandas = self.data_pandas.unstack()
         self.unstacked = True
-        for filename in self.file_names_experiment:
-            positions = self._read_xyz(filename=filename)
+        for i, filename in enumerate(self.file_names_experiment):
+            if self.positions is not None:
+                positions = self.positions[i]
+            elif manifest is not None and filename in manifest:
+                positions = manifest.positions([filename])[0]
+            else:
+                positions = self._read_xyz(filename=filename)
             x_positions.append(positions[0])
             y_positions.append(positions[1])
 
         self.data_pandas['x(um)'] = x_positions
         self.data_pandas['y(um)'] = y_positions
 
+    def spatial_index(self):
+        """
+        KD-tree over the x, y positions of the samples. add_xypositions must have been run before.
+
+        :return: SpatialIndex labelled with the sample names, the indices are rows of data_pandas
+        """
+        positions = self.data_pandas[['x(um)', 'y(um)']].to_numpy(dtype=float)
+        return SpatialIndex(positions, labels=list(self.data_pandas.index), n_dims=2)
+
     @staticmethod
     def _read_xyz(filename):
         '''
@@ -278,13 +327,7 @@ class ResultsDataFrames:
         :return: list
         '''
         header = RamanFit.read_header(filename=filename)
-        axis = ['X', 'Y', 'Z']
-        positions = []
-        for element in axis:
-            position = float(
-                header.get(f'{element}(µm)', 'nan'))  # get the position in micrometers, otherwise put a nan.
-            positions.append(position)
-        return positions
+        return positions_from_header(header)  # get the position in micrometers, otherwise put a nan.
 
 
 def get_num(string_with_number):
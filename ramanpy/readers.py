@@ -0,0 +1,263 @@
+import io
+import tempfile
+from itertools import islice
+
+import numpy as np
+
+from .archives import is_plain_file, open_text
+
+# characters removed from the header lines, same cleanup as tools.cleanup_header but in a single pass
+_HEADER_CLEANUP = str.maketrans('', '', '#\n\t ')
+
+
+def parse_header_line(line):
+    """
+    Cleans up one header line and splits it into key and value.
+
+    :param line: str line of the header, starting with #
+    :return: tuple (key, value) or None if the line does not contain an =
+    Example:
+    >>> parse_header_line('#X (µm)=\\t12.5\\n')
+    ('X(µm)', '12.5')
+
+    """
+    line = line.translate(_HEADER_CLEANUP)
+    if '=' not in line:
+        return None
+    key, value = line.split('=', 1)
+    return key, value
+
+
+def read_header(filename):
+    """
+    Reads only the header of a file whose comments start with #. The file is closed as soon as the
+    first line of data is found. As for all the readers here, the file can be compressed or in an archive
+    (see ramanpy.archives).
+
+    :param filename: str name of file
+    :return: dict with the header
+    """
+    header = {}
+    with open_text(filename) as fh:
+        for line in fh:
+            if not line.startswith('#'):
+                break
+            item = parse_header_line(line)
+            if item is not None:
+                header[item[0]] = item[1]
+    return header
+
+
+def _read_header_lines(fh):
+    """
+    Reads the # lines at the current position of an open file.
+
+    :param fh: file handle in text mode
+    :return: header dict, and the first line which is not part of the header ('' at the end of the file)
+    """
+    header = {}
+    for line in fh:
+        if not line.startswith('#'):
+            return header, line
+        item = parse_header_line(line)
+        if item is not None:
+            header[item[0]] = item[1]
+    return header, ''
+
+
+def _parse_values(text, n_columns, name, dtype=np.float64):
+    """
+    Parses a block of numeric text into an array of shape (n_rows, n_columns).
+    A value which is not a number, or a line without n_columns values, raises a ValueError instead of giving
+    truncated data.
+
+    :param text: str with numbers separated by spaces, tabs or newlines
+    :param n_columns: int number of columns
+    :param name: str used in the error message
+    :param dtype: numpy dtype of the output
+    :return: 2D array
+    """
+    if not text.strip():
+        return np.empty((0, n_columns), dtype=dtype)
+
+    # comments in the middle of the data are stripped, as read_csv(comment='#') does
+    try:
+        values = np.loadtxt(io.StringIO(text), dtype=dtype, comments='#', ndmin=2)
+    except ValueError as error:
+        raise ValueError(f'{name}: {error}') from None
+    if values.shape[1] != n_columns:
+        raise ValueError(f'{name}: {values.shape[1]} columns, expected {n_columns}')
+    return values
+
+
+def read_columns(filename, n_columns=2, dtype=np.float64):
+    """
+    Single pass parser for text spectra: a header with lines starting with # followed by numeric columns
+    separated by tabs or spaces. The header and the data are read with the same file handle.
+
+    :param filename: str name of file
+    :param n_columns: int number of numeric columns in the file
+    :param dtype: numpy dtype of the output
+    :return: header dict, and an array of shape (n_columns, n_points), each row is contiguous in memory
+    """
+    with open_text(filename) as fh:
+        header, first_data_line = _read_header_lines(fh)
+        body = first_data_line + fh.read()
+
+    values = _parse_values(body, n_columns, filename, dtype=dtype)
+
+    # transpose and copy so that each column ends up contiguous
+    values = np.ascontiguousarray(values.T)
+    return header, values
+
+
+def read_spectrum(filename):
+    """
+    Reads a two column spectrum (x, y) and its header in one pass.
+
+    :param filename: str name of file
+    :return: header dict, x and y as contiguous 1D arrays
+    """
+    header, values = read_columns(filename, n_columns=2)
+    return header, values[0], values[1]
+
+
+def read_whitespace_columns(filename, skip_rows=None, dtype=np.float64):
+    """
+    Vectorized reader for whitespace separated numeric files such as the XRD formats .xy (angle, intensity)
+    and .xye (angle, intensity, error). The number of columns is taken from the first line of data.
+
+    :param filename: str name of file
+    :param skip_rows: int number of lines to skip at the beginning. If None, the leading lines that are not
+                      numeric (titles, # comments, empty lines) are skipped, and also the first numeric line if
+                      it does not have the number of columns of the next one (e.g. start, step and time of the
+                      scan in a .xy file).
+    :param dtype: numpy dtype of the output
+    :return: array of shape (n_columns, n_points), each row is contiguous in memory
+    """
+    # only the first lines are read here to find where the data starts, the parsing is done by loadtxt (C parser)
+    with open_text(filename) as fh:
+        n_skipped = 0
+        first_data_line = ''
+        for i, line in enumerate(fh):
+            if skip_rows is not None:
+                if i >= skip_rows and not line.startswith('#') and line.strip():
+                    first_data_line, n_skipped = line, i
+                    break
+            elif _is_numeric_line(line):
+                if not first_data_line:  # the next numeric line tells if it is data or a numeric title
+                    first_data_line, n_skipped = line, i
+                    continue
+                if _count_fields(line) != _count_fields(first_data_line):
+                    first_data_line, n_skipped = line, i
+                break
+
+    n_columns = _count_fields(first_data_line)
+    if n_columns == 0:
+        raise ValueError(f'{filename}: no data found')
+    if is_plain_file(filename):
+        values = np.loadtxt(filename, skiprows=n_skipped, comments='#', dtype=dtype, ndmin=2, encoding='latin-1')
+    else:  # compressed or in an archive, loadtxt reads the open stream
+        with open_text(filename) as fh:
+            values = np.loadtxt(fh, skiprows=n_skipped, comments='#', dtype=dtype, ndmin=2)
+    if values.shape[1] != n_columns:
+        raise ValueError(f'{filename}: expected {n_columns} columns, found {values.shape[1]}')
+    return np.ascontiguousarray(values.T)
+
+
+def _count_fields(line):
+    """
+    number of values of a line, without comments.
+    """
+    return len(line.split('#', 1)[0].split())
+
+
+def _is_numeric_line(line):
+    """
+    True if the line (without comments) contains only numbers.
+
+    :param line: str
+    :return: bool
+    """
+    fields = line.split('#', 1)[0].split()
+    if not fields:
+        return False
+    try:
+        [float(field) for field in fields]
+    except ValueError:
+        return False
+    return True
+
+
+def iter_column_blocks(filename, block_size=64, chunk_lines=4096, tmp_dir=None):
+    """
+    Generator over the spectra of a wide export file: one x column followed by N intensity columns,
+    one row per x point. The spectra are yielded in blocks of block_size.
+
+    The text is parsed only once, chunk_lines rows at a time, and transposed into a temporary binary file,
+    so the memory used is bounded by the chunk and the block, not by the size of the export.
+
+    :param filename: str name of file
+    :param block_size: int number of spectra per block
+    :param chunk_lines: int number of rows parsed at once
+    :param tmp_dir: folder for the temporary file, default one of the system if None
+    :return: generator of (index of the first spectrum of the block, x, y) with y of shape (k, n_points)
+    """
+    with open_text(filename) as fh:
+        _, first_data_line = _read_header_lines(fh)
+        n_columns = len(first_data_line.split())
+        n_points = 1 + sum(1 for line in fh if line.strip() and not line.startswith('#'))
+    if n_columns < 2:
+        raise ValueError(f'{filename}: at least two columns are needed')
+    n_spectra = n_columns - 1
+
+    x = np.empty(n_points)
+    with tempfile.TemporaryFile(dir=tmp_dir) as spool_file:
+        spool = np.memmap(spool_file, dtype=np.float64, mode='w+', shape=(n_spectra, n_points))
+
+        with open_text(filename) as fh:
+            _, first_data_line = _read_header_lines(fh)
+            row = 0
+            lines = [first_data_line]
+            while lines:
+                lines.extend(islice(fh, chunk_lines))
+                values = _parse_values(''.join(lines), n_columns, filename)
+                x[row:row + values.shape[0]] = values[:, 0]
+                spool[:, row:row + values.shape[0]] = values[:, 1:].T
+                row += values.shape[0]
+                lines = list(islice(fh, chunk_lines))
+
+        for start in range(0, n_spectra, block_size):
+            yield start, x, np.array(spool[start:start + block_size])
+        del spool
+
+
+def iter_stacked_spectra(filename):
+    """
+    Generator over the spectra of an export file with stacked blocks: each spectrum is a two column block (x, y),
+    separated from the next one by its # header lines or by an empty line.
+    Only one spectrum is in memory at a time.
+
+    :param filename: str name of file
+    :return: generator of (header dict, x, y)
+    """
+    def make_spectrum(header, lines):
+        values = _parse_values(''.join(lines), 2, filename)
+        return header, np.ascontiguousarray(values[:, 0]), np.ascontiguousarray(values[:, 1])
+
+    header = {}
+    lines = []
+    with open_text(filename) as fh:
+        for line in fh:
+            if line.startswith('#') or not line.strip():
+                if lines:  # end of the current block
+                    yield make_spectrum(header, lines)
+                    header = {}
+                    lines = []
+                item = parse_header_line(line)
+                if item is not None:
+                    header[item[0]] = item[1]
+            else:
+                lines.append(line)
+    if lines:
+        yield make_spectrum(header, lines)
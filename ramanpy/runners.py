@@ -1,4 +1,4 @@
-from ramanpy import RamanFit, XRDFit
+from ramanpy import Pipeline, RamanFit, XRDFit
 
 
 def raman_fit_carbon(file_to_analyze, file_peaks):
@@ -16,11 +16,11 @@ def raman_fit_carbon(file_to_analyze, file_peaks):
     default_peaks_file = 'raman_linear_carbon.ini'
 
     peaks = RamanFit.read_peaks_configfile(file_peaks, default_peaks_file=default_peaks_file)
-    other_data = RamanFit.read_otherdata_configfile(file_peaks)
+    other_data = RamanFit.read_otherdata_configfile(file_peaks, default_config_file=default_peaks_file)
     raman_carbon = RamanFit(file_to_analyze=file_to_analyze, peaks=peaks, other_data=other_data)
 
-    raman_carbon.apply_smoothing()
-    raman_carbon.apply_normalize()
+    # preprocessing stages given by pipeline in the peaks file (smoothing and normalization by default)
+    Pipeline.from_other_data(other_data).apply(raman_carbon)
     raman_carbon.set_tolerances_fit()
     raman_carbon.build_fitting_model_peaks()
     raman_carbon.run_fit_model()
@@ -46,8 +46,7 @@ def xrd_fit_carbon(file_to_analyze, file_peaks):
     other_data = XRDFit.read_otherdata_configfile(file_peaks,default_config_file=default_peaks_file)
     xrd_carbon = XRDFit(file_to_analyze=file_to_analyze, peaks=peaks, other_data=other_data)
 
-    xrd_carbon.apply_smoothing()
-    xrd_carbon.apply_normalize()
+    Pipeline.from_other_data(other_data).apply(xrd_carbon)
     xrd_carbon.set_tolerances_fit()
     xrd_carbon.build_fitting_model_peaks()
     xrd_carbon.run_fit_model()
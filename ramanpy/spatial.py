@@ -0,0 +1,223 @@
+import numpy as np
+from matplotlib.path import Path as PolygonPath
+from scipy.spatial import cKDTree
+
+# orders in which the spectra of a map can be visited, see SpatialIndex.visit_order
+VISIT_ORDERS = ('raster', 'snake', 'hilbert')
+
+
+class SpatialIndex:
+    """
+    KD-tree over the positions of the measurements, to select spectra by location without scanning all of them.
+    The queries return the indices of the spectra (rows of the positions given), which can be used directly
+    with SpectrumBatch.subset, or to pick files from a Manifest before loading them.
+    Measurements without position (nan) are never returned.
+
+    Attributes
+    ----------
+    positions: 2D array
+        positions used in the index, shape (n_spectra, n_dims), in µm
+    labels: list
+        optional names of the spectra (e.g. filenames), same order as positions
+    tree: cKDTree
+        tree built with the valid positions only
+    """
+
+    def __init__(self, positions, labels=None, n_dims=2):
+        """
+
+        :param positions: array (n_spectra, >= n_dims) with X, Y(, Z) positions
+        :param labels: list of names of the spectra
+        :param n_dims: int number of coordinates used, 2 for X, Y maps, 3 to include Z
+        """
+        self.positions = np.asarray(positions, dtype=float)[:, :n_dims]
+        self.labels = labels
+        self._valid = np.flatnonzero(np.all(np.isfinite(self.positions), axis=1))
+        self.tree = cKDTree(self.positions[self._valid])
+
+    def __len__(self):
+        return self.positions.shape[0]
+
+    def within_radius(self, point, radius):
+        """
+        All the spectra at a distance smaller or equal than radius from a point.
+
+        :param point: coordinates (n_dims) or int index of a spectrum
+        :param radius: float in µm
+        :return: sorted array of indices
+        """
+        found = self.tree.query_ball_point(self._as_point(point), r=radius)
+        return np.sort(self._valid[np.asarray(found, dtype=int)])
+
+    def nearest(self, point, k=1, exclude_self=True):
+        """
+        k nearest spectra to a point.
+
+        :param point: coordinates (n_dims) or int index of a spectrum
+        :param k: int number of neighbours
+        :param exclude_self: bool, when point is an index, do not return the spectrum itself
+        :return: array of indices sorted by distance, and array with the distances
+        """
+        skip = exclude_self and isinstance(point, (int, np.integer))
+        k_query = min(k + skip, self.tree.n)
+        distances, found = self.tree.query(self._as_point(point), k=k_query)
+        distances, found = np.atleast_1d(distances), self._valid[np.atleast_1d(found)]
+        if skip:
+            keep = found != point
+            distances, found = distances[keep], found[keep]
+        return found[:k], distances[:k]
+
+    def neighbours(self, k=8):
+        """
+        k nearest neighbours of every spectrum, in a single query of the tree.
+
+        :param k: int number of neighbours
+        :return: int array (n_spectra, k) sorted by distance, -1 where there is no neighbour
+                 (spectra without position, or less than k + 1 valid positions)
+        """
+        result = np.full((len(self), k), -1, dtype=int)
+        k_query = min(k + 1, self.tree.n)
+        if k_query < 2:
+            return result
+
+        _, found = self.tree.query(self.positions[self._valid], k=k_query)
+        found = self._valid[found]
+        # drop the spectrum itself (not always the first one if several share a position)
+        is_self = found == self._valid[:, np.newaxis]
+        order = np.argsort(is_self, axis=1, kind='stable')
+        found = np.take_along_axis(found, order, axis=1)[:, :k_query - 1]
+        result[self._valid, :found.shape[1]] = found
+        return result
+
+    def in_box(self, lower, upper):
+        """
+        All the spectra inside an axis aligned box.
+
+        :param lower: coordinates of the lower corner
+        :param upper: coordinates of the upper corner
+        :return: sorted array of indices
+        """
+        lower = np.asarray(lower, dtype=float)
+        upper = np.asarray(upper, dtype=float)
+        # the box is inside the ball around its centre, the tree gives the candidates
+        candidates = self.within_radius((lower + upper) / 2, np.linalg.norm(upper - lower) / 2)
+        inside = np.all((self.positions[candidates] >= lower) & (self.positions[candidates] <= upper), axis=1)
+        return candidates[inside]
+
+    def in_polygon(self, vertices):
+        """
+        All the spectra inside a polygon in the X, Y plane.
+
+        :param vertices: array (n_vertices, 2) with the corners of the polygon
+        :return: sorted array of indices
+        """
+        vertices = np.asarray(vertices, dtype=float)
+        lower, upper = vertices.min(axis=0), vertices.max(axis=0)
+        if self.positions.shape[1] == 2:
+            candidates = self.in_box(lower, upper)
+        else:  # Z is not constrained, the box would be infinite for the tree
+            candidates = self._in_xy_box(lower, upper)
+        inside = PolygonPath(vertices).contains_points(self.positions[candidates, :2])
+        return candidates[inside]
+
+    def grid(self):
+        """
+        row and column of each spectrum on the grid of the map. Positions closer than half the typical step of the
+        map (median distance to the nearest neighbour) along Y (X) are in the same row (column), so small jitters
+        of the stage do not create extra rows. The rows and columns are numbered from 0.
+
+        :return: int arrays row, column of length n_spectra, -1 for the spectra without position
+        """
+        row = np.full(len(self), -1, dtype=int)
+        column = np.full(len(self), -1, dtype=int)
+        if self.tree.n == 0:
+            return row, column
+
+        xy = self.positions[self._valid, :2]
+        step = 0.0
+        if self.tree.n > 1:
+            distances = self.tree.query(self.tree.data, k=2)[0][:, 1]
+            distances = distances[distances > 0]
+            step = np.median(distances) if distances.size else 0.0
+        for axis, out in ((1, row), (0, column)):
+            # distinct rows (columns) are separated by more than half a step, jitters by less
+            order = np.argsort(xy[:, axis], kind='stable')
+            number = np.concatenate([[0], np.cumsum(np.diff(xy[order, axis]) > step / 2)])
+            out[self._valid[order]] = number
+        return row, column
+
+    def visit_order(self, order='hilbert'):
+        """
+        Order in which to visit the spectra so that each one is close to the previous ones, e.g. to start each
+        fit from the results of its neighbours.
+
+        - raster: row by row, each row from left to right.
+        - snake: row by row, every other row from right to left, so two consecutive spectra are always neighbours.
+        - hilbert: along a Hilbert curve over the grid, which keeps the visited spectra in compact blocks.
+
+        :param order: str raster, snake or hilbert
+        :return: array with the indices of all the spectra, the ones without position at the end
+        """
+        if order not in VISIT_ORDERS:
+            raise ValueError(f'Unknown order {order}, use one of {VISIT_ORDERS}')
+        row, column = self.grid()
+        row, column = row[self._valid], column[self._valid]
+        if order == 'raster':
+            key = np.lexsort((column, row))
+        elif order == 'snake':
+            key = np.lexsort((np.where(row % 2, -column, column), row))
+        else:
+            key = np.argsort(hilbert_index(row, column), kind='stable')
+        missing = np.setdiff1d(np.arange(len(self)), self._valid)
+        return np.concatenate([self._valid[key], missing])
+
+    def labels_of(self, indices):
+        """
+        :param indices: array of indices, as returned by the queries
+        :return: list with the labels of those spectra
+        """
+        return [self.labels[i] for i in indices]
+
+    def _in_xy_box(self, lower, upper):
+        """
+        spectra inside a box in the X, Y plane, whatever their Z.
+        """
+        xy = self.positions[self._valid, :2]
+        inside = np.all((xy >= lower) & (xy <= upper), axis=1)
+        return self._valid[inside]
+
+    def _as_point(self, point):
+        """
+        coordinates of a point given as coordinates or as the index of a spectrum.
+        """
+        if isinstance(point, (int, np.integer)):
+            return self.positions[point]
+        return np.asarray(point, dtype=float)
+
+
+def hilbert_index(row, column):
+    """
+    Position along a Hilbert curve of points of a grid (vectorized version of the classic xy2d algorithm).
+
+    :param row: int array of rows
+    :param column: int array of columns
+    :return: int array, the distance along the curve of each point
+    """
+    x, y = np.array(column, dtype=np.int64), np.array(row, dtype=np.int64)
+    n = 1
+    while n <= max(x.max(initial=0), y.max(initial=0)):
+        n *= 2
+
+    distance = np.zeros(x.shape, dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        distance += s * s * ((3 * rx) ^ ry)
+        # rotation of the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return distance
@@ -1,8 +1,11 @@
-import os
 from itertools import takewhile
 
+import numpy as np
 import pandas as pd
+from .archives import file_extension, open_text, output_name
+from .cache import read_cached
 from .generic_fit_class import GenericFit
+from .readers import read_columns, read_whitespace_columns
 from .tools import cleanup_header
 from scipy.signal import detrend
 
@@ -23,27 +26,78 @@ class RamanFit(GenericFit):
         data y, in this case, intensity
 
     """
+    var_x = 'Wavenumber, cm$^{-1}$'  # for plots
+    var_y = 'Intensity, -'
 
-    def __init__(self, file_to_analyze, peaks, other_data=None, folder_out=None):
-        experimental_data, metadata = self.read_data_raman(file_to_analyze)
-        super().__init__(experimental_data=experimental_data, peaks=peaks, other_data=other_data, folder_out=folder_out)
+    def __init__(self, file_to_analyze, peaks, other_data=None, folder_out=None, cache_dir=None, dtype=None,
+                 lazy=False):
+        """
+
+        :param file_to_analyze: str name of the file
+        :param peaks: list of peaks to be retrieved
+        :param other_data: if needed
+        :param folder_out: str folder where report will be saved.
+        :param cache_dir: folder of the binary cache (see SpectrumCache)
+        :param dtype: precision of the intensities, as read if None
+        :param lazy: bool, if True the file is only read on the first access to experimental_data, x or y
+        """
+        super().__init__(peaks=peaks, other_data=other_data, folder_out=folder_out)
+
+        self._source = {'file_to_analyze': file_to_analyze, 'cache_dir': cache_dir, 'dtype': dtype}
+        self.filename = output_name(file_to_analyze)  # remove the extension
+        if not lazy:
+            self.load_data()
 
-        self.var_x = 'Wavenumber, cm$^{-1}$'  # for plots
-        self.var_y = 'Intensity, -'
-        self.x = self.experimental_data['wavenumber'].values
-        self.y = self.experimental_data['intensity'].values
-        self.filename = file_to_analyze.split(".")[0]  # remove the extension
+    def _read_source(self):
+        """
+        reads the file given to the constructor.
+        """
+        experimental_data, metadata = self.read_data_raman(self._source['file_to_analyze'],
+                                                           cache_dir=self._source['cache_dir'])
+        self.experimental_data = experimental_data
+        self.x = experimental_data['wavenumber'].values
+        self.y = self._as_dtype(experimental_data['intensity'].values, self._source['dtype'])
 
     @staticmethod
-    def read_data_raman(file_to_analyze):
+    def read_data_raman(file_to_analyze, cache_dir=None, engine='numpy'):
         """
         read data and put in a dataframe, and metadata
         :param file_to_analyze: filename
+        :param cache_dir: folder of the binary cache (see SpectrumCache). None to always parse the text file.
+        :param engine: 'numpy' for the single pass parser of ramanpy.readers (default),
+                       'pandas' for the read_csv based reader_single_point.
         :return: pandas df and metadata
         """
-        data, metadata = RamanFit.reader_single_point(file_to_analyze)
+        if engine == 'pandas':
+            return RamanFit.reader_single_point(file_to_analyze, cache_dir=cache_dir)
+
+        values, metadata = read_cached(file_to_analyze, RamanFit._read_numpy_single_point, cache_dir=cache_dir)
+        data = pd.DataFrame({'wavenumber': values[0], 'intensity': values[1]}, copy=False)
         return data, metadata
 
+    @staticmethod
+    def read_xy(filename, cache_dir=None, dtype=None):
+        """
+        Reads a raman file directly into arrays, without building a dataframe.
+        :param filename: str name of file
+        :param cache_dir: folder of the binary cache, None to always parse the text file.
+        :param dtype: dtype of the intensities (e.g. np.float32 to halve the memory), as read if None.
+        :return: x (wavenumber), y (intensity) and header
+        """
+        values, header = read_cached(filename, RamanFit._read_numpy_single_point, cache_dir=cache_dir)
+        return values[0], GenericFit._as_dtype(values[1], dtype), header
+
+    @staticmethod
+    def _read_numpy_single_point(filename):
+        """
+        Parses the text file of a single point with the single pass parser.
+
+        :param filename: str name of file
+        :return: array of shape (2, n_points) with wavenumber and intensity, and the header
+        """
+        header, values = read_columns(filename, n_columns=2)
+        return values, header
+
     @staticmethod
     def read_header(filename):
         '''
@@ -51,7 +105,7 @@ class RamanFit(GenericFit):
         :param filename: str name of file
         :return: header data cleaned up
         '''
-        with open(filename, 'r', errors='ignore') as myfile:
+        with open_text(filename) as myfile:
             headiter = takewhile(lambda s: s.startswith('#'), myfile)
             header = cleanup_header(headiter)
         header = dict(element.split('=', 1) for element in header)
@@ -59,7 +113,7 @@ class RamanFit(GenericFit):
 
 
     @staticmethod
-    def reader_single_point(filename, normalize=False, remove_offset=False):
+    def reader_single_point(filename, normalize=False, remove_offset=False, cache_dir=None):
         """
         Reader for raman spectrometry files of a single location.
 
@@ -72,14 +126,17 @@ class RamanFit(GenericFit):
 
         remove_offset:bool
                 Remove linear offset using detrend from scipy. Mostly for visualization
+        cache_dir: str
+                folder of the binary cache. If given, the file is parsed only once and later reads
+                memory-map the cached array.
 
         Returns
         -------------
         data: pandas dataframe with two columns: wavenumber and intensity
         header: metadata from the measurement
         """
-        data = pd.read_csv(filename, comment='#', sep='\t', index_col=False, names=['wavenumber', 'intensity'])
-        header = RamanFit.read_header(filename=filename)
+        values, header = read_cached(filename, RamanFit._read_text_single_point, cache_dir=cache_dir)
+        data = pd.DataFrame({'wavenumber': values[0], 'intensity': values[1]}, copy=False)
         if normalize:
             data.intensity = data.intensity.apply(lambda x: x / data.intensity.max())
 
@@ -88,6 +145,19 @@ class RamanFit(GenericFit):
 
         return data, header
 
+    @staticmethod
+    def _read_text_single_point(filename):
+        """
+        Parses the text file of a single point.
+
+        :param filename: str name of file
+        :return: array of shape (2, n_points) with wavenumber and intensity, and the header
+        """
+        with open_text(filename) as fh:
+            data = pd.read_csv(fh, comment='#', sep='\t', index_col=False, names=['wavenumber', 'intensity'])
+        header = RamanFit.read_header(filename=filename)
+        return data.values.T, header
+
     def set_tolerances_fit(self):
         """
         This method tries to get the tolerances for the fit. If it does not find, will use some default ones.
@@ -125,19 +195,59 @@ class XRDFit(GenericFit):
         data y, in this case, intensity
 
     """
+    var_x = '$2-\\theta$, deg'  # for plots
+    var_y = 'Intensity, -'
 
-    def __init__(self, file_to_analyze, peaks, other_data=None, folder_out=None):
-        experimental_data, metadata = self.read_data_xrd(file_to_analyze)
-        super().__init__(experimental_data=experimental_data, peaks=peaks, other_data=other_data, folder_out=folder_out)
+    def __init__(self, file_to_analyze, peaks, other_data=None, folder_out=None, cache_dir=None, dtype=None,
+                 lazy=False):
+        """
+
+        :param file_to_analyze: str name of the file
+        :param peaks: list of peaks to be retrieved
+        :param other_data: if needed
+        :param folder_out: str folder where report will be saved.
+        :param cache_dir: folder of the binary cache (see SpectrumCache)
+        :param dtype: precision of the intensities, as read if None
+        :param lazy: bool, if True the file is only read on the first access to experimental_data, x or y
+        """
+        super().__init__(peaks=peaks, other_data=other_data, folder_out=folder_out)
 
-        self.var_x = '$2-\\theta$, deg'
-        self.var_y = 'Intensity, -'
-        self.x = self.experimental_data['angle'].values
-        self.y = self.experimental_data['intensity'].values
-        self.filename = file_to_analyze.split(".")[0]  # remove the extension
+        self._source = {'file_to_analyze': file_to_analyze, 'cache_dir': cache_dir, 'dtype': dtype}
+        self.filename = output_name(file_to_analyze)  # remove the extension
+        if not lazy:
+            self.load_data()
+
+    def _read_source(self):
+        """
+        reads the file given to the constructor.
+        """
+        values, metadata = read_cached(self._source['file_to_analyze'], XRDFit._read_numpy_xrd,
+                                       cache_dir=self._source['cache_dir'])
+        self.experimental_data = XRDFit._to_dataframe(values)
+        self.x = values[0]
+        self.y = self._as_dtype(values[1], self._source['dtype'])
+        if values.shape[0] > 2 and self.uses_error_weights():
+            self.y_error = values[2]
+
+    def uses_error_weights(self):
+        """
+        True if the third column of the file is the uncertainty of the intensity, used as weights of the fit.
+        Selected with use_error_weights in other_data (true or false), by default only for the .xye files: the
+        third column of other exports (.xy, .dat) can be something else.
+
+        :return: bool
+        """
+        value = str(self.other_data.get('use_error_weights', 'auto')).strip().lower()
+        if value == 'auto':
+            return file_extension(self._source['file_to_analyze']) == '.xye'
+        if value in ('true', 'yes', '1'):
+            return True
+        if value in ('false', 'no', '0', 'none'):
+            return False
+        raise ValueError(f'Unknown use_error_weights {value}, use auto, true or false')
 
     @staticmethod
-    def read_data_xrd(filename, normalize=False):
+    def read_data_xrd(filename, normalize=False, cache_dir=None):
         """
         Reader for XRD files.
 
@@ -147,21 +257,71 @@ class XRDFit(GenericFit):
                 with filename
         normalize: bool
                 Normalize to maximum (max of the counts will be 1)
+        cache_dir: str
+                folder of the binary cache. If given, the file is parsed only once and later reads
+                memory-map the cached array.
 
         Returns
         -------------
-        data: pandas dataframe with two columns: angle and intensity
+        data: pandas dataframe with two columns: angle and intensity (and error for .xye files)
         header: metadata from the measurement
         """
-        data = pd.read_csv(filename, skiprows=1, comment='#', delim_whitespace=True,
-                           index_col=False, names=['angle', 'intensity'])
-        header = os.path.splitext(filename)[0]
+        values, header = read_cached(filename, XRDFit._read_numpy_xrd, cache_dir=cache_dir)
+        data = XRDFit._to_dataframe(values)
 
         if normalize:
             data.intensity = data.intensity.apply(lambda x: x / data.intensity.max())
 
         return data, header
 
+    @staticmethod
+    def read_xy(filename, cache_dir=None, dtype=None):
+        """
+        Reads a XRD file directly into arrays, without building a dataframe.
+        :param filename: str name of file
+        :param cache_dir: folder of the binary cache, None to always parse the text file.
+        :param dtype: dtype of the intensities (e.g. np.float32 to halve the memory), as read if None.
+        :return: x (angle), y (intensity) and header
+        """
+        values, header = read_cached(filename, XRDFit._read_numpy_xrd, cache_dir=cache_dir)
+        return values[0], GenericFit._as_dtype(values[1], dtype), header
+
+    @staticmethod
+    def read_arrays_xrd(filename, dtype=np.float64):
+        """
+        Reads a XRD file (.xy or .xye) with the vectorized reader of ramanpy.readers.
+        The leading lines that are not numeric (title of the scan, comments) are skipped, and a numeric title
+        (e.g. start, step and time of the scan) with another number of columns than the data.
+
+        :param filename: str name of file
+        :param dtype: numpy dtype of the arrays
+        :return: angle, intensity and error (None if the file has no error column)
+        """
+        values = read_whitespace_columns(filename, dtype=dtype)
+        error = values[2] if values.shape[0] > 2 else None
+        return values[0], values[1], error
+
+    @staticmethod
+    def _read_numpy_xrd(filename):
+        """
+        Parses the text file of an XRD measurement.
+
+        :param filename: str name of file
+        :return: array of shape (n_columns, n_points) with angle, intensity (and error), and the header
+        """
+        return read_whitespace_columns(filename), output_name(filename)
+
+    @staticmethod
+    def _to_dataframe(values):
+        """
+        dataframe of the experimental data, without copying the arrays.
+
+        :param values: array of shape (n_columns, n_points)
+        :return: pandas dataframe with columns angle, intensity (and error)
+        """
+        columns = dict(zip(['angle', 'intensity', 'error'], values))
+        return pd.DataFrame(columns, copy=False)
+
     def set_tolerances_fit(self):
         """
         This method tries to get the tolerances for the fit. If it does not find, will use some default ones.
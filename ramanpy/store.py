@@ -0,0 +1,263 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from .batch import SpectrumBatch
+
+SCHEMA_VERSION = 1
+
+
+class CampaignStore:
+    """
+    A single HDF5 file holding a whole measurement campaign, instead of one .txt per spectrum and one
+    _params.txt/_report per fit. Requires h5py.
+
+    Layout of the file (all the spectra share the same x axis, see SpectrumBatch):
+
+    - x: (n_points,) shared x axis
+    - raw: (n_spectra, n_points) raw intensities, chunked and compressed
+    - processed: (n_spectra, n_points) intensities after smoothing, normalization... (optional)
+    - names: (n_spectra,) names of the spectra
+    - headers: (n_spectra,) headers of the files, as json strings
+    - positions: (n_spectra, 3) X, Y, Z in µm
+    - fit/values and fit/stderr: (n_spectra, n_params) fitted parameters, nan if not fitted.
+      The names of the parameters are in the attribute params of the group fit.
+
+    Attributes
+    ----------
+    filename: str
+        name of the HDF5 file
+    chunk_spectra: int
+        number of spectra per chunk
+    """
+
+    def __init__(self, filename, mode='a', chunk_spectra=64, compression='gzip'):
+        """
+
+        :param filename: str name of the HDF5 file
+        :param mode: 'r' read only, 'a' read/write (created if needed), 'w' overwrite
+        :param chunk_spectra: int number of spectra per chunk of the datasets
+        :param compression: compression filter of h5py, None to disable it
+        """
+        if h5py is None:
+            raise ImportError('CampaignStore requires h5py, install it with pip install h5py')
+
+        self.filename = filename
+        self.chunk_spectra = chunk_spectra
+        self.compression = compression
+        self.file = h5py.File(filename, mode)
+        if mode != 'r':
+            self.file.attrs.setdefault('ramanpy_schema_version', SCHEMA_VERSION)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.file['raw'].shape[0] if 'raw' in self.file else 0
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def x(self):
+        return self.file['x'][...]
+
+    @property
+    def names(self):
+        return list(self.file['names'].asstr()[...]) if 'names' in self.file else []
+
+    def append_batch(self, batch):
+        """
+        Appends the spectra of a batch as raw data, with their names, headers and positions.
+
+        :param batch: SpectrumBatch
+        :return: array with the indices of the new spectra in the store
+        """
+        n_points = batch.x.size
+        if 'x' not in self.file:
+            self.file.create_dataset('x', data=batch.x)
+            self._create_rows('raw', n_points, batch.y.dtype)
+            self._create_rows('positions', 3, np.float64)
+            self._create_rows('names', None, h5py.string_dtype())
+            self._create_rows('headers', None, h5py.string_dtype())
+        elif not np.array_equal(self.x, batch.x):
+            raise ValueError(f'{self.filename}: the batch does not share the x axis of the store')
+
+        headers = batch.headers if batch.headers is not None else [{}] * len(batch)
+        start = len(self)
+        self._append_rows('raw', batch.y)
+        self._append_rows('positions', batch.positions)
+        self._append_rows('names', np.array(batch.filenames, dtype=object))
+        self._append_rows('headers', np.array([json.dumps(header) for header in headers], dtype=object))
+
+        return np.arange(start, start + len(batch))
+
+    def write_processed(self, indices, y):
+        """
+        Stores preprocessed intensities (after smoothing, normalization...) for some spectra.
+
+        :param indices: indices of the spectra in the store
+        :param y: 2D array (len(indices), n_points)
+        """
+        n_points = self.file['raw'].shape[1]
+        if 'processed' not in self.file:
+            self.file.create_dataset('processed', shape=(len(self), n_points), maxshape=(None, n_points),
+                                     dtype=np.asarray(y).dtype, chunks=(self.chunk_spectra, n_points),
+                                     compression=self.compression, fillvalue=np.nan)
+        dataset = self.file['processed']
+        if dataset.shape[0] < len(self):  # the store may have grown since it was created
+            dataset.resize(len(self), axis=0)
+
+        indices = np.asarray(indices)
+        order = np.argsort(indices)
+        dataset[indices[order].tolist()] = np.asarray(y)[order]
+
+    def write_fit_table(self, table, indices=None):
+        """
+        Stores the fitted parameters, as returned by SpectrumBatch.run_fits: one row per spectrum,
+        a column per parameter and another one with its _stderr.
+
+        :param table: pandas dataframe
+        :param indices: indices of the rows in the store. If None, the index of the table (names) is used.
+        """
+        if indices is None:
+            position = {name: i for i, name in enumerate(self.names)}
+            indices = [position[name] for name in table.index]
+        indices = np.asarray(indices)
+
+        params = [column for column in table.columns if not column.endswith('_stderr')]
+        if 'fit' not in self.file:
+            group = self.file.create_group('fit')
+            group.attrs['params'] = params
+            for name in ('values', 'stderr'):
+                group.create_dataset(name, shape=(len(self), len(params)), dtype=np.float64,
+                                     maxshape=(None, len(params)), fillvalue=np.nan,
+                                     chunks=(self.chunk_spectra, len(params)))
+        group = self.file['fit']
+        if list(group.attrs['params']) != params:
+            raise ValueError(f'{self.filename}: the parameters of the table are not the ones of the store')
+
+        for name in ('values', 'stderr'):  # the store may have grown since the fit group was created
+            if group[name].shape[0] < len(self):
+                group[name].resize(len(self), axis=0)
+
+        order = np.argsort(indices)
+        values = table[params].to_numpy(dtype=np.float64)
+        stderr = table[[param + '_stderr' for param in params]].astype(float).to_numpy(dtype=np.float64)
+        group['values'][indices[order].tolist()] = values[order]
+        group['stderr'][indices[order].tolist()] = stderr[order]
+
+    def read_spectra(self, indices=None, kind='raw'):
+        """
+        Reads some spectra, only the chunks needed are read from disk.
+
+        :param indices: int, slice or list of indices. All the spectra if None.
+        :param kind: 'raw' or 'processed'
+        :return: x, y
+        """
+        return self.x, _read_rows(self.file[kind], indices)
+
+    def read_headers(self, indices=None):
+        """
+        :param indices: int, slice or list of indices. All the spectra if None.
+        :return: list of header dicts
+        """
+        headers = _read_rows(self.file['headers'].asstr(), indices)
+        if isinstance(headers, str):
+            return json.loads(headers)
+        return [json.loads(header) for header in headers]
+
+    def read_positions(self, indices=None):
+        """
+        :param indices: int, slice or list of indices. All the spectra if None.
+        :return: array (n, 3) with X, Y, Z in µm
+        """
+        return _read_rows(self.file['positions'], indices)
+
+    def read_batch(self, indices=None, kind='raw', **kwargs):
+        """
+        Reads some spectra as a SpectrumBatch.
+
+        :param indices: slice or list of indices. All the spectra if None.
+        :param kind: 'raw' or 'processed'
+        :param kwargs: passed to SpectrumBatch (peaks, other_data, folder_out, fit_class)
+        :return: SpectrumBatch
+        """
+        x, y = self.read_spectra(indices, kind=kind)
+        positions = self.read_positions(indices)
+        names = _read_rows(self.file['names'].asstr(), indices)
+        return SpectrumBatch(x, y, filenames=names, headers=self.read_headers(indices), copy=False,
+                             metadata={'X': positions[:, 0], 'Y': positions[:, 1], 'Z': positions[:, 2]}, **kwargs)
+
+    def read_fit_table(self, indices=None):
+        """
+        Reads the fitted parameters, in the same format as SpectrumBatch.run_fits.
+
+        :param indices: slice or list of indices. All the spectra if None.
+        :return: pandas dataframe indexed by the names of the spectra
+        """
+        group = self.file['fit']
+        params = list(group.attrs['params'])
+        values = _read_rows(group['values'], indices)
+        stderr = _read_rows(group['stderr'], indices)
+        names = _read_rows(self.file['names'].asstr(), indices)
+
+        columns = {}
+        for i, param in enumerate(params):
+            columns[param] = values[:, i]
+            columns[param + '_stderr'] = stderr[:, i]
+        return pd.DataFrame(columns, index=list(names))
+
+    def read_fit_params(self, indices=None):
+        """
+        Reads the fitted parameters as one dict per spectrum, like the content of a _params.txt file.
+
+        :param indices: slice or list of indices. All the spectra if None.
+        :return: list of dicts
+        """
+        return list(self.read_fit_table(indices).to_dict(orient='index').values())
+
+    def _create_rows(self, name, n_columns, dtype):
+        """
+        creates an empty resizable dataset, with one row per spectrum.
+        """
+        shape = (0,) if n_columns is None else (0, n_columns)
+        maxshape = (None,) if n_columns is None else (None, n_columns)
+        chunks = (self.chunk_spectra,) + shape[1:]
+        return self.file.create_dataset(name, shape=shape, maxshape=maxshape, dtype=dtype, chunks=chunks,
+                                        compression=self.compression)
+
+    def _append_rows(self, name, rows):
+        """
+        appends rows at the end of a dataset.
+        """
+        dataset = self.file[name]
+        start = dataset.shape[0]
+        dataset.resize(start + len(rows), axis=0)
+        dataset[start:] = rows
+
+
+def _read_rows(dataset, indices):
+    """
+    Reads rows of a dataset. h5py only accepts increasing indices, so they are sorted and put back in order.
+
+    :param dataset: h5py dataset
+    :param indices: int, slice, list of indices or None for all the rows
+    :return: array
+    """
+    if indices is None:
+        return dataset[...]
+    if isinstance(indices, (int, np.integer, slice)):
+        return dataset[indices]
+
+    unique, inverse = np.unique(np.asarray(indices), return_inverse=True)
+    return dataset[unique.tolist()][inverse]
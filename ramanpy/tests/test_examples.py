@@ -1,8 +1,38 @@
-from ..generic_fit_class import GenericFit
+import os
+
+import numpy as np
+import pytest
+from lmfit.models import LorentzianModel
+from scipy.integrate import trapezoid
 
+from ..generic_fit_class import GenericFit
+from ..archives import _open_tars, close_archives, open_text
+from ..batch import SpectrumBatch
+from ..loaders import load_directory, read_files_threaded
+from ..manifest import Manifest
+from ..models import ModelJacobian, MultiLorentzianModel
+from ..pipeline import Pipeline
+from ..preprocessing import (als_baseline, guess_peaks, normalize_spectra, resample_spectra, smooth_spectra,
+                             snip_baseline)
+from ..process_results_raman import ResultsDataFrames
+from ..spatial import SpatialIndex
+from ..specific_fit_classes import RamanFit, XRDFit
+from ..store import CampaignStore
 from ..tools import cleanup_header
 
 
+def write_raman_file(filename, x_position=12.5, y_position=-3.0, n_points=500):
+    # synthetic raman file with a header like the ones of the spectrometer
+    x = np.linspace(1000, 3000, n_points)
+    y = 100 / (1 + ((x - 1350) / 30) ** 2) + 80 / (1 + ((x - 1590) / 25) ** 2)
+    with open(filename, 'w', encoding='utf-8') as fh:
+        fh.write('#Acq. time (s)=\t10\n')
+        fh.write(f'#X (µm)=\t{x_position}\n#Y (µm)=\t{y_position}\n#Z (µm)=\t0\n')
+        for x_value, y_value in zip(x, y):
+            fh.write(f'{x_value}\t{y_value}\n')
+    return x, y
+
+
 def test_cleanup_header():
     data = ['# hello', "\t,# ciao"]
     actual = cleanup_header(data)
@@ -17,3 +47,695 @@ def test_bkg_model_selection():
     expected = tuple
 
     assert isinstance(actual, expected)
+
+
+def test_reader_cache(tmp_path):
+    filename = str(tmp_path / 'spectrum.txt')
+    write_raman_file(filename)
+    cache_dir = tmp_path / 'cache'
+
+    expected, expected_header = RamanFit.reader_single_point(filename)
+    RamanFit.reader_single_point(filename, cache_dir=cache_dir)  # fills the cache
+    actual, actual_header = RamanFit.reader_single_point(filename, cache_dir=cache_dir)
+
+    assert len(list(cache_dir.glob('*.npy'))) == 1
+    assert actual_header == expected_header
+    np.testing.assert_array_equal(actual.values, expected.values)
+
+
+def test_single_pass_reader(tmp_path):
+    filename = str(tmp_path / 'spectrum.txt')
+    write_raman_file(filename)
+
+    expected, expected_header = RamanFit.read_data_raman(filename, engine='pandas')
+    actual, actual_header = RamanFit.read_data_raman(filename)
+
+    assert actual_header == expected_header
+    np.testing.assert_allclose(actual.values, expected.values, rtol=1e-14)
+
+    # a corrupt file raises instead of giving truncated data
+    with open(filename) as fh:
+        lines = fh.readlines()
+    for corrupt in ('1500.0\tabc\n', '1500.0\t1.0\t2.0\n1600.0\n'):
+        with open(filename, 'w') as fh:
+            fh.writelines(lines[:100] + [corrupt] + lines[100:])
+        with pytest.raises(ValueError):
+            RamanFit.read_data_raman(filename)
+
+
+def test_spectrum_batch(tmp_path):
+    filenames = []
+    for i in range(3):
+        filename = str(tmp_path / f'spectrum_{i}.txt')
+        write_raman_file(filename, x_position=i)
+        filenames.append(filename)
+
+    batch = SpectrumBatch.from_files(filenames, peaks=[1350, 1590], folder_out=tmp_path / 'out')
+    batch.apply_smoothing()
+    batch.apply_normalize()
+
+    single = RamanFit(filenames[1], peaks=[1350, 1590], folder_out=tmp_path / 'out')
+    single.apply_smoothing()
+    single.apply_normalize()
+
+    assert batch.y.shape == (3, 500)
+    np.testing.assert_array_equal(batch.positions[:, 0], [0, 1, 2])
+    np.testing.assert_allclose(batch.y[1], single.y)
+
+    table = batch.run_fits(indices=[1])
+    np.testing.assert_allclose(table['lz1center'].values, [1350], atol=1)
+
+
+def test_load_directory(tmp_path):
+    for i in range(5):
+        write_raman_file(str(tmp_path / f'spectrum_{i}.txt'), x_position=i)
+    (tmp_path / 'corrupted.txt').write_text('#X (µm)=\t1\n1\t2\t3\n')
+
+    batch = load_directory(str(tmp_path), workers=3)
+
+    assert len(batch) == 5
+    assert list(batch.failures) == [str(tmp_path / 'corrupted.txt')]
+    np.testing.assert_array_equal(batch.metadata['X'], [0, 1, 2, 3, 4])
+
+
+def test_iter_from_export(tmp_path):
+    x = np.linspace(1000, 3000, 50)
+    y = np.arange(7)[:, None] + np.sin(x / 100)[None, :]
+    filename = str(tmp_path / 'export.txt')
+    with open(filename, 'w') as fh:
+        fh.write('#Exported map\n')
+        np.savetxt(fh, np.column_stack([x, y.T]), delimiter='\t')
+
+    batches = list(SpectrumBatch.iter_from_export(filename, block_size=3))
+
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    np.testing.assert_allclose(np.concatenate([batch.y for batch in batches]), y)
+    assert batches[2].filenames == [str(tmp_path / 'export_6')]
+
+    filename = str(tmp_path / 'stacked.txt')
+    with open(filename, 'w') as fh:
+        for i in range(4):
+            fh.write(f'#X (µm)=\t{i}\n')
+            np.savetxt(fh, np.column_stack([x, y[i]]), delimiter='\t')
+
+    batches = list(SpectrumBatch.iter_from_export(filename, layout='stacked', block_size=3))
+
+    assert [len(batch) for batch in batches] == [3, 1]
+    np.testing.assert_allclose(batches[1].y[0], y[3])
+    np.testing.assert_array_equal(batches[0].metadata['X'], [0, 1, 2])
+
+
+def test_campaign_store(tmp_path):
+    pytest.importorskip('h5py')
+    filenames = []
+    for i in range(4):
+        filename = str(tmp_path / f'spectrum_{i}.txt')
+        write_raman_file(filename, x_position=i)
+        filenames.append(filename)
+    batch = SpectrumBatch.from_files(filenames, peaks=[1350, 1590], folder_out=tmp_path / 'out')
+    store_file = str(tmp_path / 'campaign.h5')
+
+    with CampaignStore(store_file) as store:
+        indices = store.append_batch(batch)
+        batch.apply_smoothing()
+        batch.apply_normalize()
+        store.write_processed(indices, batch.y)
+        store.write_fit_table(batch.run_fits(indices=[2, 0]))
+
+    with CampaignStore(store_file, mode='r') as store:
+        x, y = store.read_spectra([3, 1], kind='processed')
+        np.testing.assert_allclose(y, batch.y[[3, 1]])
+        assert store.read_headers(1)['X(µm)'] == '1'
+        table = store.read_fit_table()
+        assert np.isnan(table['lz1center'].values[1])
+
+    results = ResultsDataFrames.from_store(store_file, peaks_names=['D', 'G'], indices=[0, 2])
+    results.add_xypositions()
+    np.testing.assert_allclose(results.data_pandas[('center', 'D')].values, [1350, 1350], atol=1)
+    np.testing.assert_array_equal(results.data_pandas['x(um)'].values, [0, 2])
+
+
+def test_manifest(tmp_path):
+    for i in range(3):
+        write_raman_file(str(tmp_path / f'spectrum_{i}.txt'), x_position=i, n_points=100)
+    index_file = str(tmp_path / 'manifest.json')
+
+    manifest = Manifest.build(str(tmp_path), index_file=index_file, full_scan=True)
+    np.testing.assert_array_equal(manifest.positions()[:, 0], [0, 1, 2])
+    assert manifest.entries[str(tmp_path / 'spectrum_0.txt')]['n_points'] == 100
+
+    write_raman_file(str(tmp_path / 'spectrum_1.txt'), x_position=7, n_points=100)
+    manifest = Manifest.load(index_file)
+    rescanned = manifest.refresh([str(tmp_path / f'spectrum_{i}.txt') for i in range(3)])
+    assert rescanned == [str(tmp_path / 'spectrum_1.txt')]
+    assert manifest.header(str(tmp_path / 'spectrum_1.txt'))['X(µm)'] == '7'
+
+    # modified without refresh: header and positions scan the file again
+    write_raman_file(str(tmp_path / 'spectrum_1.txt'), x_position=8, n_points=200)
+    assert manifest.header(str(tmp_path / 'spectrum_1.txt'))['X(µm)'] == '8'
+
+    # deleted files are dropped, and the ones which cannot be scanned again are not served
+    os.remove(tmp_path / 'spectrum_0.txt')
+    with pytest.raises(FileNotFoundError):
+        manifest.header(str(tmp_path / 'spectrum_0.txt'))
+    os.remove(tmp_path / 'spectrum_2.txt')
+    os.mkdir(tmp_path / 'spectrum_2.txt')  # cannot be read
+    rescanned = manifest.refresh([str(tmp_path / f'spectrum_{i}.txt') for i in range(3)])
+    assert rescanned == [str(tmp_path / 'spectrum_2.txt')] and list(manifest.failures) == rescanned
+    assert list(manifest.entries) == [str(tmp_path / 'spectrum_1.txt')]
+    np.testing.assert_array_equal(manifest.positions()[:, 0], [8])
+
+
+def test_spatial_index():
+    grid_x, grid_y = np.meshgrid(np.arange(10) * 5.0, np.arange(10) * 5.0)
+    positions = np.column_stack([grid_x.ravel(), grid_y.ravel(), np.zeros(100)])
+    positions[99] = np.nan
+    index = SpatialIndex(positions)
+
+    np.testing.assert_array_equal(index.within_radius(0, 5), [0, 1, 10])
+    np.testing.assert_array_equal(np.sort(index.nearest(11, k=4)[0]), [1, 10, 12, 21])
+    np.testing.assert_array_equal(index.in_box([0, 0], [5, 10]), [0, 1, 10, 11, 20, 21])
+    np.testing.assert_array_equal(index.in_polygon([[-1, -1], [11, -1], [-1, 11]]), [0, 1, 2, 10, 11, 20])
+    assert 99 not in index.in_box([40, 40], [50, 50])
+
+    jittered = SpatialIndex(positions + np.random.default_rng(0).normal(0, 0.2, positions.shape))
+    row, column = jittered.grid()
+    np.testing.assert_array_equal(row[:99], np.arange(99) // 10)
+    np.testing.assert_array_equal(column[:99], np.arange(99) % 10)
+    full = SpatialIndex(np.column_stack([grid_x.ravel(), grid_y.ravel()]))
+    for order in ('raster', 'snake', 'hilbert'):
+        path = index.visit_order(order)
+        assert sorted(path) == list(range(100)) and path[-1] == 99
+        steps = np.abs(np.diff(full.positions[full.visit_order(order)], axis=0)).sum(axis=1)
+        assert np.mean(steps == 5) > {'raster': 0.9, 'snake': 0.99, 'hilbert': 0.95}[order]
+
+
+def test_xrd_reader(tmp_path):
+    angle = np.linspace(10, 40, 301)
+    intensity = 1000 / (1 + ((angle - 26) / 0.5) ** 2) + 10
+    filename = str(tmp_path / 'scan.xye')
+    with open(filename, 'w') as fh:
+        fh.write('Scan of a carbon sample\n')
+        np.savetxt(fh, np.column_stack([angle, intensity, np.sqrt(intensity)]))
+
+    actual_angle, actual_intensity, actual_error = XRDFit.read_arrays_xrd(filename, dtype=np.float32)
+    assert actual_intensity.dtype == np.float32
+    np.testing.assert_allclose(actual_angle, angle, rtol=1e-6)
+    np.testing.assert_allclose(actual_error, np.sqrt(intensity), rtol=1e-6)
+
+    xrd = XRDFit(filename, peaks=[26], folder_out=tmp_path / 'out')
+    xrd.set_tolerances_fit()
+    xrd.build_fitting_model_peaks()
+    xrd.run_fit_model()
+    assert xrd.result.weights is not None
+    np.testing.assert_allclose(xrd.result.params['lz1center'].value, 26, atol=1e-3)
+    xrd.apply_normalize()  # min-max, the errors are scaled as the intensity
+    np.testing.assert_allclose(xrd.y_error, np.sqrt(intensity) / np.ptp(intensity), rtol=1e-6)
+
+    # the third column of other exports is only used as weights if asked
+    other = str(tmp_path / 'scan.dat')
+    with open(other, 'w') as fh:
+        np.savetxt(fh, np.column_stack([angle, intensity, np.sqrt(intensity)]))
+    for name, setting, expected in ((other, 'auto', False), (other, 'true', True), (filename, 'false', False)):
+        xrd = XRDFit(name, peaks=[26], other_data={'use_error_weights': setting}, folder_out=tmp_path / 'out')
+        assert (xrd.y_error is not None) == expected
+
+    # .xy files starting with a numeric title (start, step and time of the scan), or without title
+    for title in ('10.0 0.1 80.0\n', '# comment\n10.0 0.1 80.0\n\n', ''):
+        filename = str(tmp_path / 'scan.xy')
+        with open(filename, 'w') as fh:
+            fh.write(title)
+            np.savetxt(fh, np.column_stack([angle, intensity]))
+        actual_angle, actual_intensity, actual_error = XRDFit.read_arrays_xrd(filename)
+        np.testing.assert_allclose(actual_angle, angle)
+        np.testing.assert_allclose(actual_intensity, intensity)
+        assert actual_error is None
+
+
+def test_float32_batch(tmp_path):
+    filenames = []
+    for i in range(2):
+        filename = str(tmp_path / f'spectrum_{i}.txt')
+        write_raman_file(filename)
+        filenames.append(filename)
+
+    batch = SpectrumBatch.from_files(filenames, peaks=[1350, 1590], folder_out=tmp_path / 'out', dtype=np.float32)
+    reference = SpectrumBatch.from_files(filenames, peaks=[1350, 1590], folder_out=tmp_path / 'out')
+    for spectra in (batch, reference):
+        spectra.apply_smoothing()
+        spectra.apply_normalize()
+
+    assert batch.y.dtype == np.float32
+    np.testing.assert_allclose(batch.y, reference.y, atol=1e-5)
+    table = batch.run_fits(indices=[0])
+    np.testing.assert_allclose(table['lz2center'].values, [1590], atol=1)
+
+
+def test_batched_smoothing():
+    rng = np.random.default_rng(0)
+    x = np.linspace(1000, 3000, 500)
+    y = 100 / (1 + ((x - 1350) / 30) ** 2) + rng.random((20, x.size))
+
+    direct = smooth_spectra(y, window_size=101, poly_order=3, method='savgol')
+    np.testing.assert_allclose(smooth_spectra(y, window_size=101, poly_order=3, method='fft'), direct, atol=1e-10)
+
+    batch = SpectrumBatch(x, y, other_data={'window_size': '101', 'poly_order': '3'})
+    batch.apply_smoothing()
+    for i in (0, 19):
+        single = RamanFit.from_arrays(x, y[i], other_data={'window_size': '101', 'poly_order': '3'})
+        single.apply_smoothing()
+        np.testing.assert_allclose(batch.y[i], single.y, atol=1e-10)
+
+
+def test_normalization_modes():
+    rng = np.random.default_rng(0)
+    x = np.linspace(1000, 3000, 500)
+    y = 100 / (1 + ((x - 1350) / 30) ** 2) + rng.random((3, x.size))
+
+    expected = (y - y.min(axis=1, keepdims=True)) / (y.max(axis=1, keepdims=True) - y.min(axis=1, keepdims=True))
+    original = y.copy()
+    batch = SpectrumBatch(x, y)
+    batch.apply_normalize()
+    np.testing.assert_array_equal(batch.y, expected)
+    np.testing.assert_array_equal(y, original)  # the array of the caller is not normalized in place
+
+    np.testing.assert_allclose(normalize_spectra(y, 'max').max(axis=1), 1)
+    np.testing.assert_allclose(trapezoid(normalize_spectra(y, 'area', x=x), x, axis=1), 1)
+    np.testing.assert_allclose(np.linalg.norm(normalize_spectra(y, 'l2'), axis=1), 1)
+    snv = normalize_spectra(y[0], 'snv')
+    np.testing.assert_allclose([snv.mean(), snv.std(ddof=1)], [0, 1], atol=1e-12)
+
+    spectrum = y[0] * 1  # an array owning its data, as the ones of the users
+    single = RamanFit.from_arrays(x, spectrum, other_data={'_normalize_data': 'vector'})
+    single.apply_normalize()
+    np.testing.assert_allclose(single.y, normalize_spectra(y[0], 'l2'))
+    np.testing.assert_array_equal(spectrum, y[0])
+    np.testing.assert_array_equal(single.x, x)
+
+
+def test_baseline_removal():
+    rng = np.random.default_rng(0)
+    x = np.linspace(1000, 3000, 500)
+    background = 50 * np.exp(-(x - 1000) / 1500)
+    peaks = 100 / (1 + ((x - 1350) / 30) ** 2) + 80 / (1 + ((x - 1590) / 25) ** 2)
+    y = background + peaks + rng.random((300, x.size))
+
+    # one by one and all together give the same baseline
+    batched = als_baseline(y, lam=1e6, p=0.01)
+    np.testing.assert_allclose(batched[:2], als_baseline(y[:2], lam=1e6, p=0.01), atol=1e-6)
+    assert np.abs(batched - background).max() < 8  # the tails of the lorentzians are partly taken as baseline
+    assert np.abs(snip_baseline(y, half_window=40) - background).max() < 5
+
+    other_data = {'baseline': 'als', 'baseline_lambda': '1e6', 'poly_type': 'none'}
+    fit = RamanFit.from_arrays(x, y[0], peaks=[1350, 1590], other_data=other_data)
+    fit.apply_baseline()
+    fit.apply_normalize()
+    fit.set_tolerances_fit()
+    fit.build_fitting_model_peaks()
+    fit.run_fit_model()
+    assert not any(name.startswith('bkg') for name in fit.result.params)
+    np.testing.assert_allclose(fit.result.params['lz2center'].value, 1590, atol=1)
+
+    # the baseline is removed from copies, not from the arrays of the caller
+    original = y.copy()
+    batch = SpectrumBatch(x, y, other_data={'baseline': 'snip'})
+    batch.apply_baseline()
+    spectrum = y[0] * 1
+    single = RamanFit.from_arrays(x, spectrum, other_data={'baseline': 'snip'})
+    single.apply_baseline()
+    np.testing.assert_allclose(single.y, batch.y[0])
+    np.testing.assert_array_equal(y, original)
+    np.testing.assert_array_equal(spectrum, original[0])
+
+
+def test_despike():
+    rng = np.random.default_rng(1)
+    x = np.linspace(1000, 3000, 500)
+    clean = 100 / (1 + ((x - 1350) / 30) ** 2) + 80 / (1 + ((x - 1590) / 25) ** 2)
+    y = clean + rng.normal(0, 1, (100, x.size))
+    y[5, 200] += 300
+    y[7, [300, 301]] += 200
+    grid_x, grid_y = np.meshgrid(np.arange(10), np.arange(10))
+    metadata = {'X': grid_x.ravel(), 'Y': grid_y.ravel()}
+
+    for method in ('diff', 'neighbours'):
+        batch = SpectrumBatch(x, y.copy(), metadata=metadata, other_data={'despike': method})
+        batch.apply_despike()
+        table = batch.spike_table()
+        assert set(table['spectrum']) == {5, 7}
+        assert {200, 300, 301} <= set(table['point'])
+        assert np.abs(batch.y - clean).max() < 10
+    assert len(SpatialIndex(np.column_stack([grid_x.ravel(), grid_y.ravel()])).neighbours(4)[0]) == 4
+
+
+def test_resampling():
+    x_axes = [np.linspace(1000 + shift, 3000 + shift, 500 + shift) for shift in range(4)]
+    x_axes[1] = x_axes[1][::-1]  # some exports are in decreasing order
+    spectra = [(x, np.sin(x / 50), {}) for x in x_axes]
+
+    with pytest.raises(ValueError):
+        SpectrumBatch.from_spectra(spectra)
+    batch = SpectrumBatch.from_spectra(spectra, grid='auto')
+    assert batch.x[0] == 1003 and 2990 < batch.x[-1] <= 3000
+    np.testing.assert_allclose(batch.y, np.sin(batch.x / 50)[np.newaxis].repeat(4, axis=0), atol=1e-3)
+    for i, x in enumerate(x_axes):
+        np.testing.assert_allclose(batch.y[i], np.interp(batch.x, np.sort(x), np.sin(np.sort(x) / 50)), atol=1e-12)
+
+    cubic = resample_spectra(x_axes, [np.sin(x / 50) for x in x_axes], batch.x, kind='cubic')
+    np.testing.assert_allclose(cubic, np.sin(batch.x / 50)[np.newaxis].repeat(4, axis=0), atol=1e-5)
+
+    batch.resample(step=10)
+    assert batch.y.shape == (4, batch.x.size) and np.all(np.diff(batch.x) == pytest.approx(10))
+    assert np.isnan(resample_spectra(x_axes, [np.sin(x / 50) for x in x_axes], [900, 2000])[:, 0]).all()
+
+
+def test_region_of_interest():
+    rng = np.random.default_rng(0)
+    x = np.linspace(100, 3500, 1024)
+    y = 1 / (1 + ((x - 1350) / 30) ** 2) + 0.8 / (1 + ((x - 1590) / 25) ** 2) + 0.01 * rng.random(x.size)
+    other_data = {'roi': 'sigma', 'roi_width': '10', 'peak_center_tolerance': '20', 'sigma': '30',
+                  'min_max_amplitude': ['0', '500']}  # as read by ConfigObj
+
+    full = RamanFit.from_arrays(x, y, peaks=[1350, 1590], other_data=dict(other_data, roi='none'))
+    cropped = RamanFit.from_arrays(x, y, peaks=[1350, 1590], other_data=other_data)
+    for fit in (full, cropped):
+        fit.set_tolerances_fit()
+        fit.apply_roi()
+        fit.build_fitting_model_peaks()
+        fit.run_fit_model()
+
+    # one window from 1350 - 320 to 1590 + 320, the two windows overlap
+    np.testing.assert_array_equal(cropped.roi, [[1030, 1910]])
+    assert cropped.x.size < 0.3 * x.size
+    for name in ('lz1center', 'lz2center', 'lz1sigma'):
+        np.testing.assert_allclose(cropped.result.params[name].value, full.result.params[name].value, rtol=1e-2)
+    assert cropped.result.eval(x=x).shape == x.shape
+
+    batch = SpectrumBatch(x, np.vstack([y, y]), peaks=[1350, 1590], other_data=other_data)
+    batch.apply_roi()
+    np.testing.assert_array_equal(batch.x, cropped.x)
+
+
+def test_decimation(tmp_path):
+    rng = np.random.default_rng(0)
+    x = np.linspace(100, 3500, 8192)
+    y = 100 / (1 + ((x - 1350) / 30) ** 2) + 80 / (1 + ((x - 1590) / 25) ** 2) + 0.002 * x + rng.random(x.size)
+    other_data = {'poly_type': 'linear', 'peak_center_tolerance': '20', 'sigma': '30', 'window_size': '31',
+                  'min_max_amplitude': ['0', '500'], 'decimation_factor': '8'}
+
+    fits = {}
+    for mode in ('none', 'curvature', 'peaks'):
+        fit = RamanFit.from_arrays(x, y, peaks=[1350, 1590], other_data=dict(other_data, decimate=mode),
+                                   folder_out=tmp_path, filename=str(tmp_path / mode))
+        fit.apply_smoothing()
+        fit.apply_normalize()
+        fit.set_tolerances_fit()
+        fit.apply_decimation()
+        fit.build_fitting_model_peaks()
+        fit.run_fit_model()
+        fits[mode] = fit
+
+    for mode in ('curvature', 'peaks'):
+        assert fits[mode].x.size < 0.4 * x.size
+        for name in ('lz1center', 'lz1sigma', 'lz2center', 'lz2amplitude'):
+            np.testing.assert_allclose(fits[mode].result.params[name].value,
+                                       fits['none'].result.params[name].value, rtol=1e-3)
+        x_full, y_full, best_fit = fits[mode].eval_full()
+        np.testing.assert_array_equal(x_full, x)
+        np.testing.assert_allclose(best_fit, fits['none'].result.best_fit, atol=1e-3)
+    fits['peaks'].plot_results()
+    assert (tmp_path / 'peaks.png').exists()
+
+    batch = SpectrumBatch(x, np.vstack([y, y]), peaks=[1350, 1590], other_data=dict(other_data, decimate='both'))
+    batch.apply_smoothing()
+    batch.apply_normalize()
+    batch.apply_decimation()
+    assert batch.decimation.sum() < 0.4 * x.size and batch.y.shape == (2, x.size)
+    table = batch.run_fits(indices=[1])
+    np.testing.assert_allclose(table['lz2center'].values, fits['none'].result.params['lz2center'].value,
+                               rtol=1e-4)
+
+
+def test_multi_lorentzian_model():
+    x = np.linspace(1000, 3400, 1000)
+    prefixes = ['lz1', 'lz2', 'lz3']
+    model = MultiLorentzianModel(prefixes)
+    composite = LorentzianModel(prefix='lz1') + LorentzianModel(prefix='lz2') + LorentzianModel(prefix='lz3')
+    params = model.make_params()
+    # same order as the parameters of the peaks added one by one
+    assert list(params) == [name for prefix in prefixes for name in LorentzianModel(prefix=prefix).make_params()]
+    for prefix, center, sigma in zip(prefixes, (1350, 1590, 2700), (30, 20, 60)):
+        params[prefix + 'center'].set(center)
+        params[prefix + 'amplitude'].set(center / 10)
+        params[prefix + 'sigma'].set(sigma)
+
+    np.testing.assert_allclose(model.eval(params, x=x), composite.eval(params, x=x), rtol=1e-12)
+    components = model.eval_components(params=params, x=x)
+    for prefix, component in composite.eval_components(params=params, x=x).items():
+        np.testing.assert_allclose(components[prefix], component, rtol=1e-12)
+    assert params['lz2fwhm'].value == pytest.approx(40)
+    assert params['lz2height'].value == pytest.approx(159 / (np.pi * 20))
+
+
+def test_analytic_jacobian():
+    rng = np.random.default_rng(0)
+    x = np.linspace(1000, 3400, 2000)
+    peaks = [1150, 1346, 1587, 2480, 2687, 2932, 3230]
+    y = sum(amplitude * 30 / np.pi / ((x - center - 5) ** 2 + 30 ** 2)
+            for amplitude, center in zip([500, 3000, 2500, 400, 1200, 600, 300], peaks))
+    y += 0.01 * x + 1e-6 * x ** 2 + rng.normal(0, 0.5, x.size)
+    other_data = {'peak_center_tolerance': '50', 'sigma': '30', 'min_max_amplitude': ['0', '500'],
+                  'min_max_sigma': ['1', '200']}
+
+    for poly_type in ('quadratic', 'linear', 'none'):
+        fits = {}
+        for jacobian in ('numeric', 'analytic'):
+            fit = RamanFit.from_arrays(x, y, peaks=peaks, other_data=dict(other_data, poly_type=poly_type,
+                                                                         jacobian=jacobian))
+            fit.apply_normalize()
+            fit.set_tolerances_fit()
+            fit.build_fitting_model_peaks()
+            fit.run_fit_model()
+            fits[jacobian] = fit.result
+
+        assert fits['analytic'].nfev < fits['numeric'].nfev
+        for name in fits['numeric'].params:
+            if not name.startswith('bkg'):
+                np.testing.assert_allclose(fits['analytic'].params[name].value,
+                                           fits['numeric'].params[name].value, rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(fits['analytic'].best_fit, fits['numeric'].best_fit, atol=1e-4)
+
+    # same derivatives as finite differences, with the weights and the sign of the residual of lmfit
+    fit.other_data['poly_type'] = 'quadratic'
+    fit.build_fitting_model_peaks()
+    jacobian = ModelJacobian.from_model(fit.model, fit.params)
+    weights = rng.random(x.size)
+    names = [name for name, par in fit.params.items() if par.vary]
+    residual = fit.model._residual(fit.params, y, weights, x=x)
+    analytic = jacobian(fit.params, y, weights, x=x)
+    for i, name in enumerate(names):
+        params = fit.params.copy()
+        step = 1e-7 * max(1, abs(params[name].value))
+        params[name].value += step
+        numeric = (fit.model._residual(params, y, weights, x=x) - residual) / step
+        np.testing.assert_allclose(analytic[:, i], numeric, atol=1e-4 * np.abs(numeric).max() + 1e-9)
+
+
+def test_batch_fitter():
+    rng = np.random.default_rng(0)
+    x = np.linspace(1000, 2000, 800)
+    centers = 1350 + rng.normal(0, 3, 6)
+    y = np.array([300 / (1 + ((x - center) / 30) ** 2) + 200 / (1 + ((x - 1590) / 25) ** 2) + 0.02 * x
+                  for center in centers]) + rng.normal(0, 1, (6, x.size))
+    other_data = {'poly_type': 'linear', 'peak_center_tolerance': '20', 'sigma': '30',
+                  'min_max_amplitude': ['0', '500'], 'min_max_sigma': ['1', '200'], '_normalize_data': True}
+    batch = SpectrumBatch(x, y, peaks=[1350, 1590], other_data=other_data)
+    batch.apply_normalize()
+
+    reference = batch.run_fits()
+    table = batch.run_batch_fits(chunk_size=4)  # two chunks, the spectra stop at different iterations
+    assert table['success'].all() and list(table.index) == list(reference.index)
+    for column in reference.columns:
+        if not column.startswith('bkg'):
+            np.testing.assert_allclose(table[column], reference[column].astype(float), rtol=1e-3, atol=1e-6)
+    np.testing.assert_allclose(table['lz1center'], centers, atol=0.5)
+
+    # starting values given per spectrum
+    table = batch.run_batch_fits(indices=[0, 2], initial={'lz1center': centers[[0, 2]]})
+    np.testing.assert_allclose(table['lz1center'], reference['lz1center'].values[[0, 2]], rtol=1e-6)
+
+    # the same points as run_fits with a region of interest, the curved background is only linear locally
+    curved = SpectrumBatch(x, y[:3] + 100 * np.exp(-(x - 1000) / 200), peaks=[1350, 1590],
+                           other_data=dict(other_data, roi='sigma'))
+    curved.apply_normalize()
+    reference = curved.run_fits()
+    table = curved.run_batch_fits()
+    for name in ('lz1center', 'lz1amplitude', 'lz2sigma', 'lz2height'):
+        np.testing.assert_allclose(table[name], reference[name].astype(float), rtol=1e-3)
+
+    # stopped before converging: max_iterations reached, or no step can reduce the sum of squares (nan)
+    assert not batch.run_batch_fits(max_iterations=2)['success'].any()
+    batch.y[1, 10] = np.nan
+    assert list(batch.run_batch_fits(indices=[0, 1])['success']) == [True, False]
+
+
+def test_map_fits():
+    rng = np.random.default_rng(0)
+    x = np.linspace(1000, 2000, 400)
+    grid_x, grid_y = np.meshgrid(np.arange(6) * 2.0, np.arange(6) * 2.0)
+    grid_x, grid_y = grid_x.ravel(), grid_y.ravel()
+    centers = 1330 + grid_x + rng.normal(0, 0.3, grid_x.size)
+    y = np.array([(300 + 5 * position) / (1 + ((x - center) / 30) ** 2) + 200 / (1 + ((x - 1600) / 25) ** 2)
+                  for center, position in zip(centers, grid_y)]) + rng.normal(0, 1, (grid_x.size, x.size))
+    other_data = {'poly_type': 'linear', 'peak_center_tolerance': '30', 'sigma': '10', '_normalize_data': True,
+                  'min_max_amplitude': ['0', '500'], 'min_max_sigma': ['1', '200']}
+    batch = SpectrumBatch(x, y, peaks=[1350, 1590], other_data=other_data, metadata={'X': grid_x, 'Y': grid_y})
+    batch.apply_normalize()
+
+    reference = batch.run_fits()
+    cold = np.mean([batch.fit_spectrum(i).result.nfev for i in range(len(batch))])
+    for coarse_step in (None, 3):
+        table = batch.run_map_fits(order='hilbert', coarse_step=coarse_step)
+        assert list(table.index) == batch.filenames
+        assert table['nfev'].mean() < cold
+        for name in ('lz1center', 'lz1amplitude', 'lz2sigma'):
+            np.testing.assert_allclose(table[name], reference[name], rtol=1e-5)
+
+
+def test_initial_guess():
+    rng = np.random.default_rng(0)
+    x = np.linspace(1000, 2000, 800)
+    y = 300 / (1 + ((x - 1355) / 30) ** 2) + 200 / (1 + ((x - 1585) / 20) ** 2) + 0.02 * x
+    y += rng.normal(0, 1, x.size)
+
+    amplitude, center, sigma = guess_peaks(x, y, [1350, 1590, 2500], 20, 120)
+    np.testing.assert_allclose(center[:2], [1355, 1585], atol=2)
+    np.testing.assert_allclose(sigma[:2], [30, 20], rtol=0.15)
+    np.testing.assert_allclose(amplitude[:2], [300 * np.pi * 30, 200 * np.pi * 20], rtol=0.15)
+    assert np.isnan([amplitude[2], center[2], sigma[2]]).all()  # outside of the spectrum
+
+    amplitude, _, _ = guess_peaks(x, np.array([y, 2 * y]), [1350, 1590], 20, 120)
+    np.testing.assert_allclose(amplitude[1], 2 * amplitude[0], rtol=1e-6)
+
+    other_data = {'poly_type': 'linear', 'peak_center_tolerance': '20', 'sigma': '10', 'jacobian': 'numeric',
+                  'min_max_amplitude': ['0', '500'], 'min_max_sigma': ['1', '200'], '_normalize_data': True}
+    fits = []
+    for guess in ('none', 'peaks'):
+        fit = RamanFit.from_arrays(x, y, peaks=[1350, 1590], other_data=dict(other_data, initial_guess=guess))
+        fit.apply_normalize()
+        fit.set_tolerances_fit()
+        fit.build_fitting_model_peaks()
+        fit.run_fit_model()
+        fits.append(fit.result)
+    assert fits[1].nfev <= fits[0].nfev
+    for name in ('lz1center', 'lz1amplitude', 'lz2sigma'):
+        np.testing.assert_allclose(fits[1].params[name].value, fits[0].params[name].value, rtol=1e-4)
+
+
+def test_pipeline(tmp_path):
+    filename = str(tmp_path / 'spectrum.txt')
+    write_raman_file(filename)
+    other_data = {'pipeline': ['despike', 'smooth', 'baseline', 'normalize'], 'despike': 'diff',
+                  'baseline': 'snip'}
+    pipeline = Pipeline.from_other_data(other_data)
+    assert pipeline.stages == ('despike', 'smooth', 'baseline', 'normalize')
+
+    reference = RamanFit(filename, peaks=[1350, 1590], other_data=other_data, folder_out=tmp_path / 'out')
+    for method in ('apply_despike', 'apply_smoothing', 'apply_baseline', 'apply_normalize'):
+        getattr(reference, method)()
+
+    lazy = RamanFit(filename, peaks=[1350, 1590], other_data=other_data, folder_out=tmp_path / 'out', lazy=True)
+    pipeline.attach(lazy)
+    assert lazy._y is None  # nothing is read nor computed yet
+    np.testing.assert_array_equal(lazy.y, reference.y)
+    lazy.release_data()
+    np.testing.assert_array_equal(lazy.y, reference.y)  # read and processed again
+
+    batch = SpectrumBatch.from_files([filename, filename], other_data=other_data, dtype=np.float32)
+    pipeline.apply(batch)
+    np.testing.assert_allclose(batch.y[1], reference.y, atol=1e-5)
+    assert batch.y.dtype == np.float32
+
+    with pytest.raises(ValueError):
+        Pipeline(['smooth', 'sharpen'])
+
+
+def test_pipeline_release_after_fit(tmp_path):
+    filename = str(tmp_path / 'spectrum.txt')
+    write_raman_file(filename)
+    other_data = {'pipeline': ['smooth', 'normalize', 'crop', 'decimate'], 'roi': 'sigma', 'decimate': 'curvature',
+                  'decimation_factor': '4', 'sigma': '30', 'peak_center_tolerance': '20', 'poly_type': 'linear'}
+    reference = RamanFit(filename, peaks=[1350, 1590], other_data=dict(other_data), folder_out=tmp_path / 'out')
+    Pipeline.from_other_data(other_data).apply(reference)
+
+    lazy = RamanFit(filename, peaks=[1350, 1590], other_data=dict(other_data), folder_out=tmp_path / 'out',
+                    lazy=True)
+    Pipeline.from_other_data(other_data).attach(lazy)
+    lazy.set_tolerances_fit()
+    lazy.build_fitting_model_peaks()
+    lazy.run_fit_model()
+    lazy.release_data()
+    assert lazy.sample_weights is None and lazy.x_full is None
+    np.testing.assert_array_equal(lazy.y, reference.y)  # cropped and decimated again from the file
+    np.testing.assert_array_equal(lazy.x_full, reference.x_full)
+    np.testing.assert_array_equal(lazy.sample_weights, reference.sample_weights)
+
+
+def test_lazy_construction(tmp_path):
+    filename = str(tmp_path / 'spectrum.txt')
+    write_raman_file(filename)
+
+    raman = RamanFit(filename, peaks=[1350, 1590], folder_out=tmp_path / 'out', lazy=True)
+    assert raman._x is None
+    raman.apply_smoothing()  # first access, the file is read here
+    assert raman.x.size == 500
+
+    raman.release_data()
+    assert raman._y is None
+    np.testing.assert_array_equal(raman.y, RamanFit(filename, peaks=[], folder_out=tmp_path / 'out').y)
+
+
+def test_compressed_and_archived_spectra(tmp_path):
+    import gzip
+    import tarfile
+    import zipfile
+
+    filename = str(tmp_path / 'spectrum.txt')
+    write_raman_file(filename)
+    expected = RamanFit(filename, peaks=[], folder_out=tmp_path / 'out')
+
+    with open(filename, 'rb') as fh, gzip.open(filename + '.gz', 'wb') as gz:
+        gz.write(fh.read())
+    with zipfile.ZipFile(tmp_path / 'campaign.zip', 'w') as zf:
+        zf.write(filename, 'run1/spectrum.txt')
+    with tarfile.open(tmp_path / 'campaign.tar.gz', 'w:gz') as tf:
+        for i in range(3):
+            tf.add(filename, f'run1/spectrum_{i}.txt')
+
+    for name in (filename + '.gz', str(tmp_path / 'campaign.zip') + '::run1/spectrum.txt'):
+        actual = RamanFit(name, peaks=[], folder_out=tmp_path / 'out')
+        np.testing.assert_array_equal(actual.y, expected.y)
+        assert actual.experimental_data.shape == (500, 2)
+    assert actual.filename == str(tmp_path / 'campaign' / 'run1' / 'spectrum')
+
+    batch = load_directory(str(tmp_path / 'campaign.tar.gz'), workers=2)
+    assert batch.filenames[2] == str(tmp_path / 'campaign' / 'run1' / 'spectrum_2')
+    np.testing.assert_array_equal(batch.y[1], expected.y)
+
+    # the tar files are closed when an archive changes, and at the end of the threads of read_files_threaded
+    member = str(tmp_path / 'campaign.tar.gz') + '::run1/spectrum_0.txt'
+    close_archives()
+    for i in range(3):
+        os.utime(tmp_path / 'campaign.tar.gz', ns=(i * 10 ** 9, i * 10 ** 9))  # rewritten
+        with open_text(member) as fh:
+            fh.read()
+    assert len(_open_tars.archives) == 1
+    close_archives()
+
+    def reader(filename):
+        with open_text(filename) as fh:
+            fh.read()
+        return [tf for _, tf in _open_tars.archives.values()]
+
+    handles, failures = read_files_threaded([member.replace('_0', f'_{i}') for i in range(3)], reader, workers=2)
+    assert not failures and all(tf.closed for tfs in handles for tf in tfs)
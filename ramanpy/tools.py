@@ -15,3 +15,18 @@ def cleanup_header(lines_text):
     header = list(lines_text)
     return header
 
+
+def positions_from_header(header, axis=('X', 'Y', 'Z')):
+    """
+    Gets the positions of the measurement from a header, in micrometers.
+    :param header: dict with the header of the file (see RamanFit.read_header)
+    :param axis: names of the axis to retrieve
+    :return: list of positions, nan if not found in the header
+    Example:
+    >>> positions_from_header({'X(µm)': '12.5', 'Y(µm)': '-3'})
+    [12.5, -3.0, nan]
+
+    """
+    if not isinstance(header, dict):  # e.g. XRD files, the header is just the name of the file
+        return [float('nan')] * len(axis)
+    return [float(header.get(f'{element}(µm)', 'nan')) for element in axis]